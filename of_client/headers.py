@@ -0,0 +1,324 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+# author: Christopher Monsanto (chris@monsan.to)                               #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+
+"""
+Header field extraction from, and rewriting of, the raw bytes of a
+packet, with precompiled structs at fixed offsets.  Covers Ethernet,
+802.1Q, IPv4, TCP, UDP, ICMP and ARP; anything these functions are not
+sure they handle the way POX's packetlib would is left to packetlib
+(they return None).  No POX imports, so this can be used and tested on
+its own.
+"""
+
+import struct
+
+ETH_LEN = 14
+ETH = struct.Struct('!6s6sH')           # dstmac, srcmac, ethtype
+VLAN = struct.Struct('!HH')             # tci, inner ethtype
+IPV4 = struct.Struct('!BBHHHBBH4s4s')   # version/ihl, tos, total length, id, flags/fragment, ttl, protocol, checksum, srcip, dstip
+PORTS = struct.Struct('!HH')            # TCP/UDP srcport, dstport
+ICMP = struct.Struct('!BB')             # type, code
+ARP = struct.Struct('!HHBBH6s4s6s4s')   # hwtype, prototype, hwlen, protolen, opcode, hwsrc, protosrc, hwdst, protodst
+
+VLAN_TYPE = 0x8100
+IP_TYPE = 0x0800
+ARP_TYPE = 0x0806
+MIN_ETHTYPE = 0x0600                    # smaller values are 802.3 lengths
+TCP_PROTOCOL = 6
+UDP_PROTOCOL = 17
+ICMP_PROTOCOL = 1
+TCP_MIN_LEN = 20
+UDP_LEN = 8
+ICMP_MIN_LEN = 4
+IP_MORE_FRAGMENTS = 0x2000
+IP_FRAGMENT_OFFSET = 0x1fff
+IP_CHECKSUM = 10                        # offsets of checksums within their headers
+TCP_CHECKSUM = 16
+UDP_CHECKSUM = 6
+ICMP_CHECKSUM = 2
+WORD = struct.Struct('!H')
+
+
+def ethertype(raw):
+    """
+    The outermost ethertype of a packet, or None if it is too short.
+    """
+    if len(raw) < ETH_LEN:
+        return None
+    return ETH.unpack_from(raw)[2]
+
+
+def parse_headers(raw, length=None):
+    """
+    Extracts the header fields of a packet, which may have been
+    truncated after its headers.
+
+    :param raw: the packet
+    :type raw: str
+    :param length: the length of the whole packet, if raw was truncated
+    :type length: int
+    :returns: the header fields, keyed as in pyretic packets, or None if
+        the packet should be parsed by packetlib instead
+    :rtype: dict or None
+    """
+    if length is None:
+        length = len(raw)
+    if len(raw) < ETH_LEN:
+        return None
+    (dstmac,srcmac,ethtype) = ETH.unpack_from(raw)
+    if ethtype < MIN_ETHTYPE:
+        return None
+    h = {'header_len' : ETH_LEN,
+         'payload_len' : length - ETH_LEN,
+         'srcmac' : srcmac,
+         'dstmac' : dstmac,
+         'ethtype' : ethtype}
+    offset = ETH_LEN
+
+    if ethtype == VLAN_TYPE:
+        if len(raw) < offset + VLAN.size:
+            return None
+        (tci,ethtype) = VLAN.unpack_from(raw,offset)
+        h['vlan_id'] = tci & 0x0fff
+        h['vlan_pcp'] = tci >> 13
+        h['ethtype'] = ethtype
+        offset += VLAN.size
+
+    if ethtype == IP_TYPE:
+        if len(raw) < offset + IPV4.size:
+            return None
+        (vihl,tos,total_len,_,frag,_,protocol,_,srcip,dstip) = IPV4.unpack_from(raw,offset)
+        ihl = (vihl & 0x0f) * 4
+        if vihl >> 4 != 4 or ihl < IPV4.size or total_len < ihl:
+            return None
+        if len(raw) < offset + ihl or length < offset + total_len:
+            return None
+        h['srcip'] = srcip
+        h['dstip'] = dstip
+        h['protocol'] = protocol
+        h['tos'] = tos
+        if frag & (IP_MORE_FRAGMENTS | IP_FRAGMENT_OFFSET):
+            return h
+        payload_len = total_len - ihl
+        offset += ihl
+        if (protocol in (TCP_PROTOCOL,UDP_PROTOCOL,ICMP_PROTOCOL) and
+            len(raw) < offset + PORTS.size):
+            return None
+        if protocol == TCP_PROTOCOL:
+            if payload_len < TCP_MIN_LEN:
+                return None
+            (h['srcport'],h['dstport']) = PORTS.unpack_from(raw,offset)
+        elif protocol == UDP_PROTOCOL:
+            if payload_len < UDP_LEN:
+                return None
+            (h['srcport'],h['dstport']) = PORTS.unpack_from(raw,offset)
+        elif protocol == ICMP_PROTOCOL:
+            if payload_len < ICMP_MIN_LEN:
+                return None
+            (icmp_type,code) = ICMP.unpack_from(raw,offset)
+            h['srcport'] = icmp_type
+            h['dstport'] = code
+
+    elif ethtype == ARP_TYPE:
+        if len(raw) < offset + ARP.size:
+            return None
+        (hwtype,prototype,hwlen,protolen,opcode,_,protosrc,_,protodst) = ARP.unpack_from(raw,offset)
+        if (hwtype != 1 or prototype != IP_TYPE or 
+            hwlen != 6 or protolen != 4):
+            return None
+        if opcode <= 255:
+            h['ethtype'] = ARP_TYPE
+            h['protocol'] = opcode
+            h['srcip'] = protosrc
+            h['dstip'] = protodst
+
+    return h
+
+
+def words(value):
+    """The 16-bit words of a string of even length."""
+    return struct.unpack('!%dH' % (len(value) / 2), value)
+
+
+def update_checksum(buf, offset, changes):
+    """
+    Incrementally updates the ones'-complement checksum at offset for
+    16-bit words changing from old to new (RFC 1624, eqn. 3).
+
+    :param buf: the packet
+    :type buf: bytearray
+    :param offset: where the checksum is
+    :type offset: int
+    :param changes: (old, new) pairs of words
+    :type changes: list (int, int)
+    :returns: the new checksum
+    :rtype: int
+    """
+    (csum,) = WORD.unpack_from(buf, offset)
+    total = ~csum & 0xffff
+    for (old,new) in changes:
+        total += (~old & 0xffff) + new
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    csum = ~total & 0xffff
+    WORD.pack_into(buf, offset, csum)
+    return csum
+
+
+def rewrite_headers(raw, fields):
+    """
+    Rewrites the header fields of a packet in a copy of its bytes,
+    patching only what the fields change.  VLAN tags are inserted or
+    stripped with a single splice, and checksums are updated
+    incrementally, so the cost follows the modification rather than the
+    packet.
+
+    :param raw: the packet
+    :type raw: str
+    :param fields: the header values the packet should have, keyed as in
+        pyretic packets, with addresses as raw bytes; a vlan_id tags the
+        packet, its absence untags it
+    :type fields: dict
+    :returns: the rewritten packet, or None if it should be rewritten by
+        packetlib instead
+    :rtype: str or None
+    """
+    if len(raw) < ETH_LEN:
+        return None
+    (_,_,ethtype) = ETH.unpack_from(raw)
+    if ethtype < MIN_ETHTYPE:
+        return None
+    srcmac = fields.get('srcmac')
+    dstmac = fields.get('dstmac')
+    if not (isinstance(srcmac,str) and len(srcmac) == 6 and 
+            isinstance(dstmac,str) and len(dstmac) == 6):
+        return None
+    offset = ETH_LEN
+    tagged = ethtype == VLAN_TYPE
+    if tagged:
+        if len(raw) < offset + VLAN.size:
+            return None
+        (_,ethtype) = VLAN.unpack_from(raw,offset)
+        offset += VLAN.size
+    if ethtype == ARP_TYPE:
+        return None
+
+    buf = bytearray(raw)
+    buf[0:6] = dstmac
+    buf[6:12] = srcmac
+
+    ### VLAN
+    if 'vlan_id' in fields:
+        vlan_id = fields['vlan_id']
+        vlan_pcp = fields.get('vlan_pcp')
+        if vlan_id is None or vlan_pcp is None:
+            return None
+        tci = WORD.pack((vlan_pcp << 13) | vlan_id)
+        if tagged:
+            buf[ETH_LEN:ETH_LEN+2] = tci
+        else:
+            buf[12:12] = WORD.pack(VLAN_TYPE) + tci
+            offset += VLAN.size
+    elif tagged:
+        del buf[12:16]
+        offset -= VLAN.size
+
+    if ethtype != IP_TYPE:
+        return str(buf)
+
+    ### IPV4
+    if len(buf) < offset + IPV4.size:
+        return None
+    (vihl,tos,total_len,_,frag,_,protocol,_,srcip,dstip) = IPV4.unpack_from(buf,offset)
+    ihl = (vihl & 0x0f) * 4
+    if (vihl >> 4 != 4 or ihl < IPV4.size or total_len < ihl or
+        len(buf) < offset + total_len):
+        return None
+    new_srcip = fields.get('srcip')
+    new_dstip = fields.get('dstip')
+    new_tos = fields.get('tos')
+    if (fields.get('protocol') != protocol or new_tos is None or
+        not (isinstance(new_srcip,str) and len(new_srcip) == 4 and 
+             isinstance(new_dstip,str) and len(new_dstip) == 4)):
+        return None
+    ip_changes = []
+    if new_tos != tos:
+        ip_changes.append((vihl << 8 | tos, vihl << 8 | new_tos))
+        buf[offset+1] = new_tos
+    # CHANGES TO THE ADDRESSES ALSO CHANGE THE TCP/UDP PSEUDO-HEADER
+    address_changes = []
+    if new_srcip != srcip:
+        address_changes += zip(words(srcip),words(new_srcip))
+        buf[offset+12:offset+16] = new_srcip
+    if new_dstip != dstip:
+        address_changes += zip(words(dstip),words(new_dstip))
+        buf[offset+16:offset+20] = new_dstip
+    if ip_changes or address_changes:
+        update_checksum(buf, offset + IP_CHECKSUM, ip_changes + address_changes)
+
+    if frag & (IP_MORE_FRAGMENTS | IP_FRAGMENT_OFFSET):
+        return str(buf)
+
+    ### TRANSPORT
+    payload_len = total_len - ihl
+    offset += ihl
+    if protocol == TCP_PROTOCOL or protocol == UDP_PROTOCOL:
+        if payload_len < (TCP_MIN_LEN if protocol == TCP_PROTOCOL else UDP_LEN):
+            return None
+        new_ports = (fields.get('srcport'), fields.get('dstport'))
+        if None in new_ports:
+            return None
+        ports = PORTS.unpack_from(buf,offset)
+        changes = list(address_changes)
+        if new_ports != ports:
+            changes += zip(ports,new_ports)
+            PORTS.pack_into(buf,offset,*new_ports)
+        if changes:
+            if protocol == TCP_PROTOCOL:
+                update_checksum(buf, offset + TCP_CHECKSUM, changes)
+            elif WORD.unpack_from(buf, offset + UDP_CHECKSUM)[0] != 0:
+                # ZERO MEANS NO UDP CHECKSUM, AND A COMPUTED ZERO IS SENT AS ALL ONES
+                if update_checksum(buf, offset + UDP_CHECKSUM, changes) == 0:
+                    WORD.pack_into(buf, offset + UDP_CHECKSUM, 0xffff)
+    elif protocol == ICMP_PROTOCOL:
+        if payload_len < ICMP_MIN_LEN:
+            return None
+        new_type = fields.get('srcport')
+        new_code = fields.get('dstport')
+        if new_type is None or new_code is None:
+            return None
+        (icmp_type,code) = ICMP.unpack_from(buf,offset)
+        if (new_type,new_code) != (icmp_type,code):
+            ICMP.pack_into(buf,offset,new_type,new_code)
+            update_checksum(buf, offset + ICMP_CHECKSUM,
+                            [(icmp_type << 8 | code, new_type << 8 | new_code)])
+
+    return str(buf)
@@ -39,6 +39,10 @@ from pox.lib.packet.lldp          import lldp, chassis_id, port_id, end_tlv
 from pox.lib.packet.lldp          import ttl, system_description
 
 from pyretic.backend.comm import *
+from of_client.headers import parse_headers, rewrite_headers, ethertype
+from pyretic.backend.shm import ShmTransport
+
+FULL_PACKET_LEN = 0xffff  # max_len for sending the controller whole packets
 
 
 def inport_value_hack(outport):
@@ -48,27 +52,28 @@ def inport_value_hack(outport):
         return 2
 
 
-class BackendChannel(asynchat.async_chat):
+class BackendChannel(MessageChannel):
     """Sends messages to the server and receives responses.
     """
     def __init__(self, host, port, of_client):
         self.of_client = of_client
-        self.received_data = []
-        asynchat.async_chat.__init__(self)
+        self.pending_shm = None
+        MessageChannel.__init__(self)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((host, port))
-        self.ac_in_buffer_size = 4096 * 3
-        self.ac_out_buffer_size = 4096 * 3
-        self.set_terminator(TERM_CHAR)
         return
 
     def handle_connect(self):
         print "Connected to pyretic frontend."
-        
-    def collect_incoming_data(self, data):
-        """Read an incoming message from the client and put it into our outgoing queue."""
-        with self.of_client.channel_lock:
-            self.received_data.append(data)
+        if self.of_client.transport == 'shm':
+            try:
+                self.pending_shm = ShmTransport.create(self.handle_message)
+            except (EnvironmentError, ValueError), e:
+                print "WARNING: cannot create shared memory, using TCP: %s" % e
+            else:
+                self.send_message(['transport','shm',
+                                   self.pending_shm.tx_paths(),
+                                   self.pending_shm.rx_paths()])
 
     def dict2OF(self,d):
         def convert(h,val):
@@ -85,11 +90,8 @@ class BackendChannel(asynchat.async_chat):
                 return val
         return { h : convert(h,val) for (h, val) in d.items()}
 
-    def found_terminator(self):
-        """The end of a command or message has been seen."""
-        with self.of_client.channel_lock:
-            msg = deserialize(self.received_data)
-
+    def handle_message(self, msg):
+        """A complete message has been received."""
         # USE DESERIALIZED MSG
         if msg[0] == 'inject_discovery_packet':
             switch = msg[1]
@@ -97,12 +99,24 @@ class BackendChannel(asynchat.async_chat):
             self.of_client.inject_discovery_packet(switch,port)
         elif msg[0] == 'packet':
             packet = self.dict2OF(msg[1])
-            self.of_client.send_to_switch(packet)
+            outports = msg[2] if len(msg) > 2 else None
+            self.of_client.send_to_switch(packet,outports)
+        elif msg[0] == 'buffered_packet':
+            switch = msg[1]
+            inport = msg[2]
+            buffer_id = msg[3]
+            actions = map(self.dict2OF,msg[4])
+            self.of_client.send_buffered_to_switch(switch,inport,buffer_id,actions)
+        elif msg[0] == 'packet_in_length':
+            length = msg[1]
+            switch = msg[2]
+            self.of_client.set_packet_in_length(length,switch)
         elif msg[0] == 'install':
             pred = self.dict2OF(msg[1])
             priority = int(msg[2])
             actions = map(self.dict2OF,msg[3])
-            self.of_client.install_flow(pred,priority,actions)
+            cookie = msg[4] if len(msg) > 4 else 0
+            self.of_client.install_flow(pred,priority,actions,cookie)
         elif msg[0] == 'delete':
             pred = self.dict2OF(msg[1])
             priority = int(msg[2])
@@ -110,24 +124,59 @@ class BackendChannel(asynchat.async_chat):
         elif msg[0] == 'clear':
             switch = int(msg[1])
             self.of_client.clear(switch)
+        elif msg[0] == 'apply_diff':
+            switch = msg[1]
+            batch = msg[2]
+            xid = msg[3]
+            for op in batch:
+                if op[0] == 'install':
+                    op[1] = self.dict2OF(op[1])
+                    op[3] = map(self.dict2OF,op[3])
+                elif op[0] == 'delete':
+                    op[1] = self.dict2OF(op[1])
+            self.of_client.apply_diff(switch,batch,xid)
         elif msg[0] == 'barrier':
             switch = msg[1]
-            self.of_client.barrier(switch)
+            xid = msg[2] if len(msg) > 2 else None
+            self.of_client.barrier(switch,xid)
         elif msg[0] == 'flow_stats_request':
             switch = msg[1]
-            self.of_client.flow_stats_request(switch)
+            pred = msg[2] if len(msg) > 2 and not msg[2] is None else {}
+            xid = msg[3] if len(msg) > 3 else None
+            self.of_client.flow_stats_request(switch,self.dict2OF(pred),xid)
+        elif msg[0] == 'aggregate_stats_request':
+            switch = msg[1]
+            pred = self.dict2OF(msg[2])
+            xid = msg[3]
+            self.of_client.aggregate_stats_request(switch,pred,xid)
+        elif msg[0] == 'transport':
+            shm = self.pending_shm
+            self.pending_shm = None
+            if shm is None:
+                return
+            shm.unlink()
+            if msg[1] == 'shm':
+                # THE LAST MESSAGE OVER TCP, SO THE FRONTEND KNOWS WHEN TO READ THE RINGS
+                self.send_message(['transport','ready'])
+                self.shm = shm
+                shm.start()
+                print "Using shared memory transport."
+            else:
+                shm.close()
         else:
             print "ERROR: Unknown msg from frontend %s" % msg
 
 
 class POXClient(revent.EventMixin):
     # NOT **kwargs
-    def __init__(self,show_traces=False,debug_packet_in=False,ip='127.0.0.1',port=BACKEND_PORT):
+    def __init__(self,show_traces=False,debug_packet_in=False,ip='127.0.0.1',port=BACKEND_PORT,
+                 transport='tcp'):
         self.switches = {}
         self.show_traces = show_traces
         self.debug_packet_in = debug_packet_in
         self.packetno = 0
-        self.channel_lock = threading.Lock()
+        self.transport = transport
+        self.packet_in_length = None
 
         if core.hasComponent("openflow"):
             self.listenTo(core.openflow)
@@ -135,11 +184,19 @@ class POXClient(revent.EventMixin):
         self.backend_channel = BackendChannel(ip, port, self)
         self.adjacency = {} # From Link to time.time() stamp
 
-    def packet_from_network(self, switch, inport, raw):
-        h = {}
+    def packet_from_network(self, switch, inport, raw, length=None):
+        h = parse_headers(raw, length)
+        if h is None:
+            h = self.packetlib_headers(raw)
+            if not length is None:
+                h["payload_len"] = length - h["header_len"]
         h["switch"] = switch
         h["inport"] = inport
-        
+        h["raw"] = raw
+        return h
+
+    def packetlib_headers(self, raw):
+        h = {}
         p = packetlib.ethernet(raw)
         h["header_len"] = p.hdr_len
         h["payload_len"] = p.payload_len
@@ -174,7 +231,6 @@ class POXClient(revent.EventMixin):
                 h["srcip"] = p.protosrc.toRaw()
                 h["dstip"] = p.protodst.toRaw()
 
-        h["raw"] = raw 
         return h
 
     def make_arp(self, packet):
@@ -195,6 +251,19 @@ class POXClient(revent.EventMixin):
 
 
     def packet_to_network(self, packet):
+        if len(packet["raw"]) > 0:
+            def raw_value(v):
+                try:
+                    return v.toRaw()
+                except AttributeError:
+                    return v
+            fields = { h : raw_value(v) for (h,v) in packet.items() }
+            raw = rewrite_headers(packet["raw"],fields)
+            if not raw is None:
+                return raw
+        return self.packetlib_to_network(packet)
+
+    def packetlib_to_network(self, packet):
         if len(packet["raw"]) == 0:
             if packet["ethtype"] == packetlib.ethernet.ARP_TYPE:
                 p_begin = p = self.make_arp(packet)
@@ -344,30 +413,35 @@ class POXClient(revent.EventMixin):
             pass
 
 
-    def send_to_pyretic(self,msg):
-        serialized_msg = serialize(msg)
+    def send_to_pyretic(self,msg,lane=LANE_CONTROL,droppable=False):
         try:
-            with self.channel_lock:
-                self.backend_channel.push(serialized_msg)
+            self.backend_channel.send_message(msg,lane,droppable)
         except IndexError as e:
             print "ERROR PUSHING MESSAGE %s" % msg
             pass
 
 
-    def send_to_switch(self,packet):
+    def send_to_switch(self,packet,outports=None):
         switch = packet["switch"]
-        outport = packet["outport"]
-        try:
-            inport = packet["inport"]
-            if inport == -1 or inport == outport:
-                inport = inport_value_hack(outport)
-        except KeyError:
-            inport = inport_value_hack(outport)
-        
         msg = of.ofp_packet_out()
-        msg.in_port = inport
+        if outports is None:
+            outport = packet["outport"]
+            try:
+                inport = packet["inport"]
+                if inport == -1 or inport == outport:
+                    inport = inport_value_hack(outport)
+            except KeyError:
+                inport = inport_value_hack(outport)
+            msg.in_port = inport
+            msg.actions.append(of.ofp_action_output(port = outport))
+        else:
+            inport = packet.get("inport",-1)
+            if inport == -1:
+                msg.in_port = of.OFPP_NONE
+            else:
+                msg.in_port = inport
+            msg.actions = self.build_output_actions(switch,inport,outports)
         msg.data = self.packet_to_network(packet)
-        msg.actions.append(of.ofp_action_output(port = outport))
  
         if self.show_traces:
             print "========= POX/OF SEND ================"
@@ -385,6 +459,72 @@ class POXClient(revent.EventMixin):
             print "ERROR:send_to_switch: No connection to switch %d available" % switch
             # TODO - IF SOCKET RECONNECTION, THEN WAIT AND RETRY
 
+    def build_output_actions(self,switch,inport,outports):
+        """
+        The output actions sending a packet that came in on inport out of
+        each of outports, using a single OFPP_ALL action when they are
+        all of the switch's other ports.
+        """
+        outports = set(outports)
+        actions = []
+        if inport in outports:
+            outports.discard(inport)
+            actions.append(of.ofp_action_output(port = of.OFPP_IN_PORT))
+        try:
+            others = set(self.switches[switch]['ports']) - set([inport])
+        except KeyError:
+            others = set()
+        if others and outports == others:
+            actions.append(of.ofp_action_output(port = of.OFPP_ALL))
+        else:
+            actions += [ of.ofp_action_output(port = outport) 
+                         for outport in sorted(outports) ]
+        return actions
+
+    def send_buffered_to_switch(self,switch,inport,buffer_id,action_list):
+        msg = of.ofp_packet_out()
+        msg.in_port = inport
+        msg.buffer_id = buffer_id
+        msg.actions = self.build_of_actions(switch,inport,action_list)
+
+        if self.show_traces:
+            print "========= POX/OF SEND BUFFERED ======="
+            print msg
+            print
+
+        try:
+            self.switches[switch]['connection'].send(msg)
+        except RuntimeError, e:
+            print "ERROR:send_buffered_to_switch: %s to switch %d" % (str(e),switch)
+        except KeyError, e:
+            print "ERROR:send_buffered_to_switch: No connection to switch %d available" % switch
+
+    def controller_max_len(self,switch,max_len):
+        """
+        How much of each packet switch should send the controller: all
+        of it unless the switch can buffer the rest.
+        """
+        if max_len is None or not self.switches.get(switch,{}).get('buffers'):
+            return FULL_PACKET_LEN
+        return max_len
+
+    def set_packet_in_length(self,length,switch=None):
+        """
+        Sets how much of the packets that miss in their tables switch, or
+        all switches, send the controller.  Rules that send packets to the
+        controller carry their own length.
+        """
+        self.packet_in_length = length
+        if switch is None:
+            switches = self.switches.keys()
+        elif switch in self.switches:
+            switches = [switch]
+        else:
+            switches = []
+        for s in switches:
+            miss_send_len = self.controller_max_len(s,length)
+            self.switches[s]['connection'].send(of.ofp_set_config(miss_send_len=miss_send_len))
+
     def build_of_match(self,switch,inport,pred):
         ### BUILD OF MATCH
         match = of.ofp_match()
@@ -413,12 +553,13 @@ class POXClient(revent.EventMixin):
             match.tp_dst = pred['dstport']
         return match
 
-    def build_of_actions(self,inport,action_list):
+    def build_of_actions(self,switch,inport,action_list):
         ### BUILD OF ACTIONS
         of_actions = []
         for actions in action_list:
             outport = actions['outport']
             del actions['outport']
+            max_len = actions.pop('max_len',None)
             if 'srcmac' in actions:
                 of_actions.append(of.ofp_action_dl_addr.set_src(actions['srcmac']))
             if 'dstmac' in actions:
@@ -441,24 +582,52 @@ class POXClient(revent.EventMixin):
                     of_actions.append(of.ofp_action_vlan_pcp(vlan_pcp=actions['vlan_pcp']))
             if (not inport is None) and (outport == inport):
                 of_actions.append(of.ofp_action_output(port=of.OFPP_IN_PORT))
+            elif outport == of.OFPP_CONTROLLER:
+                of_actions.append(of.ofp_action_output(port=outport,
+                                                       max_len=self.controller_max_len(switch,max_len)))
             else:
                 of_actions.append(of.ofp_action_output(port=outport))
         return of_actions
 
-    def install_flow(self,pred,priority,action_list):
+    def build_flow_add(self,pred,priority,action_list,cookie=0):
+        switch = pred['switch']
+        if 'inport' in pred:        
+            inport = pred['inport']
+        else:
+            inport = None
+        match = self.build_of_match(switch,inport,pred)
+        of_actions = self.build_of_actions(switch,inport,action_list)
+        # COUNTED RULES REPORT THEIR FINAL COUNTS WHEN REMOVED
+        flags = of.OFPFF_SEND_FLOW_REM if cookie else 0
+        return of.ofp_flow_mod(command=of.OFPFC_ADD,
+                               cookie=cookie,
+                               flags=flags,
+                               priority=priority,
+                               idle_timeout=of.OFP_FLOW_PERMANENT,
+                               hard_timeout=of.OFP_FLOW_PERMANENT,
+                               match=match,
+                               actions=of_actions)
+
+    def build_flow_delete(self,pred,priority):
         switch = pred['switch']
         if 'inport' in pred:        
             inport = pred['inport']
         else:
             inport = None
         match = self.build_of_match(switch,inport,pred)
-        of_actions = self.build_of_actions(inport,action_list)
-        msg = of.ofp_flow_mod(command=of.OFPFC_ADD,
-                              priority=priority,
-                              idle_timeout=of.OFP_FLOW_PERMANENT,
-                              hard_timeout=of.OFP_FLOW_PERMANENT,
-                              match=match,
-                              actions=of_actions)
+        return of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT,
+                               priority=priority,
+                               match=match)
+
+    def build_barrier(self,xid=None):
+        b = of.ofp_barrier_request()
+        if not xid is None:
+            b.xid = xid
+        return b
+
+    def install_flow(self,pred,priority,action_list,cookie=0):
+        switch = pred['switch']
+        msg = self.build_flow_add(pred,priority,action_list,cookie)
         try:
             self.switches[switch]['connection'].send(msg)
         except RuntimeError, e:
@@ -468,14 +637,7 @@ class POXClient(revent.EventMixin):
 
     def delete_flow(self,pred,priority):
         switch = pred['switch']
-        if 'inport' in pred:        
-            inport = pred['inport']
-        else:
-            inport = None
-        match = self.build_of_match(switch,inport,pred)
-        msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT,
-                              priority=priority,
-                              match=match)
+        msg = self.build_flow_delete(pred,priority)
         try:
             self.switches[switch]['connection'].send(msg)
         except RuntimeError, e:
@@ -483,15 +645,55 @@ class POXClient(revent.EventMixin):
         except KeyError, e:
             print "WARNING:delete_flow: No connection to switch %d available" % switch
 
-    def barrier(self,switch):
-        b = of.ofp_barrier_request()
-        self.switches[switch]['connection'].send(b) 
+    def apply_diff(self,switch,batch,xid=None):
+        """
+        Applies a batch of flow table updates to switch, followed by a
+        barrier with transaction id xid, packing all of their OpenFlow
+        messages into a single write.
+        """
+        msgs = []
+        for op in batch:
+            if op[0] == 'install':
+                msgs.append(self.build_flow_add(op[1],op[2],op[3],op[4]))
+            elif op[0] == 'delete':
+                msgs.append(self.build_flow_delete(op[1],op[2]))
+            elif op[0] == 'clear':
+                msgs.append(of.ofp_flow_mod(command = of.OFPFC_DELETE))
+            elif op[0] == 'barrier':
+                msgs.append(self.build_barrier())
+        msgs.append(self.build_barrier(xid))
+        try:
+            self.switches[switch]['connection'].send(''.join(m.pack() for m in msgs))
+        except RuntimeError, e:
+            print "WARNING:apply_diff: %s to switch %d" % (str(e),switch)
+        except KeyError, e:
+            print "WARNING:apply_diff: No connection to switch %d available" % switch
 
-    def flow_stats_request(self,switch):
+    def barrier(self,switch,xid=None):
+        b = self.build_barrier(xid)
+        try:
+            self.switches[switch]['connection'].send(b) 
+        except RuntimeError, e:
+            print "WARNING:barrier: %s to switch %d" % (str(e),switch)
+        except KeyError, e:
+            print "WARNING:barrier: No connection to switch %d available" % switch
+
+    def flow_stats_request(self,switch,pred={},xid=None):
         sr = of.ofp_stats_request()
+        if not xid is None:
+            sr.xid = xid
         sr.body = of.ofp_flow_stats_request()
-        match = of.ofp_match()
-        sr.body.match = match
+        sr.body.match = self.build_of_match(switch,pred.get('inport'),pred)
+        sr.body.table_id = 0xff
+        sr.body.out_port = of.OFPP_NONE
+        self.switches[switch]['connection'].send(sr) 
+
+    def aggregate_stats_request(self,switch,pred,xid=None):
+        sr = of.ofp_stats_request()
+        if not xid is None:
+            sr.xid = xid
+        sr.body = of.ofp_aggregate_stats_request()
+        sr.body.match = self.build_of_match(switch,pred.get('inport'),pred)
         sr.body.table_id = 0xff
         sr.body.out_port = of.OFPP_NONE
         self.switches[switch]['connection'].send(sr) 
@@ -510,9 +712,14 @@ class POXClient(revent.EventMixin):
         self.switches[event.dpid] = {}
         self.switches[event.dpid]['connection'] = event.connection
         self.switches[event.dpid]['ports'] = {}
+        self.switches[event.dpid]['buffers'] = event.ofp.n_buffers
+
+        if not self.packet_in_length is None:
+            self.set_packet_in_length(self.packet_in_length,event.dpid)
 
         msg = of.ofp_flow_mod(match = of.ofp_match())
-        msg.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER))
+        msg.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER,
+                                                max_len = self.controller_max_len(event.dpid,self.packet_in_length)))
         self.switches[event.dpid]['connection'].send(msg) 
 
         self.send_to_pyretic(['switch','join',event.dpid,'BEGIN'])
@@ -594,6 +801,21 @@ class POXClient(revent.EventMixin):
             action_dicts.append(d)
         return action_dicts
 
+    def _handle_BarrierIn(self, event):
+        self.send_to_pyretic(['barrier_reply',event.dpid,event.xid])
+
+    def _handle_FlowRemoved(self, event):
+        flow_removed = event.ofp
+        if not flow_removed.cookie:
+            return
+        flow_stat_dict = {}
+        flow_stat_dict['cookie'] = flow_removed.cookie
+        flow_stat_dict['priority'] = flow_removed.priority
+        flow_stat_dict['match'] = self.of_match_to_dict(flow_removed.match)
+        flow_stat_dict['packet_count'] = flow_removed.packet_count
+        flow_stat_dict['byte_count'] = flow_removed.byte_count
+        self.send_to_pyretic(['flow_removed',event.connection.dpid,flow_stat_dict],LANE_BULK)
+
     def _handle_FlowStatsReceived (self, event):
         dpid = event.connection.dpid
         def handle_ofp_flow_stat(flow_stat):
@@ -614,7 +836,20 @@ class POXClient(revent.EventMixin):
             flow_stat_dict['actions'] = actions
             return flow_stat_dict
         flow_stats = [handle_ofp_flow_stat(s) for s in event.stats]
-        self.send_to_pyretic(['flow_stats_reply',dpid,flow_stats])
+        self.send_to_pyretic(['flow_stats_reply',dpid,flow_stats,self.stats_xid(event)],LANE_BULK)
+
+    def _handle_AggregateFlowStatsReceived(self, event):
+        dpid = event.connection.dpid
+        aggregate_stats = {'packet_count' : event.stats.packet_count,
+                           'byte_count' : event.stats.byte_count,
+                           'flow_count' : event.stats.flow_count}
+        # SAME LANE AS flow_removed, WHICH MUST NOT BE OVERTAKEN
+        self.send_to_pyretic(['aggregate_stats_reply',dpid,aggregate_stats,self.stats_xid(event)],LANE_BULK)
+
+    def stats_xid(self, event):
+        """The transaction id of the request a stats event replies to."""
+        parts = event.ofp if isinstance(event.ofp, list) else [event.ofp]
+        return parts[0].xid
 
     def _handle_PortStatus(self, event):
         port = event.ofp.desc
@@ -701,8 +936,8 @@ class POXClient(revent.EventMixin):
         if originatorDPID == None:
             return
 
-        if originatorDPID not in core.openflow.connections:
-            return
+        # THE ORIGINATOR MAY BE CONNECTED TO ANOTHER OF CLIENT, SO LEAVE IT TO
+        # THE FRONTEND, WHICH IGNORES LINKS TO SWITCHES IT DOESN'T KNOW
 
         # Get port number from port TLV
         if lldph.tlvs[1].subtype != pkt.port_id.SUB_PORT:
@@ -738,11 +973,12 @@ class POXClient(revent.EventMixin):
 
 
     def _handle_PacketIn(self, event):
-        packet = event.parsed
-        if packet.type == ethernet.LLDP_TYPE: 
-            self.handle_lldp(packet,event)
+        # CHECK THE ETHERTYPE ON THE RAW BYTES, SO THAT POX ONLY PARSES LLDP
+        packet_type = ethertype(event.data)
+        if packet_type == ethernet.LLDP_TYPE: 
+            self.handle_lldp(event.parsed,event)
             return
-        elif packet.type == 0x86dd:  # IGNORE IPV6
+        elif packet_type == 0x86dd:  # IGNORE IPV6
             return 
 
         if self.show_traces:
@@ -755,17 +991,20 @@ class POXClient(revent.EventMixin):
             print "dpid\t%s" % event.dpid
             print
 
-        received = self.packet_from_network(event.dpid, event.ofp.in_port, event.data)
-        self.send_to_pyretic(['packet',received])
+        received = self.packet_from_network(event.dpid, event.ofp.in_port, event.data,
+                                            event.ofp.total_len)
+        if not event.ofp.buffer_id is None:
+            received['buffer_id'] = event.ofp.buffer_id
+        self.send_to_pyretic(['packet',received],LANE_PACKET,droppable=True)
         
        
-def launch():
+def launch(transport='tcp'):
 
     class asyncore_loop(threading.Thread):
         def run(self):
-            asyncore.loop()
+            asyncore.loop(timeout=ASYNCORE_TIMEOUT)
 
-    POXClient()
+    POXClient(transport=transport)
     al = asyncore_loop()
     al.start()
 
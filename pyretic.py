@@ -42,14 +42,16 @@ import logging
 from multiprocessing import Queue, Process
 import pyretic.core.util as util
 
-of_client = None
+of_clients = []
+OF_PORT = 6633
 
 def signal_handler(signal, frame):
     print '\n----starting pyretic shutdown------'
     # for thread in threading.enumerate():
     #     print (thread,thread.isAlive())
     print "attempting to kill of_client"
-    of_client.kill()
+    for of_client in of_clients:
+        of_client.kill()
     # print "attempting get output of of_client:"
     # output = of_client.communicate()[0]
     # print output
@@ -83,15 +85,24 @@ def parseArgs():
                    choices=['low','normal','high','please-make-it-stop'],
                    default = 'low',
                    help = '|'.join( ['low','normal','high','please-make-it-stop'] )  )
-
-    op.set_defaults(frontend_only=False,mode='reactive0')
+    op.add_option( '--of-clients', '-n', type='int', dest='of_clients',
+                   help = 'number of OF clients to start, client i serving the '
+                          'switches whose DPID is i modulo this on port %d+i. '
+                          'Each switch must connect to its own client only, e.g. '
+                          'by passing the same --of-clients to mininet.sh' % OF_PORT )
+
+    op.add_option( '--transport', '-t', type='choice',
+                   choices=['tcp','shm'],
+                   help = 'tcp|shm, shm using shared memory rings to reach '
+                          'the OF clients, falling back to tcp if they are unavailable' )
+
+    op.set_defaults(frontend_only=False,mode='reactive0',of_clients=1,transport='tcp')
     options, args = op.parse_args()
 
     return (op, options, args, kwargs_to_pass)
 
 
 def main():
-    global of_client
     (op, options, args, kwargs_to_pass) = parseArgs()
     if options.mode == 'i':
         options.mode = 'interpreted'
@@ -179,11 +190,20 @@ def main():
         python=sys.executable
         # TODO(josh): pipe pox_client stdout to subprocess.PIPE or
         # other log file descriptor if necessary
-        of_client = subprocess.Popen([python, 
-                                      pox_exec,
-                                      'of_client.pox_client' ],
-                                     stdout=sys.stdout,
-                                     stderr=subprocess.STDOUT)
+        of_client_module = ['of_client.pox_client']
+        if options.transport != 'tcp':
+            of_client_module.append('--transport=%s' % options.transport)
+        if options.of_clients == 1:
+            of_client_args = [of_client_module]
+        else:
+            of_client_args = [ of_client_module + 
+                               ['openflow.of_01',
+                                '--port=%d' % (OF_PORT + i)]
+                               for i in range(options.of_clients) ]
+        for a in of_client_args:
+            of_clients.append(subprocess.Popen([python, pox_exec] + a,
+                                               stdout=sys.stdout,
+                                               stderr=subprocess.STDOUT))
     
     signal.signal(signal.SIGINT, signal_handler)
     signal.pause()
@@ -27,8 +27,12 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
-import threading
+import threading, traceback
+from collections import deque
 from pyretic.backend.comm import *
+from pyretic.backend.shm import ShmTransport
+
+INBOUND_PACKET_LIMIT = 1024  # packet-ins waiting for the runtime before more are dropped
 
 class BackendServer(asyncore.dispatcher):
     """Receives connections and establishes handlers for each backend.
@@ -39,56 +43,78 @@ class BackendServer(asyncore.dispatcher):
         self.set_reuse_addr()
         self.bind(address)
         self.address = self.socket.getsockname()
-        self.listen(1)
+        self.listen(5)
         self.backend = backend
         return
 
     def handle_accept(self):
-        # Called when a backend connects to our socket
+        # Called when a backend connects to our socket.
+        # Several OF clients may connect, each serving a shard of the
+        # switches, so keep listening.
         backend_info = self.accept()
-        self.backend.backend_channel = BackendChannel(self.backend,sock=backend_info[0])
-        # We only want to deal with one backend at a time,
-        # so close as soon as we set up the handler.
-        # Normally you would not do this and the server
-        # would run forever or until it received instructions
-        # to stop.
-        self.handle_close()
+        if backend_info is None:
+            return
+        self.backend.add_channel(BackendChannel(self.backend,sock=backend_info[0]))
         return
     
     def handle_close(self):
         self.close()
 
 
-class BackendChannel(asynchat.async_chat):
+class BackendChannel(MessageChannel):
     """Handles echoing messages from a single backend.
     """
     def __init__(self, backend, sock):
         self.backend = backend
-        self.received_data = []
-        asynchat.async_chat.__init__(self, sock)
-        self.ac_in_buffer_size = 4096 * 3
-        self.ac_out_buffer_size = 4096 * 3
-        self.set_terminator(TERM_CHAR)
+        MessageChannel.__init__(self, sock)
         return
 
-    def collect_incoming_data(self, data):
-        """Read an incoming message from the backend and put it into our outgoing queue."""
-        with self.backend.channel_lock:
-            self.received_data.append(data)
+    def handle_close(self):
+        MessageChannel.handle_close(self)
+        self.backend.remove_channel(self)
 
-    def found_terminator(self):
-        """The end of a command or message has been seen."""
-        with self.backend.channel_lock:
-            msg = deserialize(self.received_data)
+    def handle_message(self, msg):
+        """A complete message has been received."""
+        if msg and msg[0] == 'transport':
+            self.negotiate_transport(msg)
+        else:
+            self.backend.receive(self,msg)
+
+    def negotiate_transport(self, msg):
+        """
+        Attaches the shared-memory rings offered by the OF client, or
+        declines them so that it keeps using TCP.  The rings are only
+        read once the client reports, as its last message over TCP, that
+        it has switched to them.
+        """
+        if msg[1] == 'ready':
+            if not self.shm is None:
+                self.shm.start()
+            return
+        if msg[1] == 'shm':
+            try:
+                # THE CLIENT'S RECEIVE RINGS ARE OUR TRANSMIT RINGS
+                shm = ShmTransport(msg[3],msg[2],self.handle_message)
+            except (EnvironmentError, ValueError, TypeError), e:
+                print "WARNING: cannot attach shared memory, using TCP: %s" % e
+            else:
+                self.send_message(['transport','shm'])
+                self.shm = shm
+                return
+        self.send_message(['transport','tcp'])
 
+    def dispatch_message(self, msg):
+        """Hands a received message to the runtime."""
         # USE DESERIALIZED MSG
         if msg is None or len(msg) == 0:
             print "ERROR: empty message"
         elif msg[0] == 'switch':
             if msg[1] == 'join':
                 if msg[3] == 'BEGIN':
+                    self.backend.route_switch(msg[2],self)
                     self.backend.runtime.handle_switch_join(msg[2])
             elif msg[1] == 'part':
+                self.backend.route_switch(msg[2],None)
                 self.backend.runtime.handle_switch_part(msg[2])
             else:
                 print "ERROR: Bad switch event"
@@ -107,7 +133,13 @@ class BackendChannel(asynchat.async_chat):
             packet = msg[1]
             self.backend.runtime.handle_packet_in(packet)
         elif msg[0] == 'flow_stats_reply':
-            self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2])
+            self.backend.runtime.handle_flow_stats_reply(msg[1],msg[2],msg[3])
+        elif msg[0] == 'aggregate_stats_reply':
+            self.backend.runtime.handle_aggregate_stats_reply(msg[1],msg[2],msg[3])
+        elif msg[0] == 'flow_removed':
+            self.backend.runtime.handle_flow_removed(msg[1],msg[2])
+        elif msg[0] == 'barrier_reply':
+            self.backend.runtime.handle_barrier_reply(msg[1],msg[2])
         else:
             print 'ERROR: Unknown msg from backend %s' % msg
         return
@@ -117,12 +149,21 @@ class Backend(object):
 
     class asyncore_loop(threading.Thread):
         def run(self):
-            asyncore.loop()
+            asyncore.loop(timeout=ASYNCORE_TIMEOUT)
 
     def __init__(self):
-        self.backend_channel = None
+        self.channels = []
+        self.switch_channels = {}
         self.runtime = None
         self.channel_lock = threading.Lock()
+        self.inbound_cv = threading.Condition()
+        self.inbound = deque()
+        self.inbound_packets = 0
+        self.dropped_packet_ins = 0
+
+        self.dispatcher = threading.Thread(target=self.dispatch_loop)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
 
         address = ('localhost', BACKEND_PORT) # USE KNOWN PORT
         self.backend_server = BackendServer(self,address)
@@ -131,29 +172,118 @@ class Backend(object):
         self.al.daemon = True
         self.al.start()
         
-    def send_packet(self,packet):
-        self.send_to_OF_client(['packet',packet])
+    def add_channel(self,channel):
+        with self.channel_lock:
+            self.channels.append(channel)
+
+    def remove_channel(self,channel):
+        """
+        Forgets a closed channel; the switches it served have left.
+        """
+        with self.channel_lock:
+            if not channel in self.channels:
+                return
+            self.channels.remove(channel)
+            orphans = [ s for (s,c) in self.switch_channels.items() 
+                        if c is channel ]
+        for s in orphans:
+            self.receive(channel,['switch','part',s])
+
+    def route_switch(self,switch,channel):
+        """
+        Records the channel of the OF client that a switch is connected
+        to, or forgets it if channel is None.
+        """
+        with self.channel_lock:
+            if channel is None:
+                self.switch_channels.pop(switch,None)
+            else:
+                self.switch_channels[switch] = channel
+
+    def receive(self,channel,msg):
+        """
+        Queues a message for the dispatcher thread, so that the I/O thread
+        never waits on the runtime.  Packet-ins are dropped while
+        INBOUND_PACKET_LIMIT of them are already waiting; other messages
+        are always queued.
+        """
+        with self.inbound_cv:
+            if msg and msg[0] == 'packet':
+                if self.inbound_packets >= INBOUND_PACKET_LIMIT:
+                    self.dropped_packet_ins += 1
+                    return
+                self.inbound_packets += 1
+            self.inbound.append((channel,msg))
+            self.inbound_cv.notify()
+
+    def dispatch_loop(self):
+        while True:
+            with self.inbound_cv:
+                while not self.inbound:
+                    self.inbound_cv.wait()
+                (channel,msg) = self.inbound.popleft()
+                if msg and msg[0] == 'packet':
+                    self.inbound_packets -= 1
+            try:
+                channel.dispatch_message(msg)
+            except Exception:
+                traceback.print_exc()
+
+    def send_packet(self,packet,outports=None):
+        msg = ['packet',packet]
+        if not outports is None:
+            msg.append(outports)
+        self.send_to_OF_client(msg,LANE_PACKET,droppable=True,
+                               switch=packet['switch'])
 
-    def send_install(self,pred,priority,action_list):
-        self.send_to_OF_client(['install',pred,priority,action_list])
+    def send_buffered_packet(self,switch,inport,buffer_id,action_list):
+        self.send_to_OF_client(['buffered_packet',switch,inport,buffer_id,action_list],
+                               LANE_PACKET,droppable=True,switch=switch)
+
+    def send_packet_in_length(self,length,switch=None):
+        self.send_to_OF_client(['packet_in_length',length,switch],switch=switch)
+
+    def send_install(self,pred,priority,action_list,cookie=0):
+        self.send_to_OF_client(['install',pred,priority,action_list,cookie],LANE_BULK,
+                               switch=pred.get('switch'))
 
     def send_delete(self,pred,priority):
-        self.send_to_OF_client(['delete',pred,priority])
+        self.send_to_OF_client(['delete',pred,priority],LANE_BULK,
+                               switch=pred.get('switch'))
         
     def send_clear(self,switch):
-        self.send_to_OF_client(['clear',switch])
+        self.send_to_OF_client(['clear',switch],LANE_BULK,switch=switch)
+
+    def send_flow_stats_request(self,switch,pred=None,xid=None):
+        self.send_to_OF_client(['flow_stats_request',switch,pred,xid],switch=switch)
 
-    def send_flow_stats_request(self,switch):
-        self.send_to_OF_client(['flow_stats_request',switch])
+    def send_aggregate_stats_request(self,switch,pred,xid=None):
+        self.send_to_OF_client(['aggregate_stats_request',switch,pred,xid],switch=switch)
 
-    def send_barrier(self,switch):
-        self.send_to_OF_client(['barrier',switch])
+    def send_apply_diff(self,switch,batch,xid=None):
+        self.send_to_OF_client(['apply_diff',switch,batch,xid],LANE_BULK,switch=switch)
+
+    def send_barrier(self,switch,xid=None):
+        self.send_to_OF_client(['barrier',switch,xid],LANE_BULK,switch=switch)
 
     def inject_discovery_packet(self,dpid, port):
-        self.send_to_OF_client(['inject_discovery_packet',dpid,port])
+        self.send_to_OF_client(['inject_discovery_packet',dpid,port],droppable=True,
+                               switch=dpid)
 
-    def send_to_OF_client(self,msg):
-        serialized_msg = serialize(msg)
+    def send_to_OF_client(self,msg,lane=LANE_CONTROL,droppable=False,switch=None):
+        """
+        Sends a message in the given lane to the OF client connected to
+        switch, or to every OF client if that is not known.  Flow-mods
+        travel in LANE_BULK together with the barriers that delimit them,
+        so that they stay in order.  Blocks while the lane is backlogged,
+        unless the message is droppable, in which case it is discarded
+        instead.
+        """
         with self.channel_lock:
-            if not self.backend_channel is None:
-                self.backend_channel.push(serialized_msg)
+            channel = self.switch_channels.get(switch)
+            if channel is None:
+                channels = list(self.channels)
+            else:
+                channels = [channel]
+        for channel in channels:
+            channel.send_message(msg,lane,droppable)
@@ -29,82 +29,462 @@
 
 import asynchat
 import asyncore
+import errno
 import socket
-
-import json
+import struct
+import threading
+from collections import deque
 
 BACKEND_PORT=41414
-TERM_CHAR='\n'
-
-def serialize(msg):
-    jsonable_msg = to_jsonable_format(msg)
-    jsoned_msg = json.dumps(jsonable_msg)
-    serialized_msg = jsoned_msg + TERM_CHAR
-    return serialized_msg
-
-def deserialize(serialized_msgs):
-    def json2python(item):
-        if isinstance(item, unicode):
-            return item.encode('ascii')
-        elif isinstance(item, dict):
-            return bytelist2ascii({ 
-                    json2python(k) : json2python(v) 
-                    for (k,v) in item.items() })
-        elif isinstance(item, list):
-            return [ json2python(l)
-                     for l in item ]
+ASYNCORE_TIMEOUT=0.05  # seconds, so channels written by other threads are polled promptly
+
+### WIRE FORMAT
+# Every message is a frame: a fixed header followed by a body holding one
+# tagged value.  The header carries a magic number and protocol version
+# (so mismatched peers fail loudly), a flags byte, and the body length.
+#
+# The flags name the lane a frame travels in.  Lanes share the connection
+# but are scheduled by strict priority, and messages larger than
+# FRAGMENT_SIZE are split into fragments (all but the last flagged MORE)
+# so that a bulky message cannot hold up a more urgent lane for long.
+PROTOCOL_MAGIC=0x5079
+PROTOCOL_VERSION=2
+HEADER=struct.Struct('!HBBI')   # magic, version, flags, body length
+HEADER_LEN=HEADER.size
+
+LANE_PACKET=0    # packet-ins and packet-outs
+LANE_CONTROL=1   # topology events, barrier replies, stats requests
+LANE_BULK=2      # flow-mods (and their barriers) and stats replies
+LANES=3
+LANE_MASK=0x03
+FLAG_MORE=0x80
+FRAGMENT_SIZE=16384
+
+INT=struct.Struct('!q')
+FLOAT=struct.Struct('!d')
+LENGTH=struct.Struct('!I')
+INT_MIN=-2**63
+INT_MAX=2**63-1
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode(item,parts):
+    """
+    Appends the tagged encoding of item to parts.
+
+    :param item: the value to encode
+    :type item: None, bool, int, long, float, str, unicode, list, tuple or dict
+    :param parts: the encoded chunks so far
+    :type parts: list str
+    """
+    if item is None:
+        parts.append('N')
+    elif isinstance(item,bool):
+        parts.append('T' if item else 'F')
+    elif isinstance(item,(int,long)):
+        if INT_MIN <= item <= INT_MAX:
+            parts.append('i')
+            parts.append(INT.pack(item))
         else:
-            return item
-    serialized_msg = serialized_msgs.pop(0)
-    jsoned_msg = serialized_msg.rstrip(TERM_CHAR)
-    msg = None
-    while True:
-        try:
-            msg = json.loads(jsoned_msg)  
-            msg = json2python(msg)
-            break
-        except:
-            if len(serialized_msgs) == 0:
-                break
-            next_part = serialized_msgs.pop(0).rstrip(TERM_CHAR)
-            jsoned_msg += next_part
+            digits = str(item)
+            parts.append('L')
+            parts.append(LENGTH.pack(len(digits)))
+            parts.append(digits)
+    elif isinstance(item,str):
+        parts.append('s')
+        parts.append(LENGTH.pack(len(item)))
+        parts.append(item)
+    elif isinstance(item,unicode):
+        encode(item.encode('utf-8'),parts)
+    elif isinstance(item,float):
+        parts.append('d')
+        parts.append(FLOAT.pack(item))
+    elif isinstance(item,(list,tuple)):
+        parts.append('a')
+        parts.append(LENGTH.pack(len(item)))
+        for i in item:
+            encode(i,parts)
+    elif isinstance(item,dict):
+        parts.append('m')
+        parts.append(LENGTH.pack(len(item)))
+        for (k,v) in item.items():
+            encode(k,parts)
+            encode(v,parts)
+    else:
+        raise TypeError('cannot serialize %r' % (item,))
+
+
+def decode(data,offset):
+    """
+    Decodes the tagged value starting at offset.
+
+    :param data: the buffer holding the frame body
+    :type data: str or bytearray
+    :param offset: where the value starts
+    :type offset: int
+    :returns: the value and the offset just past it
+    :rtype: (value, int)
+    """
+    tag = data[offset]
+    if not isinstance(tag,str):
+        tag = chr(tag)
+    offset += 1
+    if tag == 'i':
+        return (INT.unpack_from(data,offset)[0], offset + INT.size)
+    elif tag == 's':
+        (n,) = LENGTH.unpack_from(data,offset)
+        offset += LENGTH.size
+        return (str(data[offset:offset+n]), offset + n)
+    elif tag == 'm':
+        (n,) = LENGTH.unpack_from(data,offset)
+        offset += LENGTH.size
+        d = {}
+        for _ in xrange(n):
+            (k,offset) = decode(data,offset)
+            (d[k],offset) = decode(data,offset)
+        return (d, offset)
+    elif tag == 'a':
+        (n,) = LENGTH.unpack_from(data,offset)
+        offset += LENGTH.size
+        l = []
+        for _ in xrange(n):
+            (v,offset) = decode(data,offset)
+            l.append(v)
+        return (l, offset)
+    elif tag == 'N':
+        return (None, offset)
+    elif tag == 'T':
+        return (True, offset)
+    elif tag == 'F':
+        return (False, offset)
+    elif tag == 'd':
+        return (FLOAT.unpack_from(data,offset)[0], offset + FLOAT.size)
+    elif tag == 'L':
+        (n,) = LENGTH.unpack_from(data,offset)
+        offset += LENGTH.size
+        return (long(str(data[offset:offset+n])), offset + n)
+    else:
+        raise ProtocolError('unknown tag %r' % tag)
+
+
+def serialize(msg,flags=0):
+    """
+    Frames a message for the wire.
+
+    :param msg: the message
+    :type msg: list
+    :param flags: the header flags
+    :type flags: int
+    :rtype: str
+    """
+    parts = ['']
+    encode(to_wire_format(msg),parts)
+    body_len = sum(len(p) for p in parts)
+    parts[0] = HEADER.pack(PROTOCOL_MAGIC,PROTOCOL_VERSION,flags,body_len)
+    return ''.join(parts)
+
+
+def encode_message(msg):
+    """
+    Encodes a message into a frame body.
+
+    :rtype: str
+    """
+    parts = []
+    encode(to_wire_format(msg),parts)
+    return ''.join(parts)
+
+
+def fragment(msg,lane=LANE_CONTROL):
+    """
+    Frames a message for the wire in the given lane, splitting it into
+    fragments of at most FRAGMENT_SIZE body bytes.
+
+    :param msg: the message, or its encoded body
+    :type msg: list or str
+    :param lane: the lane to send in
+    :type lane: int
+    :rtype: list str
+    """
+    if isinstance(msg,str):
+        body = msg
+    else:
+        body = encode_message(msg)
+    if len(body) <= FRAGMENT_SIZE:
+        return [ HEADER.pack(PROTOCOL_MAGIC,PROTOCOL_VERSION,lane,len(body)) + body ]
+    frames = []
+    for i in xrange(0,len(body),FRAGMENT_SIZE):
+        chunk = body[i:i+FRAGMENT_SIZE]
+        flags = lane
+        if i + FRAGMENT_SIZE < len(body):
+            flags |= FLAG_MORE
+        frames.append(HEADER.pack(PROTOCOL_MAGIC,PROTOCOL_VERSION,flags,len(chunk)) + chunk)
+    return frames
+
+
+def parse_header(data,offset=0):
+    """
+    Checks a frame header and returns its flags and body length.
+
+    :rtype: (int, int)
+    """
+    (magic,version,flags,length) = HEADER.unpack_from(data,offset)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError('bad magic number %#x' % magic)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError('unsupported protocol version %d' % version)
+    return (flags,length)
+
+
+def deserialize(data,start=0,end=None):
+    """
+    Decodes the body of a frame into a message, in place.
+
+    :param data: the buffer holding the frame body
+    :type data: str or bytearray
+    :param start: where the body starts
+    :type start: int
+    :param end: where the body ends, by default the end of data
+    :type end: int
+    """
+    if end is None:
+        end = len(data)
+    (msg,offset) = decode(data,start)
+    if offset != end:
+        raise ProtocolError('frame body is %d bytes, message is %d' % 
+                            (end - start, offset - start))
     return msg
 
 
 def dict_to_ascii(d):
     def convert(h,v):
         if (isinstance(v,str) or
-            isinstance(v,int)):
+            isinstance(v,(int,long))):
             return v
+        elif (isinstance(v,dict) or
+              isinstance(v,list)):
+            return to_wire_format(v)
         else:
             return repr(v)
     return { h : convert(h,v) for (h,v) in d.items() }
 
 
-def bytelist2ascii(packet_dict):
-    def convert(h,val):
-        if h in ['srcmac','dstmac','srcip','dstip','raw']:
-            return ''.join([chr(d) for d in val])
-        else:
-            return val
-    return { h : convert(h,val) for (h, val) in packet_dict.items()}
-
-
-def ascii2bytelist(packet_dict):
-    def convert(h,val):
-        if h in ['srcmac','dstmac','srcip','dstip','raw']:
-            return [ord(c) for c in val]
-        else:
-            return val
-    return { h : convert(h,val) for (h, val) in packet_dict.items()}
-
-
-def to_jsonable_format(item):
+def to_wire_format(item):
     if isinstance(item, dict):
-        ascii_item = dict_to_ascii(item)
-        bytelist_item = ascii2bytelist(ascii_item)
-        return bytelist_item
+        return dict_to_ascii(item)
     elif isinstance(item, list):
-        return map(to_jsonable_format,item)
+        return map(to_wire_format,item)
     else:
         return item
+
+
+class MessageChannel(asynchat.async_chat):
+    """
+    An async_chat that exchanges framed messages in priority lanes.
+
+    Incoming bytes are received straight into a preallocated buffer and
+    frames are decoded where they lie; the buffer is only compacted when
+    its tail runs out, and only grown for frames larger than it.
+    Fragments are reassembled per lane.  Each complete message is handed
+    to handle_message.
+
+    Outgoing messages are queued per lane with send_message, from any
+    thread, and whenever the socket is writable the next fragment of the
+    highest-priority non-empty lane is sent.  Once more than
+    out_high_watermark bytes are waiting in a lane, droppable messages for
+    it are discarded and other senders block until it has drained below
+    out_low_watermark.
+
+    If a shared-memory transport has been negotiated (see shm.py), it
+    carries every message, in the same lane, and once its poller runs
+    messages still received over the socket are posted to it, so that
+    handle_message is only ever called from one thread at a time.
+    """
+    in_buffer_size = 4096 * 16
+    out_high_watermark = 4 * 1024 * 1024
+    out_low_watermark = 1024 * 1024
+    out_wait_timeout = 1.0
+    out_fragments_per_write = 16
+
+    def __init__(self, sock=None):
+        self.in_buffer = bytearray(self.in_buffer_size)
+        self.in_start = 0    # first unparsed byte
+        self.in_end = 0      # one past the last received byte
+        self.in_partial = [None] * LANES
+        self.out_cv = threading.Condition()
+        self.out_lanes = [ deque() for _ in range(LANES) ]
+        self.out_bytes = [0] * LANES   # queued but not yet sent, per lane
+        self.out_current = None        # (lane, fragment, bytes sent)
+        self.out_dropped = 0
+        self.out_closed = False
+        self.shm = None
+        asynchat.async_chat.__init__(self, sock)
+
+    def send_message(self, msg, lane=LANE_CONTROL, droppable=False):
+        """
+        Queues a message for sending, applying backpressure.
+
+        :param msg: the message
+        :type msg: list
+        :param lane: the lane to send in
+        :type lane: int
+        :param droppable: whether the message may be dropped under load
+        :type droppable: bool
+        :returns: whether the message was queued
+        :rtype: bool
+        """
+        body = encode_message(msg)
+        shm = self.shm
+        if not shm is None:
+            queued = shm.send_body(body,lane,droppable)
+            if not queued is None:
+                return queued
+        frames = fragment(body,lane)
+        with self.out_cv:
+            if self.out_bytes[lane] >= self.out_high_watermark:
+                if droppable:
+                    self.out_dropped += 1
+                    return False
+                while (self.out_bytes[lane] > self.out_low_watermark and
+                       not self.out_closed):
+                    self.out_cv.wait(self.out_wait_timeout)
+            if self.out_closed:
+                return False
+            self.out_lanes[lane].extend(frames)
+            self.out_bytes[lane] += sum(len(f) for f in frames)
+            self.initiate_send()
+        return True
+
+    def writable(self):
+        return (not self.out_current is None or any(self.out_lanes) or
+                not self.connected)
+
+    def initiate_send(self):
+        # send_message may run on any thread, so serialize with the I/O thread
+        with self.out_cv:
+            for _ in xrange(self.out_fragments_per_write):
+                if not self.connected:
+                    return
+                if self.out_current is None:
+                    for lane in xrange(LANES):
+                        if self.out_lanes[lane]:
+                            self.out_current = (lane,self.out_lanes[lane].popleft(),0)
+                            break
+                    else:
+                        return
+                (lane,frame,sent) = self.out_current
+                try:
+                    n = self.send(buffer(frame,sent))
+                except socket.error:
+                    self.handle_error()
+                    return
+                if not n:
+                    return
+                sent += n
+                self.out_bytes[lane] -= n
+                if self.out_bytes[lane] <= self.out_low_watermark:
+                    self.out_cv.notify_all()
+                if sent < len(frame):
+                    self.out_current = (lane,frame,sent)
+                    return
+                self.out_current = None
+
+    def handle_close(self):
+        with self.out_cv:
+            self.out_closed = True
+            self.out_cv.notify_all()
+        if not self.shm is None:
+            self.shm.close()
+            self.shm = None
+        self.close()
+
+    def make_room(self, needed):
+        """
+        Ensures the buffer can hold needed more bytes past the unparsed
+        ones, moving those to the front or growing the buffer.
+        """
+        unparsed = self.in_end - self.in_start
+        if unparsed + needed > len(self.in_buffer):
+            size = len(self.in_buffer)
+            while size < unparsed + needed:
+                size *= 2
+            grown = bytearray(size)
+            grown[:unparsed] = self.in_buffer[self.in_start:self.in_end]
+            self.in_buffer = grown
+        elif self.in_start > 0:
+            self.in_buffer[:unparsed] = self.in_buffer[self.in_start:self.in_end]
+        self.in_start = 0
+        self.in_end = unparsed
+
+    def handle_read(self):
+        if self.in_end == len(self.in_buffer):
+            self.make_room(self.in_buffer_size)
+        try:
+            n = self.socket.recv_into(memoryview(self.in_buffer)[self.in_end:])
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            elif why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if n == 0:
+            self.handle_close()
+            return
+        self.in_end += n
+        try:
+            self.parse_frames()
+        except (ProtocolError, struct.error, IndexError, ValueError), e:
+            print "ERROR: dropping connection, %s" % e
+            self.handle_close()
+
+    def parse_frames(self):
+        """
+        Decodes and handles every complete frame in the buffer.
+        """
+        buf = self.in_buffer
+        while self.in_end - self.in_start >= HEADER_LEN:
+            (flags,length) = parse_header(buf,self.in_start)
+            body_start = self.in_start + HEADER_LEN
+            body_end = body_start + length
+            if body_end > self.in_end:
+                if body_end - self.in_start > len(buf):
+                    self.make_room(HEADER_LEN + length - 
+                                   (self.in_end - self.in_start))
+                break
+            lane = flags & LANE_MASK
+            if lane >= LANES:
+                raise ProtocolError('unknown lane %d' % lane)
+            partial = self.in_partial[lane]
+            if flags & FLAG_MORE or not partial is None:
+                if partial is None:
+                    partial = self.in_partial[lane] = bytearray()
+                partial += buf[body_start:body_end]
+                self.in_start = body_end
+                if flags & FLAG_MORE:
+                    continue
+                self.in_partial[lane] = None
+                msg = deserialize(partial)
+            else:
+                msg = deserialize(buf,body_start,body_end)
+                self.in_start = body_end
+            self.deliver(msg)
+        if self.in_start == self.in_end:
+            self.in_start = self.in_end = 0
+
+    def deliver(self, msg):
+        """
+        Hands a message received over the socket to handle_message, on
+        the shared-memory poller's thread once there is one.
+        """
+        shm = self.shm
+        if not shm is None and shm.started():
+            shm.post(msg)
+        else:
+            self.handle_message(msg)
+
+    def handle_message(self, msg):
+        raise NotImplementedError
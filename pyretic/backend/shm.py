@@ -0,0 +1,369 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+################################################################################
+
+"""
+Shared-memory transport between the runtime and an OF client on the same
+host.  Each lane of comm.py has, in each direction, its own
+single-producer/single-consumer ring buffer in an mmap'ed file, so that
+a busy lane cannot hold up a more urgent one; records hold message
+bodies in the wire encoding of comm.py, split into several records when
+too large for one.  The OF client creates the rings and offers them over
+the TCP channel, which carries the handshake.  Once a side reads its
+rings, every message it receives is handed over by the polling thread.
+"""
+
+import ctypes
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from collections import deque
+
+from pyretic.backend.comm import deserialize, LANES
+
+RING_MAGIC = 0x50797269
+RING_CAPACITY = 4 * 1024 * 1024
+# The control block keeps the producer's and the consumer's index on
+# separate cache lines.  Indices count bytes ever written/read, so the
+# ring is empty when they are equal.  They are accessed through ctypes,
+# as single aligned 64-bit loads and stores, so the other side never sees
+# one half-updated (struct.pack_into clears its target before writing).
+CONTROL = struct.Struct('<II')  # magic, capacity
+HEAD_OFFSET = 64
+TAIL_OFFSET = 128
+DATA_OFFSET = 192
+RECORD = struct.Struct('<II')   # body length, flags
+RECORD_ALIGN = 8
+RECORD_MORE = 0x1               # flags a record continued by the next one
+WRAP = 0xffffffff               # record length marking a jump back to the start
+
+SPIN_POLLS = 1000               # empty polls before the reader starts sleeping
+MAX_POLL_SLEEP = 0.001          # seconds
+
+
+class Ring(object):
+    """
+    A single-producer/single-consumer ring of variable-length records in a
+    memory-mapped file.
+
+    :param path: the file backing the ring
+    :type path: string
+    :param capacity: the data size, when creating the ring
+    :type capacity: int
+    """
+    def __init__(self, path, capacity=None):
+        self.path = path
+        create = not capacity is None
+        if not create:
+            f = open(path, 'r+b')
+            (magic,capacity) = CONTROL.unpack(f.read(CONTROL.size))
+            if magic != RING_MAGIC:
+                f.close()
+                raise ValueError('%s is not a ring' % path)
+        else:
+            f = open(path, 'w+b')
+            f.truncate(DATA_OFFSET + capacity)
+        self.capacity = capacity
+        self.mem = mmap.mmap(f.fileno(), DATA_OFFSET + capacity)
+        f.close()
+        if create:
+            CONTROL.pack_into(self.mem, 0, RING_MAGIC, capacity)
+        self.head_index = ctypes.c_uint64.from_buffer(self.mem, HEAD_OFFSET)
+        self.tail_index = ctypes.c_uint64.from_buffer(self.mem, TAIL_OFFSET)
+        self.max_record = capacity / 4
+
+    def head(self):
+        return self.head_index.value
+
+    def tail(self):
+        return self.tail_index.value
+
+    def free(self):
+        return self.capacity - (self.head() - self.tail())
+
+    def write(self, body, flags=0):
+        """
+        Appends a record, if there is room for it.
+
+        :param body: the record body, at most max_record bytes
+        :type body: str
+        :param flags: the record flags
+        :type flags: int
+        :returns: whether the record was written
+        :rtype: bool
+        """
+        size = RECORD.size + len(body)
+        size += -size % RECORD_ALIGN
+        head = self.head()
+        pos = head % self.capacity
+        skip = 0
+        if pos + size > self.capacity:
+            skip = self.capacity - pos
+        if head + skip + size - self.tail() > self.capacity:
+            return False
+        if skip:
+            RECORD.pack_into(self.mem, DATA_OFFSET + pos, WRAP, 0)
+            pos = 0
+        start = DATA_OFFSET + pos
+        RECORD.pack_into(self.mem, start, len(body), flags)
+        self.mem[start + RECORD.size:start + RECORD.size + len(body)] = body
+        # publish only once the record is in place
+        self.head_index.value = head + skip + size
+        return True
+
+    def read_record(self):
+        """
+        Removes and returns the oldest record and its flags, if any.
+
+        :rtype: (str, int) or None
+        """
+        tail = self.tail()
+        if tail == self.head():
+            return None
+        pos = tail % self.capacity
+        (length,flags) = RECORD.unpack_from(self.mem, DATA_OFFSET + pos)
+        if length == WRAP:
+            tail += self.capacity - pos
+            pos = 0
+            (length,flags) = RECORD.unpack_from(self.mem, DATA_OFFSET)
+        start = DATA_OFFSET + pos + RECORD.size
+        body = self.mem[start:start + length]
+        size = RECORD.size + length
+        size += -size % RECORD_ALIGN
+        self.tail_index.value = tail + size
+        return (body,flags)
+
+    def read(self):
+        """
+        Removes and returns the oldest record, if any.
+
+        :rtype: str or None
+        """
+        record = self.read_record()
+        if record is None:
+            return None
+        return record[0]
+
+    def close(self):
+        del self.head_index, self.tail_index
+        self.mem.close()
+
+
+def ring_path(name):
+    """
+    Returns a fresh file for a ring, in /dev/shm when available.
+    """
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    (fd,path) = tempfile.mkstemp(prefix='pyretic-%s-' % name, dir=shm_dir)
+    os.close(fd)
+    return path
+
+
+class ShmTransport(object):
+    """
+    A ring per lane in each direction, with a thread that polls the read
+    rings, most urgent lane first, and hands each message to handler.
+    The poller spins for a while after each message, so that latency
+    stays in the microseconds under load, and backs off to short sleeps
+    when idle.  Messages that still arrive by TCP once it runs are posted
+    to it, so that the handler is only ever called from one thread.
+
+    :param tx_paths: the rings to write, one per lane
+    :type tx_paths: list string
+    :param rx_paths: the rings to read, one per lane
+    :type rx_paths: list string
+    :param handler: called with each message received
+    :type handler: function
+    :param capacity: the data size of each ring, when creating them
+    :type capacity: int
+    """
+    def __init__(self, tx_paths, rx_paths, handler, capacity=None):
+        if len(tx_paths) != LANES or len(rx_paths) != LANES:
+            raise ValueError('expected %d rings each way' % LANES)
+        self.tx = []
+        self.rx = []
+        try:
+            for path in tx_paths:
+                self.tx.append(Ring(path, capacity))
+            for path in rx_paths:
+                self.rx.append(Ring(path, capacity))
+        except:
+            for ring in self.tx + self.rx:
+                ring.close()
+            raise
+        self.handler = handler
+        self.tx_locks = [ threading.Lock() for _ in range(LANES) ]
+        self.rx_partial = [None] * LANES
+        self.inbox = deque()
+        self.closed = False
+        self.dropped = 0
+        self.poller = None
+
+    @classmethod
+    def create(cls, handler, capacity=RING_CAPACITY):
+        """
+        Creates a fresh set of rings.
+        """
+        return cls([ ring_path('tx') for _ in range(LANES) ],
+                   [ ring_path('rx') for _ in range(LANES) ],
+                   handler, capacity)
+
+    def tx_paths(self):
+        return [ ring.path for ring in self.tx ]
+
+    def rx_paths(self):
+        return [ ring.path for ring in self.rx ]
+
+    def start(self):
+        self.poller = threading.Thread(target=self.poll)
+        self.poller.daemon = True
+        self.poller.start()
+
+    def started(self):
+        return not self.poller is None
+
+    def unlink(self):
+        """
+        Removes the ring files; the mappings stay valid.
+        """
+        for path in self.tx_paths() + self.rx_paths():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def post(self, msg):
+        """
+        Queues a message received some other way for the poller to
+        deliver.
+        """
+        self.inbox.append(msg)
+
+    def send_body(self, body, lane, droppable=False):
+        """
+        Writes an encoded message to the lane's ring, in several records
+        if it is larger than one may be, waiting for room unless it is
+        droppable.  Only messages sent after the transport closed are
+        left to TCP.
+
+        :returns: whether the message was queued, or None if it must go
+            over TCP instead
+        :rtype: bool or None
+        """
+        if self.closed:
+            return None
+        ring = self.tx[lane]
+        with self.tx_locks[lane]:
+            step = ring.max_record
+            # ONCE PART OF A MESSAGE IS IN THE RING, THE REST MUST FOLLOW, SO
+            # ONLY DROP ONE SPLIT OVER RECORDS BEFORE WRITING ANY OF IT.
+            # TWICE ITS SIZE COVERS THE RECORD HEADERS AND WRAPPING.
+            if (droppable and len(body) > step and
+                ring.free() < 2 * (len(body) + RECORD.size * (len(body) / step + 1))):
+                self.dropped += 1
+                return False
+            offset = 0
+            while True:
+                chunk = body[offset:offset + step]
+                offset += step
+                flags = RECORD_MORE if offset < len(body) else 0
+                if not ring.write(chunk, flags):
+                    if droppable and offset == step and not flags:
+                        self.dropped += 1
+                        return False
+                    sleep = 0.00001
+                    while not ring.write(chunk, flags):
+                        if self.closed:
+                            return None
+                        time.sleep(sleep)
+                        sleep = min(sleep * 2, MAX_POLL_SLEEP)
+                if not flags:
+                    return True
+
+    def receive(self):
+        """
+        Returns the next complete message body from the most urgent lane
+        that has one, if any.
+
+        :rtype: str or None
+        """
+        for lane in xrange(LANES):
+            ring = self.rx[lane]
+            while True:
+                record = ring.read_record()
+                if record is None:
+                    break
+                (body,flags) = record
+                partial = self.rx_partial[lane]
+                if flags & RECORD_MORE:
+                    if partial is None:
+                        self.rx_partial[lane] = [body]
+                    else:
+                        partial.append(body)
+                    continue
+                if not partial is None:
+                    partial.append(body)
+                    self.rx_partial[lane] = None
+                    body = ''.join(partial)
+                return body
+        return None
+
+    def poll(self):
+        idle = 0
+        sleep = 0.00001
+        while not self.closed:
+            if self.inbox:
+                self.handler(self.inbox.popleft())
+                continue
+            body = self.receive()
+            if body is None:
+                idle += 1
+                if idle > SPIN_POLLS:
+                    time.sleep(sleep)
+                    sleep = min(sleep * 2, MAX_POLL_SLEEP)
+                continue
+            idle = 0
+            sleep = 0.00001
+            try:
+                msg = deserialize(body)
+            except Exception, e:
+                print "ERROR: dropping shared memory record, %s" % e
+                continue
+            self.handler(msg)
+
+    def close(self):
+        self.closed = True
+        if (not self.poller is None and 
+            not self.poller is threading.current_thread()):
+            self.poller.join()
+        for ring in self.tx + self.rx:
+            ring.close()
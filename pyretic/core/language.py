@@ -49,7 +49,11 @@ tagging_headers = ["vlan_id", "vlan_pcp"]
 native_headers = basic_headers + tagging_headers
 location_headers = ["switch", "inport", "outport"]
 compilable_headers = native_headers + location_headers
-content_headers = [ "raw", "header_len", "payload_len"]
+content_headers = [ "raw", "header_len", "payload_len", "buffer_id"]
+# SET BY THE CONTROLLER FOR QUERIES, NEVER SENT TO THE NETWORK
+metadata_headers = ["sample_rate"]
+# NATIVE HEADERS THAT A SWITCH CAN REWRITE ON A PACKET IT HAS BUFFERED
+rewritable_headers = ["srcmac", "dstmac", "srcip", "dstip"] + tagging_headers
 
 ################################################################################
 # Policy Language                                                              #
@@ -495,7 +499,25 @@ class FwdBucket(Query):
     """
     Class for registering callbacks on individual packets sent to
     the controller.
+
+    :param payload: whether the callbacks need packet payloads; pass
+        False when they only read headers, so that switches may send
+        just those
+    :type payload: bool
     """
+    def __init__(self, payload=True):
+        self.payload = payload
+        super(FwdBucket,self).__init__()
+
+    def needs_payload(self):
+        """
+        Whether packets must reach this bucket with their payloads,
+        rather than just their headers.
+
+        :rtype: bool
+        """
+        return self.payload
+
     def compile(self):
         """Produce a Classifier for this policy
 
@@ -523,17 +545,40 @@ class FwdBucket(Query):
 class CountBucket(Query):
     """
     Class for registering callbacks on counts of packets sent to
-    the controller.
+    the controller.  Switch counters are tracked per table entry, and
+    each poll adds only what they gained since the last, so that counts
+    carry across entries being reinstalled.  Besides the cumulative
+    counts, callbacks can subscribe to the counts gained since the last
+    report (register_delta_callback) or the rate at which they were
+    gained (register_rate_callback).
+
+    :param interval: if given, the runtime polls this bucket's counts every
+      interval seconds, alongside any other buckets due at the same time
+    :type interval: float
     """
-    def __init__(self):
+    def __init__(self, interval=None):
         super(CountBucket, self).__init__()
+        self.interval = interval
         self.matches = set([])
+        self.cookies = {}
+        self.retired_cookies = {}
+        self.entries_counted = set()
         self.runtime_stats_query_fun = None
         self.outstanding_switches = []
+        self.entry_counts = {}
+        self.switch_counts = {}
+        self.round_counts = {}
+        self.aggregated = set()
+        self.removed_counts = {}
+        self.switch_packet_count = 0
+        self.switch_byte_count = 0
         self.packet_count = 0
         self.byte_count = 0
         self.packet_count_persistent = 0
         self.byte_count_persistent = 0
+        self.last_report = None
+        self.delta_callbacks = []
+        self.rate_callbacks = []
         self.in_update_cv = Condition()
         self.in_update = False
         
@@ -542,12 +587,15 @@ class CountBucket(Query):
 
     def eval(self, pkt):
         """
-        evaluate this policy on a single packet
+        evaluate this policy on a single packet, recording it to be
+        counted when the bucket is applied
 
         :param pkt: the packet on which to be evaluated
         :type pkt: Packet
         :rtype: set Packet
         """
+        with self.bucket_lock:
+            self.bucket.add(pkt)
         return set()
 
     def compile(self):
@@ -566,6 +614,14 @@ class CountBucket(Query):
                 self.byte_count_persistent += pkt['header_len'] + pkt['payload_len']
             self.bucket.clear()
 
+    def discard(self):
+        """
+        Drop the packets recorded since the bucket was last applied,
+        which the switch has already counted.
+        """
+        with self.bucket_lock:
+            self.bucket.clear()
+
     def start_update(self):
         """
         Use a condition variable to mediate access to bucket state as it is
@@ -591,6 +647,8 @@ class CountBucket(Query):
         with self.in_update_cv:
             self.in_update = True
             self.matches = set([])
+            self.retired_cookies = self.cookies
+            self.cookies = {}
             self.runtime_stats_query_fun = None
             self.outstanding_switches = []
 
@@ -607,6 +665,13 @@ class CountBucket(Query):
         if not m in self.matches:
             self.matches.add(m)
 
+    def add_cookie(self, cookie):
+        """
+        Add the cookie of a classifier rule whose counts go into this
+        bucket, once for each time the rule counts its packets here.
+        """
+        self.cookies[cookie] = self.cookies.get(cookie,0) + 1
+
     def add_pull_stats(self, fun):
         """
         Point to function that issues stats queries in the
@@ -615,59 +680,229 @@ class CountBucket(Query):
         if not self.runtime_stats_query_fun:
             self.runtime_stats_query_fun = fun
 
-    def pull_stats(self):
-        """Issue stats queries from the runtime"""
+    def register_delta_callback(self, fn):
+        """
+        Register fn to be called with the [packet_count, byte_count]
+        gained since the previous report.
+        """
+        self.delta_callbacks.append(fn)
+
+    def register_rate_callback(self, fn):
+        """
+        Register fn to be called with the [packets, bytes] per second
+        gained since the previous report.
+        """
+        self.rate_callbacks.append(fn)
+
+    def pull_stats(self, stats_round=None):
+        """
+        Issue stats queries from the runtime
+
+        :param stats_round: if given, the per-switch requests of a
+          scheduled polling round to add this bucket's queries to, rather
+          than sending them right away
+        :type stats_round: dict
+        """
         queries_issued = False
         with self.in_update_cv:
             while self.in_update: # ensure buckets not updated concurrently
                 self.in_update_cv.wait()
             if not self.runtime_stats_query_fun is None:
                 self.outstanding_switches = []
+                self.entries_counted = set()
+                self.round_counts = {}
                 queries_issued = True
-                self.runtime_stats_query_fun()
+                self.runtime_stats_query_fun(stats_round)
         # If no queries were issued, then no matches, so just call userland
         # registered callback routines
         if not queries_issued:
-            self.packet_count = self.packet_count_persistent
-            self.byte_count = self.byte_count_persistent
-            for f in self.callbacks:
-                f([self.packet_count, self.byte_count])
+            self.report()
+
+    def report(self):
+        """
+        Call the userland registered callbacks with the counts so far,
+        the counts gained since the last report, and their rate.
+        """
+        now = time.time()
+        self.packet_count = self.packet_count_persistent + self.switch_packet_count
+        self.byte_count = self.byte_count_persistent + self.switch_byte_count
+        counts = [self.packet_count, self.byte_count]
+        for f in self.callbacks:
+            f(counts)
+        if self.last_report is None:
+            (last_counts,elapsed) = ([0, 0], None)
+        else:
+            (last_counts,last_time) = self.last_report
+            elapsed = now - last_time
+        delta = [counts[0] - last_counts[0], counts[1] - last_counts[1]]
+        for f in self.delta_callbacks:
+            f(delta)
+        if elapsed:
+            for f in self.rate_callbacks:
+                f([delta[0] / elapsed, delta[1] / elapsed])
+        self.last_report = (counts,now)
+
+    def add_switch_counts(self, packets, bytes):
+        self.switch_packet_count += packets
+        self.switch_byte_count += bytes
+
+    def forget_entries(self, switch, keep=set()):
+        """Drop the counters of entries on switch not in keep."""
+        for key in self.entry_counts.keys():
+            if key[0] == switch and not key in keep:
+                del self.entry_counts[key]
 
     def add_outstanding_switch_query(self,switch):
+        """
+        Record a stats request issued to switch, which may be one of
+        several to the same switch.
+        """
         self.outstanding_switches.append(switch)
 
     def handle_flow_stats_reply(self,switch,flow_stats):
         """
         Given a flow_stats_reply from switch s, collect only those
-        counts which are relevant to this bucket.
-
-        Very simple processing for now: just collect all packet and
-        byte counts from rules that have a match that is in the set of
-        matches this bucket is interested in.
+        counts which are relevant to this bucket: those of the table
+        entries whose cookie this bucket indexes, weighted by how many
+        times their rule counts into this bucket.  Each entry adds what
+        its counters gained since they were last read, or all of them if
+        they went backwards, i.e., the entry was reinstalled.  An entry
+        reported in the replies to several of this round's requests is
+        counted once.
         """
-        def stat_in_bucket(flow_stat, s):
-            table_match = match(f['match']).intersect(match(switch=s))
-            network_match = match(f['match'])
-            if table_match in self.matches or network_match in self.matches:
-                return True
-            return False
-
         with self.in_update_cv:
             while self.in_update:
                 self.in_update_cv.wait()
-            self.packet_count = self.packet_count_persistent
-            self.byte_count = self.byte_count_persistent
+            if not switch in self.outstanding_switches:
+                return
+            # LAST READ OF THE SWITCH WAS AN AGGREGATE, SO ITS ENTRIES
+            # HAVE NO BASELINES. RECONCILE AGAINST THE AGGREGATE INSTEAD
+            rebase = switch in self.aggregated
+            seen = self.round_counts.setdefault(switch, [0, 0])
+            for f in flow_stats:
+                cookie = f.get('cookie')
+                weight = self.cookies.get(cookie)
+                if not weight:
+                    continue
+                key = (switch, cookie, frozenset(f.get('match',{}).items()))
+                if key in self.entries_counted:
+                    continue
+                self.entries_counted.add(key)
+                counts = (f['packet_count'], f['byte_count'])
+                last = self.entry_counts.get(key)
+                self.entry_counts[key] = counts
+                seen[0] += weight * counts[0]
+                seen[1] += weight * counts[1]
+                if rebase:
+                    continue
+                if last is None or counts[0] < last[0] or counts[1] < last[1]:
+                    last = (0, 0)
+                self.add_switch_counts(weight * (counts[0] - last[0]),
+                                       weight * (counts[1] - last[1]))
+            if rebase:
+                self.aggregated.discard(switch)
+                self.settle_switch(switch, seen)
+            self.switch_counts[switch] = list(seen)
+            self.outstanding_switches.remove(switch)
             if switch in self.outstanding_switches:
-                for f in flow_stats:
-                    if 'match' in f:
-                        if stat_in_bucket(f, switch):
-                            self.packet_count += f['packet_count']
-                            self.byte_count   += f['byte_count']
-                self.outstanding_switches.remove(switch)
+                return
+            # ENTRIES MISSING FROM A COMPLETE READ OF THE SWITCH ARE GONE
+            self.forget_entries(switch, self.entries_counted)
         # If have all necessary data, call user-land registered callbacks
         if not self.outstanding_switches:
-            for f in self.callbacks:
-                f([self.packet_count, self.byte_count])
+            self.report()
+
+    def handle_aggregate_stats_reply(self,switch,aggregate_stats):
+        """
+        Given an aggregate_stats_reply from switch s, over table entries
+        that all count once into this bucket, collect what their total
+        gained since the switch was last read, including the final counts
+        of entries removed in the meantime.
+        """
+        with self.in_update_cv:
+            while self.in_update:
+                self.in_update_cv.wait()
+            if not switch in self.outstanding_switches:
+                return
+            total = [aggregate_stats['packet_count'], aggregate_stats['byte_count']]
+            self.settle_switch(switch, total)
+            self.switch_counts[switch] = total
+            self.aggregated.add(switch)
+            self.forget_entries(switch)
+            self.outstanding_switches.remove(switch)
+        if not self.outstanding_switches:
+            self.report()
+
+    def settle_switch(self,switch,total):
+        """
+        Collect what the total of switch's entries gained since the
+        switch was last read, plus the final counts of entries removed in
+        the meantime.  If the total fell by more than those account for,
+        the final counts of some removed entries are still to come, so
+        the shortfall is carried over to be made up by them.
+        """
+        (removed_packets,removed_bytes) = self.removed_counts.pop(switch, [0, 0])
+        (last_packets,last_bytes) = self.switch_counts.get(switch, [0, 0])
+        delta = [total[0] + removed_packets - last_packets,
+                 total[1] + removed_bytes - last_bytes]
+        if delta[0] < 0 or delta[1] < 0:
+            self.removed_counts[switch] = [min(0, delta[0]), min(0, delta[1])]
+        self.add_switch_counts(max(0, delta[0]), max(0, delta[1]))
+
+    def forget_switch(self,switch):
+        """Forget the counters read from switch, which has reconnected."""
+        with self.in_update_cv:
+            self.switch_counts.pop(switch, None)
+            self.removed_counts.pop(switch, None)
+            self.aggregated.discard(switch)
+            self.forget_entries(switch)
+
+    def handle_flow_removed(self,switch,flow_stat):
+        """
+        Given the final counts of a table entry removed from switch s,
+        collect what they gained since the entry was last read.
+        """
+        with self.in_update_cv:
+            cookie = flow_stat.get('cookie')
+            weight = self.cookies.get(cookie) or self.retired_cookies.get(cookie)
+            if not weight:
+                return
+            key = (switch, cookie, frozenset(flow_stat.get('match',{}).items()))
+            last = self.entry_counts.pop(key, None)
+            final = (flow_stat['packet_count'], flow_stat['byte_count'])
+            if switch in self.aggregated or (last is None and switch in self.removed_counts):
+                # SETTLED AT THE NEXT AGGREGATE READ OF THE SWITCH, OR
+                # AGAINST THE SHORTFALL THAT READ LEFT
+                removed = self.removed_counts.setdefault(switch, [0, 0])
+                removed[0] += weight * final[0]
+                removed[1] += weight * final[1]
+                if switch in self.aggregated or removed[0] < 0 or removed[1] < 0:
+                    return
+                del self.removed_counts[switch]
+                self.add_switch_counts(*removed)
+                return
+            if last is None or final[0] < last[0] or final[1] < last[1]:
+                last = (0, 0)
+            else:
+                counts = self.switch_counts.get(switch)
+                if counts:
+                    counts[0] -= weight * last[0]
+                    counts[1] -= weight * last[1]
+            self.add_switch_counts(weight * (final[0] - last[0]),
+                                   weight * (final[1] - last[1]))
+
+    def handle_stats_timeout(self,switch):
+        """
+        Give up on a stats request to switch that went unanswered,
+        reporting the counts collected so far once nothing else is
+        outstanding.
+        """
+        with self.in_update_cv:
+            if not switch in self.outstanding_switches:
+                return
+            self.outstanding_switches.remove(switch)
+        if not self.outstanding_switches:
+            self.report()
 
     def __eq__(self, other):
         # TODO: if buckets eventually have names, equality should
@@ -1195,12 +1430,42 @@ def ast_fold(fun, acc, policy):
     else:
         raise NotImplementedError
     
+def snapshot(policy):
+    """
+    Returns a policy that compiles and evaluates as policy does now, with
+    each derived policy (so each dynamic policy) replaced by the policy
+    it currently derives from, so that it is unaffected by dynamic
+    policies changing meanwhile.  Derived policies that evaluate packets
+    their own way (e.g., sampling at the controller) are kept as they are.
+
+    :param policy: the policy to snapshot
+    :type policy: Policy
+    :rtype: Policy
+    """
+    if isinstance(policy,CombinatorPolicy):
+        return type(policy)(map(snapshot,policy.policies))
+    elif (isinstance(policy,DerivedPolicy) and
+          type(policy).compile.im_func is DerivedPolicy.compile.im_func and
+          type(policy).eval.im_func in [DerivedPolicy.eval.im_func,if_.eval.im_func]):
+        return snapshot(policy.policy)
+    else:
+        return policy
+
 def add_dynamic_sub_pols(acc, policy):
     if isinstance(policy,DynamicPolicy):
         return acc | {policy}
     else:
         return acc
 
+def needs_payload(acc, policy):
+    if isinstance(policy,FwdBucket):
+        return acc or policy.needs_payload()
+    elif isinstance(policy,modify):
+        return acc or any(h in policy.map for h in native_headers + content_headers
+                          if not h in rewritable_headers)
+    else:
+        return acc
+
 def add_query_sub_pols(acc, policy):
     from pyretic.lib.query import packets
     if ( isinstance(policy,Query) or
@@ -1254,10 +1519,12 @@ class Rule(object):
     """
 
     # Matches m should be of the match class.  Actions acts should be a list of
-    # either modify, identity, or drop policies.
-    def __init__(self,m,acts):
+    # either modify, identity, or drop policies.  The cookie, if any, tags
+    # the switch table entries installed for the rule.
+    def __init__(self,m,acts,cookie=0):
         self.match = m
         self.actions = acts
+        self.cookie = cookie
 
     def __str__(self):
         return str(self.match) + '\n  -> ' + str(self.actions)
@@ -31,11 +31,19 @@
 import pyretic.core.util as util
 from pyretic.core.language import *
 from pyretic.core.network import *
-from multiprocessing import Process, Manager, RLock, Lock, Value, Queue, Condition
-import logging, sys, time
+from multiprocessing import Process, Manager, RLock, Lock, Value, Condition
+import logging, sys, time, threading, Queue
 from datetime import datetime
 
 TABLE_MISS_PRIORITY = 0
+INSTALL_WINDOW = 1024         # flow-mods sent per switch between barriers
+INSTALL_WINDOWS_IN_FLIGHT = 2 # unacknowledged windows allowed per switch
+BARRIER_TIMEOUT = 5.0         # seconds to wait for a barrier reply
+BARRIER_XID_BASE = 0x80000000 # keep clear of the xids POX allocates itself
+STATS_XID_BASE = 0x40000000   # stats request xids run up to BARRIER_XID_BASE
+STATS_REPLY_TIMEOUT = 5.0     # seconds to wait for a stats reply
+PACKET_IN_FULL_LENGTH = 0xffff # send the controller whole packets
+PACKET_IN_HEADER_LENGTH = 128  # enough for ethernet, vlan, ip and transport headers
 
 class Runtime(object):
     """
@@ -70,14 +78,45 @@ class Runtime(object):
         self.extended_values_lock = RLock()
         self.dynamic_sub_pols = set()
         self.update_dynamic_sub_pols()
+        self.packet_in_length = None
+        self.update_packet_in_length()
         self.in_update_network = False
         self.global_outstanding_queries_lock = Lock()
         self.global_outstanding_queries = {}
-        self.manager = Manager()
+        self.stats_xid = STATS_XID_BASE
+        self.stats_cv = threading.Condition()
+        self.stats_thread = None
+        self.polled_buckets = {}
+        self.stats_due = {}
+        self.update_polled_buckets()
         self.old_rules_lock = Lock()
-        self.old_rules = self.manager.list()
+        self.old_rules = {}
+        self.switch_fingerprints = {}
+        self.switch_epochs = {}
+        self.rule_cookies = {}
+        self.next_cookie = 1
+        self.cookie_buckets = {}
+        self.retired_cookie_buckets = {}
         self.update_rules_lock = Lock()
         self.update_buckets_lock = Lock()
+        self.classifier = None
+        self.compiled_policy = None
+        self.bucket_rules = None
+        self.classifier_version = 0
+        self.policy_version = 0
+        self.compiled_version = 0
+        self.compile_cv = threading.Condition()
+        self.barrier_lock = threading.Lock()
+        self.barrier_xid = BARRIER_XID_BASE
+        self.outstanding_barriers = {}
+        self.switch_commit_times = {}
+        self.install_queues_lock = threading.Lock()
+        self.install_queues = {}
+        self.install_progress = {}
+        if self.mode == 'proactive0' or self.mode == 'proactive1':
+            self.compile_thread = threading.Thread(target=self.compile_loop)
+            self.compile_thread.daemon = True
+            self.compile_thread.start()
 
     def verbosity_numeric(self,verbosity_option):
         numeric_map = { 'low': 1,
@@ -98,28 +137,75 @@ class Runtime(object):
         :param concrete_packet: the packet to be interpreted.
         :type limit: payload of an OpenFlow packet_in message.
         """
+        # EVALUATE THE POLICY THE INSTALLED CLASSIFIER WAS COMPILED FROM,
+        # SO THAT THE PACKET IS HANDLED AS THE SWITCH RULES EXPECT
+        with self.switch_lock:
+            compiled_policy = self.compiled_policy
+            bucket_rules = self.bucket_rules
+
         with self.policy_lock:
+            policy = self.policy if compiled_policy is None else compiled_policy
             pyretic_pkt = self.concrete2pyretic(concrete_pkt)
 
             # find the queries, if any in the policy, that will be evaluated
-            queries,pkts = queries_in_eval((set(),{pyretic_pkt}),self.policy)
+            queries,pkts = queries_in_eval((set(),{pyretic_pkt}),policy)
 
             # evaluate the policy
-            output = self.policy.eval(pyretic_pkt)
+            output = policy.eval(pyretic_pkt)
 
-            # apply the queries whose buckets have received new packets
+            # apply the queries whose buckets have received new packets,
+            # except for counts the switch already took
+            switch_counted = self.switch_counted_buckets(pyretic_pkt,queries,
+                                                         bucket_rules)
             for q in queries:
-                q.apply()
+                if id(q) in switch_counted:
+                    q.discard()
+                else:
+                    q.apply()
 
         # send output of evaluation into the network
         concrete_output = map(self.pyretic2concrete,output)
-        map(self.send_packet,concrete_output)
+        if 'buffer_id' in concrete_pkt:
+            concrete_output = self.send_from_buffer(concrete_pkt['buffer_id'],
+                                                    self.pyretic2concrete(pyretic_pkt),
+                                                    concrete_output)
+        for (pkt,outports) in self.coalesce_outputs(concrete_output):
+            self.send_packet(pkt,outports)
 
         # if in reactive mode and no packets are forwarded to buckets, install microflow
         if self.mode == 'reactive0' and not queries:
             self.reactive0_install(pyretic_pkt,output)
 
 
+    def switch_counted_buckets(self, pkt, queries, bucket_rules):
+        """
+        The counting buckets among queries, by id, that the switch
+        counted pkt into before sending it up: in the proactive modes,
+        those of the installed rule that pkt matched.  As pkt reached
+        each of the queries, the first rule it matches counts into all
+        of them, so only the rules of each query (see bucket_rules)
+        are checked.
+
+        :param pkt: the packet sent to the controller
+        :type pkt: Packet
+        :param queries: the queries pkt reached
+        :type queries: set Query
+        :param bucket_rules: the index of the installed classifier
+        :type bucket_rules: dict
+        :rtype: set int
+        """
+        if bucket_rules is None or not self.mode in ['proactive0','proactive1']:
+            return set()
+        counted = set()
+        for q in queries:
+            for (m,switch_counts) in bucket_rules.get(id(q),[]):
+                if m.eval(pkt):
+                    if switch_counts:
+                        counted.add(id(q))
+                    break
+        return counted
+
+
 #############
 # DYNAMICS  
 #############
@@ -134,11 +220,10 @@ class Runtime(object):
 
         with self.policy_lock:
             self.update_dynamic_sub_pols()
-            classifier = None
-            if self.mode == 'proactive0' or self.mode == 'proactive1':
-                classifier = self.policy.compile()
+            self.update_packet_in_length()
+            self.update_polled_buckets()
 
-        self.update_switches(classifier)
+        self.request_update()
           
     def handle_network_change(self):
         """
@@ -150,34 +235,76 @@ class Runtime(object):
                 self.in_update_network = True
                 self.prev_network = self.network.copy()
 
+                # THE POLICY CHANGES IT CAUSES DON'T REACH handle_policy_change
                 with self.policy_lock:
                     for policy in self.dynamic_sub_pols:
                         policy.set_network(self.network)
                     self.update_dynamic_sub_pols()
-                    classifier = None
-                    if self.mode == 'proactive0' or self.mode == 'proactive1':
-                        classifier = self.policy.compile()
-
-                    self.update_switches(classifier)
+                    self.update_packet_in_length()
+                    self.update_polled_buckets()
 
                 self.in_update_network = False
+                self.request_update()
 
-    def update_switches(self,classifier):
+    def request_update(self):
+        """
+        Schedules an update of the switch classifiers.  In the proactive
+        modes the policy is compiled in the background by compile_loop, so
+        that packet processing never waits on a compile.
+        """
+        if self.mode == 'proactive0' or self.mode == 'proactive1':
+            with self.compile_cv:
+                self.policy_version += 1
+                self.compile_cv.notify()
+        else:
+            self.update_switches(None)
+
+    def compile_loop(self):
+        """
+        Background compiler.  Each time the policy changes, compiles the
+        latest version of the policy and swaps in the resulting classifier
+        together with its switch install.  Changes made while a compile is
+        running are coalesced into a single subsequent compile.  The
+        policy is snapshotted under policy_lock, and the snapshot compiled
+        without it, so that meanwhile the interpreter keeps handling
+        packets with the snapshot installed before.
+        """
+        while True:
+            with self.compile_cv:
+                while self.compiled_version == self.policy_version:
+                    self.compile_cv.wait()
+                version = self.policy_version
+            try:
+                with self.policy_lock:
+                    policy = snapshot(self.policy)
+                classifier = policy.compile()
+                self.update_switches(classifier,version,policy)
+            except Exception:
+                self.log.exception('failed to compile policy version %d' % version)
+            with self.compile_cv:
+                self.compiled_version = version
+
+    def update_switches(self,classifier,version=None,policy=None):
         """
         Updates switch tables based on input classifier
 
         :param classifier: the input classifier
         :type classifier: Classifier
+        :param version: the policy version the classifier was compiled from
+        :type version: int
+        :param policy: the policy snapshot the classifier was compiled from
+        :type policy: Policy
         """
         if self.mode == 'reactive0':
             self.clear_all() 
         elif self.mode == 'proactive0' or self.mode == 'proactive1':
-            self.log.debug(
-                '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
-                                              "generate classifier",
-                                              "policy="+repr(self.policy),
-                                              "classifier="+repr(classifier)))
-            self.install_classifier(classifier)
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(
+                    '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
+                                                  "generate classifier",
+                                                  "policy="+repr(policy),
+                                                  "classifier="+repr(classifier)))
+            self.install_classifier(classifier,version,policy)
 
     def update_dynamic_sub_pols(self):
         """
@@ -192,6 +319,23 @@ class Runtime(object):
             p.set_network(self.network)
             p.attach(self.handle_policy_change)
 
+    def update_packet_in_length(self):
+        """
+        Has switches send the controller just packet headers, unless
+        the policy may need payloads: when it forwards packets to
+        buckets not declared to read just headers, or modifies headers
+        that a switch can't rewrite on a packet it buffered.  Rules that send
+        packets to the controller carry the length, so a change is
+        reflected in the switch fingerprints.
+        """
+        if ast_fold(needs_payload, False, self.policy):
+            length = PACKET_IN_FULL_LENGTH
+        else:
+            length = PACKET_IN_HEADER_LENGTH
+        if length != self.packet_in_length:
+            self.packet_in_length = length
+            self.backend.send_packet_in_length(length)
+
 
 #######################
 # REACTIVE COMPILATION
@@ -209,11 +353,12 @@ class Runtime(object):
         rule_tuple = self.match_on_all_fields_rule_tuple(in_pkt,out_pkts)
         if rule_tuple:
             self.install_rule(rule_tuple)
-            self.log.debug(
-                '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
-                                              " | install rule",
-                                              rule_tuple[0],
-                                              'actions='+repr(rule_tuple[2])))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(
+                    '|%s|\n\t%s\n\t%s\n\t%s\n' % (str(datetime.now()),
+                                                  " | install rule",
+                                                  rule_tuple[0],
+                                                  'actions='+repr(rule_tuple[2])))
 
     def match_on_all_fields(self, pkt):
         """
@@ -228,6 +373,7 @@ class Runtime(object):
         del pred['header_len']
         del pred['payload_len']
         del pred['raw']
+        pred.pop('buffer_id',None)
         return pred
 
     def match_on_all_fields_rule_tuple(self, pkt_in, pkts_out):
@@ -240,7 +386,7 @@ class Runtime(object):
         :param pkts_out: the output packets
         :type pkts_out: set Packet
         :returns: an exact-match (microflow) rule 
-        :rtype: (dict of strings to values, int, list int)
+        :rtype: (dict of strings to values, int, list int, int)
         """        
         concrete_pkt_in = self.pyretic2concrete(pkt_in)
         concrete_pred = self.match_on_all_fields(concrete_pkt_in)
@@ -248,7 +394,7 @@ class Runtime(object):
         
         ### IF NO PKTS OUT THEN INSTALL DROP (EMPTY ACTION LIST)
         if len(pkts_out) == 0:
-            return (concrete_pred,0,action_list)
+            return (concrete_pred,0,action_list,0)
 
         for pkt_out in pkts_out:
             concrete_pkt_out = self.pyretic2concrete(pkt_out)
@@ -275,365 +421,390 @@ class Runtime(object):
                 if len(action_set) > 1:
                     return None
 
-        return (concrete_pred,0,action_list)
+        return (concrete_pred,0,action_list,0)
 
 
 #########################
 # PROACTIVE COMPILATION 
 #########################
 
-    def install_classifier(self, classifier):
+    def install_classifier(self, classifier, version=None, policy=None):
         """
-        Proactively installs switch table entries based on the input classifier
+        Proactively installs switch table entries based on the input
+        classifier, and then makes it (and the policy it was compiled
+        from, which the interpreter then evaluates) the runtime's current
+        classifier.
 
         :param classifier: the input classifer
         :type classifier: Classifier
+        :param version: the policy version the classifier was compiled from
+        :type version: int
+        :param policy: the policy snapshot the classifier was compiled from,
+            if not the runtime's policy itself
+        :type policy: Policy
         """
         if classifier is None:
             return
 
+        def policy_key(policy):
+            """A hashable key standing for a policy in a classifier rule."""
+            if isinstance(policy,match) or isinstance(policy,modify):
+                return (policy.__class__,frozenset(policy.map.items()))
+            elif isinstance(policy,CountBucket):
+                return (CountBucket,id(policy))
+            else:
+                return policy
+
         ### CLASSIFIER TRANSFORMS 
+        # Transforms are generators over (match, actions) pairs, so that the
+        # whole pipeline streams rule by rule and each output rule is
+        # allocated once, at the end of the pipeline.
 
-        def remove_drop(classifier):
+        def simplify_actions(rules):
             """
-            Removes drop policies from the action list.
+            Removes drop and identity policies from the action list, and
+            replaces each rule whose actions includes a send to controller
+            action with one whose sole action sends packets to the
+            controller. (Thereby avoiding the tricky situation of needing to
+            determine whether a given packet reached the controller b/c that
+            packet is being forwarded to a query bucket or b/c corresponding
+            rules haven't yet been installed.
             
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
+            :param rules: the input rules
+            :type rules: iterable Rule
+            :returns: the output (match, actions) pairs
+            :rtype: generator (Policy, list Policy)
             """
-            return Classifier(Rule(rule.match,
-                                   filter(lambda a: a != drop,rule.actions))
-                              for rule in classifier.rules)
-
-        def remove_identity(classifier):
-            """
-            Removes identity policies from the action list.
-            
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            # DISCUSS (cole): convert identity to inport rather
-            # than drop?
-            return Classifier(Rule(rule.match,
-                                   filter(lambda a: a != identity,rule.actions))
-                              for rule in classifier.rules)
-                
-        def controllerify(classifier):
-            """
-            Replaces each rule whose actions includes a send to controller action
-            with one whose sole action sends packets to the controller. (Thereby
-            avoiding the tricky situation of needing to determine whether a given 
-            packet reached the controller b/c that packet is being forwarded to a 
-            query bucket or b/c corresponding rules haven't yet been installed.
-                        
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            def controllerify_rule(rule):
-                if reduce(lambda acc, a: acc | (a == Controller),rule.actions,False):
-                    # DISCUSS (cole): should other actions be taken at the switch
-                    # before sending to the controller?  i.e. a policy like:
-                    # modify(srcip=1) >> ToController.
-                    return Rule(rule.match,[Controller])
-                else:
-                    return rule
-            return Classifier(controllerify_rule(rule) 
-                              for rule in classifier.rules)
-
-        def vlan_specialize(classifier):
-            """
-            Add Openflow's "default" VLAN match to identify packets which
-            don't have any VLAN tags on them.
-
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            specialized_rules = []
-            default_vlan_match = match(vlan_id=0xFFFF, vlan_pcp=0)
-            for rule in classifier.rules:
-                if ( ( isinstance(rule.match, match) and
-                       not 'vlan_id' in rule.match.map ) or
-                     rule.match == identity ):
-                    specialized_rules.append(Rule(rule.match.intersect(default_vlan_match),
-                                                  rule.actions))
-                else:
-                    specialized_rules.append(rule)
-            return Classifier(specialized_rules)
-
-        def layer_3_specialize(classifier):
+            for rule in rules:
+                # DISCUSS (cole): convert identity to inport rather
+                # than drop?
+                actions = [ a for a in rule.actions
+                            if a != drop and a != identity ]
+                for a in actions:
+                    if a == Controller:
+                        # DISCUSS (cole): should other actions be taken at the
+                        # switch before sending to the controller?  i.e. a
+                        # policy like: modify(srcip=1) >> ToController.
+                        actions = [Controller]
+                        break
+                yield (rule.match,actions)
+
+        def specialize_matches(rules):
             """
-            Specialize a layer-3 rule to several rules that match on layer-2 fields.
-            OpenFlow requires a layer-3 match to match on layer-2 ethtype.  Also, 
-            make sure that LLDP packets are reserved for use by the runtime.
+            Specialize a layer-3 rule to several rules that match on layer-2
+            fields, as OpenFlow requires a layer-3 match to match on layer-2
+            ethtype, and make sure that LLDP packets are reserved for use by
+            the runtime.  Also add Openflow's "default" VLAN match to identify
+            packets which don't have any VLAN tags on them.  Both
+            specializations are applied with a single intersection per
+            output rule.
             
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
+            :param rules: the input (match, actions) pairs
+            :type rules: iterable (Policy, list Policy)
+            :returns: the output (match, actions) pairs
+            :rtype: generator (Policy, list Policy)
             """
-            specialized_rules = []
-            # Add a rule that routes the LLDP messages to the controller for topology maintenance.
-            specialized_rules.append(Rule(match(ethtype=LLDP_TYPE),[Controller]))
-            for rule in classifier.rules:
-                if ( isinstance(rule.match, match) and
-                     ( 'srcip' in rule.match.map or 
-                       'dstip' in rule.match.map ) and 
-                     not 'ethtype' in rule.match.map ):
-                    specialized_rules.append(Rule(rule.match & match(ethtype=IP_TYPE),rule.actions))
+            default_vlan = {'vlan_id' : 0xFFFF, 'vlan_pcp' : 0}
+            default_vlan_match = match(default_vlan)
+            ip_match = match(ethtype=IP_TYPE)
+            ip_vlan_match = match(default_vlan,ethtype=IP_TYPE)
+            arp_match = match(ethtype=ARP_TYPE)
+            arp_vlan_match = match(default_vlan,ethtype=ARP_TYPE)
+
+            # Add a rule that routes the LLDP messages to the controller for
+            # topology maintenance.
+            yield (match(default_vlan,ethtype=LLDP_TYPE),[Controller])
+            for (m,actions) in rules:
+                is_match = isinstance(m, match)
+                vlan_default = ( ( is_match and not 'vlan_id' in m.map )
+                                 or m == identity )
+                if ( is_match and
+                     ( 'srcip' in m.map or 'dstip' in m.map ) and
+                     not 'ethtype' in m.map ):
+                    if vlan_default:
+                        yield (m.intersect(ip_vlan_match),actions)
+                        arp_m = m.intersect(arp_vlan_match)
+                    else:
+                        yield (m.intersect(ip_match),actions)
+                        arp_m = m.intersect(arp_match)
 
                     # DEAL W/ BUG IN OVS ACCEPTING ARP RULES THAT AREN'T ACTUALLY EXECUTED
                     arp_bug = False
-                    for action in rule.actions:
+                    for action in actions:
                         if action == Controller or isinstance(action, CountBucket):
                             pass
                         elif len(action.map) > 1:
                             arp_bug = True
                             break
                     if arp_bug:
-                        specialized_rules.append(Rule(rule.match & match(ethtype=ARP_TYPE),[Controller]))
+                        yield (arp_m,[Controller])
                     else:
-                        specialized_rules.append(Rule(rule.match & match(ethtype=ARP_TYPE),rule.actions))
+                        yield (arp_m,actions)
+                elif vlan_default:
+                    yield (m.intersect(default_vlan_match),actions)
                 else:
-                    specialized_rules.append(rule)
-            return Classifier(specialized_rules)
+                    yield (m,actions)
 
-        def bookkeep_buckets(classifier):
+        def bookkeep_buckets(rules):
             """
             Whenever rules are associated with counting buckets,
             add a reference to the classifier rule into the respective
             bucket for querying later. Count bucket actions operate at
             the pyretic level and are removed before installing rules.
+            Such rules are stamped with a cookie, which each of their
+            buckets indexes so as to attribute flow stats to itself.  A
+            rule keeps its cookie for as long as it stays in the
+            classifier, so that it needn't be reinstalled.
 
-            :param classifier: the input classifer
-            :type classifier: Classifier
+            :param rules: the input (match, actions) pairs
+            :type rules: iterable (Policy, list Policy)
             :returns: the output classifier
             :rtype: Classifier
             """
-            def collect_buckets(rules):
-                """
-                Scan classifier rules and collect distinct buckets into a
-                dictionary.
+            bucket_list = {}
+            new_rules = []
+            cookies = {}
+            cookie_buckets = {}
+            with self.update_buckets_lock:
+                """The start_update and finish_update functions per bucket guard
+                against inconsistent state in a single bucket, and the global
+                "update buckets" lock guards against inconsistent classifier
+                match state *across* buckets.
                 """
-                bucket_list = {}
-                for rule in rules:
-                    for act in rule.actions:
+                for (m,actions) in rules:
+                    phys_actions = []
+                    buckets = []
+                    for act in actions:
                         if isinstance(act, CountBucket):
                             if not id(act) in bucket_list:
                                 bucket_list[id(act)] = act
-                return bucket_list
-
-            def start_update(bucket_list):
-                for b in bucket_list.values():
-                    b.start_update()
-
-            def hook_buckets_to_rule(rule):
-                for act in rule.actions:
-                    if isinstance(act, CountBucket):
-                        act.add_match(rule.match)
-
-            def hook_buckets_to_pull_stats(bucket_list):
+                                act.start_update()
+                            act.add_match(m)
+                            buckets.append(act)
+                        else:
+                            phys_actions.append(act)
+                    cookie = 0
+                    if buckets:
+                        key = (policy_key(m),tuple(policy_key(a) for a in actions))
+                        cookie = self.rule_cookies.get(key)
+                        if cookie is None or key in cookies:
+                            cookie = self.next_cookie
+                            self.next_cookie += 1
+                        cookies[key] = cookie
+                        cookie_buckets[cookie] = buckets
+                        for b in buckets:
+                            b.add_cookie(cookie)
+                    new_rules.append(Rule(m,phys_actions,cookie))
+                self.rule_cookies = cookies
+                # FINAL COUNTS OF RETIRED RULES MAY STILL BE ON THEIR WAY
+                self.retired_cookie_buckets = self.cookie_buckets
+                self.cookie_buckets = cookie_buckets
                 for b in bucket_list.values():
                     b.add_pull_stats(self.pull_stats_for_bucket(b))
-
-            def finish_update(bucket_list):
-                for b in bucket_list.values():
                     b.finish_update()
-
-            with self.update_buckets_lock:
-                """The start_update and finish_update functions per bucket guard
-                against inconsistent state in a single bucket, and the global
-                "update buckets" lock guards against inconsistent classifier
-                match state *across* buckets.
-                """
-                bucket_list = collect_buckets(classifier.rules)
-                start_update(bucket_list)
-                map(hook_buckets_to_rule, classifier.rules)
-                hook_buckets_to_pull_stats(bucket_list)
-                finish_update(bucket_list)
-        
-        def remove_buckets(classifier):
-            """
-            Remove CountBucket policies from classifier rule actions.
-            
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            return Classifier(Rule(rule.match,
-                                   filter(lambda a: 
-                                          not isinstance(a, CountBucket),
-                                          rule.actions))
-                              for rule in classifier.rules)
-
-        def switchify(classifier,switches):
-            """
-            Specialize a classifer to a set of switches.  Any rule that doesn't 
-            specify a match on switch is turned into a set of rules matching on
-            each switch respectively.
-            
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :param switches: the network switches
-            :type switches: set int
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            new_rules = list()
-            for rule in classifier.rules:
-                if isinstance(rule.match, match) and 'switch' in rule.match.map:
-                    if not rule.match.map['switch'] in switches:
-                        continue
-                    new_rules.append(rule)
-                else:
-                    for s in switches:
-                        new_rules.append(Rule(
-                                rule.match.intersect(match(switch=s)),
-                                rule.actions))
             return Classifier(new_rules)
 
-        def concretize(classifier):
+        def switch_rules(classifier,switches):
             """
-            Convert policies into dictionaries.
+            Specialize a classifer to a set of switches, convert policies into
+            dictionaries, handle packets to be forwarded out the inport on
+            which they arrived and add priorities based on rule ordering, all
+            in a single pass.  Any rule that doesn't specify a match on switch
+            is turned into a set of rules matching on each switch
+            respectively.  Concrete actions are computed once per classifier
+            rule and shared by the rules generated for each switch.
             
             :param classifier: the input classifer
             :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
+            :param switches: the switches to specialize to
+            :type switches: list int
+            :returns: the prioritized rules for each switch
+            :rtype: dict from int to list (dict, int, list dict)
             """
-            def concretize_rule_actions(rule):
-                def concretize_match(pred):
-                    if pred == false:
-                        return None
-                    elif pred == true:
-                        return {}
-                    elif isinstance(pred, match):
-                        return { k:v for (k,v) in pred.map.items() }
-                def concretize_action(a):
-                    if a == Controller:
-                        return {'outport' : OFPP_CONTROLLER}
-                    elif isinstance(a,modify):
-                        return { k:v for (k,v) in a.map.items() }
-                    else: # default
-                        return a
-                m = concretize_match(rule.match)
-                acts = [concretize_action(a) for a in rule.actions]
-                if m is None:
-                    return None
-                else:
-                    return Rule(m,acts)
-            crs = [concretize_rule_actions(r) for r in classifier.rules]
-            crs = filter(lambda cr: not cr is None,crs)
-            return Classifier(crs)
+            def concretize_action(a):
+                if a == Controller:
+                    return {'outport' : OFPP_CONTROLLER,
+                            'max_len' : self.packet_in_length}
+                elif isinstance(a,modify):
+                    return dict(a.map)
+                else: # default
+                    return a
 
-        def OF_inportize(classifier):
-            """
-            Specialize classifier to ensure that packets to be forwarded 
-            out the inport on which they arrived are handled correctly.
-            
-            :param classifier: the input classifer
-            :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
-            """
-            import copy
             def specialize_actions(actions,outport):
-                new_actions = copy.deepcopy(actions)
-                for action in new_actions:
+                new_actions = []
+                for action in actions:
                     try:
                         if action['outport'] == outport:
+                            action = dict(action)
                             action['outport'] = OFPP_IN_PORT
                     except:
                         raise TypeError  # INVARIANT: every set of actions must go out a port
                                          # this may not hold when we move to OF 1.3
+                    new_actions.append(action)
                 return new_actions
 
-            specialized_rules = []
+            rules = { s : [] for s in switches }
+            priority = { s : 60000 for s in switches }
+            def emit(s,pred,actions,cookie):
+                rules[s].append((pred,priority[s],actions,cookie))
+                priority[s] -= 1
+
             for rule in classifier.rules:
-                phys_actions = filter(lambda a: (a['outport'] != OFPP_CONTROLLER 
-                                                 and a['outport'] != OFPP_IN_PORT),
-                                      rule.actions)
-                outports_used = map(lambda a: a['outport'], phys_actions)
-                if not 'inport' in rule.match:
-                    # Add a modified rule for each of the outports_used
-                    switch = rule.match['switch']
-                    for outport in outports_used:
-                        new_match = copy.deepcopy(rule.match)
-                        new_match['inport'] = outport
-                        new_actions = specialize_actions(rule.actions,outport)
-                        specialized_rules.append(Rule(new_match,new_actions))
-                    # And a default rule for any inport outside the set of outports_used
-                    specialized_rules.append(rule)
+                if rule.match == false:
+                    continue
+                elif isinstance(rule.match, match):
+                    pred = rule.match.map
                 else:
-                    if rule.match['inport'] in outports_used:
-                        # Modify the set of actions
-                        new_actions = specialize_actions(rule.actions,rule.match['inport'])
-                        specialized_rules.append(Rule(rule.match,new_actions))
-                    else:
-                        # Leave as before
-                        specialized_rules.append(rule)
+                    pred = {}
+                if 'switch' in pred:
+                    if not pred['switch'] in rules:
+                        continue
+                    targets = [pred['switch']]
+                else:
+                    targets = switches
+
+                actions = [concretize_action(a) for a in rule.actions]
+                outports_used = [ a['outport'] for a in actions
+                                  if ( a['outport'] != OFPP_CONTROLLER
+                                       and a['outport'] != OFPP_IN_PORT ) ]
+
+                if not 'inport' in pred:
+                    # A modified rule for each of the outports_used, followed
+                    # by a default rule for any inport outside that set
+                    specialized = [ (outport,specialize_actions(actions,outport))
+                                    for outport in outports_used ]
+                    for s in targets:
+                        for (outport,new_actions) in specialized:
+                            new_pred = dict(pred.items())
+                            new_pred['switch'] = s
+                            new_pred['inport'] = outport
+                            emit(s,new_pred,new_actions,rule.cookie)
+                        new_pred = dict(pred.items())
+                        new_pred['switch'] = s
+                        emit(s,new_pred,actions,rule.cookie)
+                else:
+                    if pred['inport'] in outports_used:
+                        actions = specialize_actions(actions,pred['inport'])
+                    for s in targets:
+                        new_pred = dict(pred.items())
+                        new_pred['switch'] = s
+                        emit(s,new_pred,actions,rule.cookie)
+            return rules
 
-            return Classifier(specialized_rules)
+        ### PER-SWITCH FINGERPRINTS
 
-        def prioritize(classifier):
+        def fingerprint_switches(classifier,switches):
             """
-            Add priorities to classifier rules based on their ordering.
-            
+            Compute a fingerprint for each switch's slice of the classifier.
+            A switch's final rule list is fully determined by the ordered
+            sequence of rules that either don't match on switch or match on
+            that switch specifically, so comparing the keys of that sequence
+            (rather than the switchified, concretized output) lets unchanged
+            switches be skipped before any per-switch work is done.  The
+            keys themselves are kept, rather than a hash of them, as a
+            collision would leave a switch with stale rules.
+
             :param classifier: the input classifer
             :type classifier: Classifier
-            :returns: the output classifier
-            :rtype: Classifier
+            :param switches: the network switches
+            :type switches: set int
+            :returns: fingerprint of each switch's rule list
+            :rtype: dict from int to tuple
             """
-            priority = {}
-            tuple_rules = list()
+            generic_keys = []
+            specific_keys = { s : [] for s in switches }
             for rule in classifier.rules:
-                s = rule.match['switch']
-                try:
-                    priority[s] -= 1
-                except KeyError:
-                    priority[s] = 60000
-                tuple_rules.append((rule.match,priority[s],rule.actions))
-            return tuple_rules
+                key = (policy_key(rule.match),
+                       tuple(policy_key(a) for a in rule.actions),
+                       rule.cookie)
+                if isinstance(rule.match, match) and 'switch' in rule.match.map:
+                    s = rule.match.map['switch']
+                    if s in specific_keys:
+                        # record position relative to the generic rules only,
+                        # so that edits on one switch don't shift the others
+                        specific_keys[s].append((len(generic_keys),key))
+                else:
+                    generic_keys.append(key)
+            generic_fingerprint = (self.packet_in_length,tuple(generic_keys))
+            # SHARE THE GENERIC KEYS WITH THE INSTALLED FINGERPRINTS IF THEY
+            # ARE UNCHANGED, SO THAT COMPARING EACH SWITCH'S FINGERPRINT
+            # DOESN'T COMPARE THEM AGAIN
+            for (installed,_) in self.switch_fingerprints.itervalues():
+                if installed == generic_fingerprint:
+                    generic_fingerprint = installed
+                break
+            return { s : (generic_fingerprint,tuple(specific_keys[s]))
+                     for s in switches }
+
+        def changed_switches(classifier,switches):
+            """
+            Determine which switches' rule lists differ from what was last
+            installed, and forget the state of switches that have left.
+
+            :param classifier: the input classifer
+            :type classifier: Classifier
+            :param switches: the network switches
+            :type switches: set int
+            :returns: the changed switches and their new fingerprints
+            :rtype: (list int, dict from int to tuple)
+            """
+            fingerprints = fingerprint_switches(classifier,switches)
+            for s in self.switch_fingerprints.keys():
+                if not s in fingerprints:
+                    del self.switch_fingerprints[s]
+                    if s in self.old_rules:
+                        del self.old_rules[s]
+                    self.retire_switch_installer(s)
+            changed = [ s for s in switches
+                        if self.switch_fingerprints.get(s) != fingerprints[s] ]
+            return (changed,fingerprints)
+
+        def record_installed(switches,new_switch_rules,fingerprints,epochs):
+            """
+            Remember the rules just committed to each switch, unless the
+            switch joined or left while they were being committed, in
+            which case it is left to be updated in full next time.
+
+            :param epochs: each switch's epoch when its update was computed
+            :type epochs: dict from int to int
+            """
+            with self.old_rules_lock:
+                for s in switches:
+                    if self.switch_epochs.get(s,0) != epochs[s]:
+                        continue
+                    self.old_rules[s] = new_switch_rules[s]
+                    self.switch_fingerprints[s] = fingerprints[s]
 
         ### UPDATE LOGIC
 
         def nuclear_install(classifier):
             """
-            Delete all rules currently installed on switches and then
-            install input classifier from scratch.
+            Delete all rules currently installed on switches whose rules
+            changed and then install input classifier on them from scratch.
             
             :param classifier: the input classifer
             :type classifier: Classifier
             """
-            switch_attrs_tuples = self.network.topology.nodes(data=True)
-            switch_to_attrs = { k : v for (k,v) in switch_attrs_tuples }
-            switches = switch_to_attrs.keys()
-            classifier = switchify(classifier,switches)
-            classifier = concretize(classifier)
-            classifier = OF_inportize(classifier)
-            new_rules = prioritize(classifier)
-
-            for s in switches:
-                self.send_barrier(s)
-                self.send_clear(s)
-                self.send_barrier(s)
-                self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
+            with self.old_rules_lock:
+                switches = self.network.topology.nodes()
+                (switches,fingerprints) = changed_switches(classifier,switches)
+                epochs = { s : self.switch_epochs.get(s,0) for s in switches }
+            new_rules = switch_rules(classifier,switches)
 
-            for rule in new_rules:
-                self.install_rule(rule)
-                
+            switch_updates = {}
             for s in switches:
-                self.send_barrier(s)
-                if self.verbosity >= self.verbosity_numeric('please-make-it-stop'):
+                updates = [('barrier',None),
+                           ('clear',None),
+                           ('barrier',None),
+                           ('install',self.table_miss_rule(s))]
+                updates += [ ('install',rule) for rule in new_rules[s] ]
+                switch_updates[s] = updates
+            self.commit_switch_updates(switch_updates)
+
+            if self.verbosity >= self.verbosity_numeric('please-make-it-stop'):
+                for s in switches:
                     self.request_flow_stats(s)
+            record_installed(switches,new_rules,fingerprints,epochs)
 
         ### INCREMENTAL UPDATE LOGIC
 
@@ -648,80 +819,95 @@ class Runtime(object):
         def install_diff_rules(classifier):
             """
             Calculate and install the difference between the input classifier
-            and the current switch tables.
+            and the current tables of switches whose rules changed.  The
+            diff is computed under old_rules_lock, but committed without
+            it, so that stats queries need not wait on switches.
             
             :param classifier: the input classifer
             :type classifier: Classifier
             """
             with self.old_rules_lock:
-                old_rules = self.old_rules
-                switch_attrs_tuples = self.network.topology.nodes(data=True)
-                switch_to_attrs = { k : v for (k,v) in switch_attrs_tuples }
-                switches = switch_to_attrs.keys()
-                classifier = switchify(classifier,switches)
-                classifier = concretize(classifier)
-                classifier = OF_inportize(classifier)
-                new_rules = prioritize(classifier)
-
-                # calculate diff
-                to_add = list()
-                to_delete = list()
-                to_modify = list()
-                for old in old_rules:
-                    new = find_same_rule(old, new_rules)
-                    if new is None:
-                        to_delete.append(old)
-                    else:
-                        if old[2] != new[2]:
-                            to_modify.append(new)
-    
-                for new in new_rules:
-                    old = find_same_rule(new, old_rules)
-                    if old is None:
-                        to_add.append(new)
-    
-                # install diff
-                if not to_add is None:
-                    for rule in to_add:
-                        self.install_rule(rule)
-                for rule in to_delete:
-                    if rule[0]['switch'] in switches:
-                        self.delete_rule((rule[0], rule[1]))
-                for rule in to_modify:
-                    self.delete_rule((rule[0], rule[1]))
-                    self.install_rule(rule)
-    
-                # update old_rule
-                del old_rules[0:len(old_rules)]
-                for rule in new_rules:
-                    old_rules.append(rule)
+                switches = self.network.topology.nodes()
+                (switches,fingerprints) = changed_switches(classifier,switches)
+                epochs = { s : self.switch_epochs.get(s,0) for s in switches }
+                new_switch_rules = switch_rules(classifier,switches)
 
+                switch_updates = {}
                 for s in switches:
-                    self.send_barrier(s)
+                    old_rules = self.old_rules.get(s,[])
+                    new_rules = new_switch_rules[s]
+
+                    # calculate diff
+                    to_add = list()
+                    to_delete = list()
+                    to_modify = list()
+                    for old in old_rules:
+                        new = find_same_rule(old, new_rules)
+                        if new is None:
+                            to_delete.append(old)
+                        else:
+                            if old[2:] != new[2:]:
+                                to_modify.append(new)
+
+                    for new in new_rules:
+                        old = find_same_rule(new, old_rules)
+                        if old is None:
+                            to_add.append(new)
+
+                    # install diff
+                    updates = [ ('install',rule) for rule in to_add ]
+                    for rule in to_delete:
+                        updates.append(('delete',(rule[0], rule[1])))
+                    for rule in to_modify:
+                        updates.append(('delete',(rule[0], rule[1])))
+                        updates.append(('install',rule))
+                    switch_updates[s] = updates
+
+            self.commit_switch_updates(switch_updates)
+            record_installed(switches,new_switch_rules,fingerprints,epochs)
+
+        def index_bucket_rules(classifier):
+            """
+            Index the matches of the rules counting into each bucket, in
+            priority order, and whether the switch counts their packets.
+            A rule that sends packets to the controller is installed with
+            that as its sole action and no cookie (see simplify_actions),
+            so the switch counts them into none of its buckets.
 
-        ### PROCESS THAT DOES INSTALL
+            :param classifier: the policy classifier
+            :type classifier: Classifier
+            :returns: (match, counted by switch) pairs by bucket id
+            :rtype: dict from int to list (Policy, bool)
+            """
+            index = {}
+            for rule in classifier.rules:
+                switch_counts = not any(a == Controller for a in rule.actions)
+                buckets = { id(a) for a in rule.actions if isinstance(a,CountBucket) }
+                for b in buckets:
+                    index.setdefault(b,[]).append((rule.match,switch_counts))
+            return index
+
+        ### INSTALL, THEN SWAP IN THE NEW CLASSIFIER
 
-        def f(classifier):
-            with self.switch_lock:
-                if self.mode == 'proactive0':
-                    nuclear_install(classifier)
-                elif self.mode == 'proactive1':
-                    install_diff_rules(classifier)
+        policy_classifier = classifier
+        bucket_rules = index_bucket_rules(policy_classifier)
 
         # Process classifier to an openflow-compatible format before
         # sending out rule installs
-        classifier = remove_drop(classifier)
-        #classifier = send_drops_to_controller(classifier)
-        classifier = remove_identity(classifier)
-        classifier = controllerify(classifier)
-        classifier = layer_3_specialize(classifier)
-        classifier = vlan_specialize(classifier)
-        bookkeep_buckets(classifier)
-        classifier = remove_buckets(classifier)
-
-        p = Process(target=f,args=(classifier,))
-        p.daemon = True
-        p.start()
+        rules = simplify_actions(classifier.rules)
+        rules = specialize_matches(rules)
+        classifier = bookkeep_buckets(rules)
+
+        with self.switch_lock:
+            if self.mode == 'proactive0':
+                nuclear_install(classifier)
+            elif self.mode == 'proactive1':
+                install_diff_rules(classifier)
+            self.classifier = policy_classifier
+            self.compiled_policy = policy
+            self.bucket_rules = bucket_rules
+            if not version is None:
+                self.classifier_version = version
 
 
 ###################
@@ -732,8 +918,8 @@ class Runtime(object):
         """
         Returns a function that can be used by counting buckets to
         issue queries from the runtime."""
-        def pull_bucket_stats():
-            switch_list = []
+        def pull_bucket_stats(stats_round=None):
+            requests = {}
             for m in bucket.matches:
                 if m == identity:
                     concrete_pred = {}
@@ -741,26 +927,179 @@ class Runtime(object):
                     assert(isinstance(m, match))
                     concrete_pred = { k:v for (k,v) in m.map.items() }
                 if 'switch' in concrete_pred:
-                    switch_list.append(concrete_pred['switch'])
+                    switch_list = [concrete_pred.pop('switch')]
                 else:
                     switch_list = self.network.topology.nodes()
-                    break
-            for s in switch_list:
-                bucket.add_outstanding_switch_query(s)
-                already_queried = self.add_global_outstanding_query(s, bucket)
-                if not already_queried:
-                    self.request_flow_stats(s)
+                for s in switch_list:
+                    requests.setdefault(s,{})[frozenset(concrete_pred.items())] = concrete_pred
+            for s,preds in requests.items():
+                if not stats_round is None:
+                    # THE SCHEDULER SENDS ONE REQUEST PER SWITCH FOR THE ROUND
+                    bucket.add_outstanding_switch_query(s)
+                    stats_round.setdefault(s,[]).append((bucket,preds.values()))
+                    continue
+                preds = self.broadest_preds(preds.values())
+                for concrete_pred in preds:
+                    bucket.add_outstanding_switch_query(s)
+                    xid = self.add_global_outstanding_query(s, [bucket])
+                    if (len(preds) == 1 and
+                        self.aggregate_covers(s, concrete_pred, preds, bucket)):
+                        self.request_aggregate_stats(s, concrete_pred, xid)
+                    else:
+                        self.request_flow_stats(s, concrete_pred, xid)
         return pull_bucket_stats
 
-    def add_global_outstanding_query(self, s, bucket):
-        already_queried = False
+    def add_global_outstanding_query(self, s, buckets):
+        """
+        Records a stats request to switch s on behalf of buckets, and
+        returns the transaction id to send it with.
+        """
+        self.start_stats_scheduler()
         with self.global_outstanding_queries_lock:
-            if not s in self.global_outstanding_queries:
-                self.global_outstanding_queries[s] = [bucket]
+            xid = self.stats_xid
+            self.stats_xid += 1
+            if self.stats_xid >= BARRIER_XID_BASE:
+                self.stats_xid = STATS_XID_BASE
+            self.global_outstanding_queries[(s,xid)] = (buckets,time.time())
+        return xid
+
+    def update_polled_buckets(self):
+        """
+        Updates the counting buckets in self.policy that the stats
+        scheduler polls, i.e., those given a polling interval.
+        """
+        def add_polled_bucket(acc, policy):
+            if isinstance(policy,CountBucket) and policy.interval:
+                acc[id(policy)] = policy
+            return acc
+        polled = ast_fold(add_polled_bucket, {}, self.policy)
+        with self.stats_cv:
+            self.polled_buckets = polled
+            self.stats_due = { b : self.stats_due.get(b,0) for b in polled }
+            self.stats_cv.notify()
+        if polled:
+            self.start_stats_scheduler()
+
+    def start_stats_scheduler(self):
+        with self.stats_cv:
+            if self.stats_thread is None:
+                self.stats_thread = threading.Thread(target=self.stats_loop)
+                self.stats_thread.daemon = True
+                self.stats_thread.start()
+
+    def stats_loop(self):
+        """
+        The stats scheduler.  A bucket polled every interval seconds falls
+        due at each multiple of its interval, so buckets with the same (or
+        commensurate) intervals fall due together and share a round.
+        Requests not answered within STATS_REPLY_TIMEOUT are given up on.
+        """
+        while True:
+            with self.stats_cv:
+                now = time.time()
+                due = []
+                for (b,bucket) in self.polled_buckets.items():
+                    if self.stats_due[b] <= now:
+                        due.append(bucket)
+                        self.stats_due[b] = (int(now / bucket.interval) + 1) * bucket.interval
+            self.expire_stats_queries(now)
+            if due:
+                self.poll_buckets(due)
+            with self.stats_cv:
+                wake = min(self.stats_due.values() + [now + STATS_REPLY_TIMEOUT])
+                timeout = wake - time.time()
+                if timeout > 0:
+                    self.stats_cv.wait(timeout)
+
+    def poll_buckets(self, buckets):
+        """
+        Polls buckets in a single round, sending each switch one stats
+        request whose reply all of them share.  Buckets still waiting on
+        replies from their last round sit this one out.
+
+        :param buckets: the buckets to poll
+        :type buckets: list CountBucket
+        """
+        stats_round = {}
+        for bucket in buckets:
+            if bucket.outstanding_switches:
+                continue
+            bucket.pull_stats(stats_round)
+        for s,wanted in stats_round.items():
+            buckets = [ bucket for (bucket,_) in wanted ]
+            preds = {}
+            for (_,bucket_preds) in wanted:
+                for concrete_pred in bucket_preds:
+                    preds[frozenset(concrete_pred.items())] = concrete_pred
+            preds = self.broadest_preds(preds.values())
+            xid = self.add_global_outstanding_query(s, buckets)
+            if (len(buckets) == 1 and len(preds) == 1 and 
+                self.aggregate_covers(s, preds[0], preds, buckets[0])):
+                self.request_aggregate_stats(s, preds[0], xid)
             else:
-                self.global_outstanding_queries[s].append(bucket)
-                already_queried = True
-        return already_queried
+                # FIELDS SHARED BY ALL THE PREDICATES COVER EACH OF THEM
+                common = dict(preds[0])
+                for concrete_pred in preds[1:]:
+                    common = { k : v for (k,v) in common.items()
+                               if concrete_pred.get(k) == v }
+                self.request_flow_stats(s, common, xid)
+
+    def expire_stats_queries(self, now):
+        """
+        Gives up on stats requests sent more than STATS_REPLY_TIMEOUT
+        before now, so the buckets waiting on them can report.
+        """
+        expired = []
+        with self.global_outstanding_queries_lock:
+            for (key,(buckets,sent)) in self.global_outstanding_queries.items():
+                if now - sent > STATS_REPLY_TIMEOUT:
+                    del self.global_outstanding_queries[key]
+                    expired.append((key,buckets))
+        for ((s,xid),buckets) in expired:
+            self.log.warning('no reply from switch %s to stats request %d' % (s,xid))
+            for bucket in buckets:
+                bucket.handle_stats_timeout(s)
+
+    def broadest_preds(self, concrete_preds):
+        """
+        Drops the predicates that another one covers, since a stats
+        request reports on every table entry at least as specific as
+        its predicate, and would otherwise be counted twice.
+        """
+        if {} in concrete_preds:
+            return [{}]
+        preds = [ (concrete_pred,match(concrete_pred)) 
+                  for concrete_pred in concrete_preds ]
+        return [ concrete_pred for (concrete_pred,pred) in preds
+                 if not any(other.covers(pred) and other != pred
+                            for (_,other) in preds) ]
+
+    def aggregate_covers(self, s, concrete_pred, concrete_preds, bucket):
+        """
+        Whether the totals over the table entries of switch s that a
+        stats request for concrete_pred reports on are exactly what
+        bucket counts, i.e., whether each of those entries was installed
+        for a rule counting once into bucket, and none of them is also
+        reported on by the request for another of concrete_preds.
+        """
+        if not concrete_pred:
+            return False
+        pred = match(concrete_pred)
+        others = [ match(other) for other in concrete_preds
+                   if other != concrete_pred ]
+        with self.old_rules_lock:
+            installed = self.old_rules.get(s)
+            if installed is None:
+                return False
+            for (entry_pred,priority,action_list,cookie) in installed:
+                entry = match(entry_pred)
+                if not pred.covers(entry):
+                    continue
+                if bucket.cookies.get(cookie) != 1:
+                    return False
+                if any(other.covers(entry) for other in others):
+                    return False
+        return True
 
 
 ####################################
@@ -786,6 +1125,7 @@ class Runtime(object):
         return pyretic_packet.modifymany(d)
 
     def pyretic2concrete(self,packet):
+        # buffer_id IS ONLY EVER SET BY use_switch_buffer
         concrete_packet = {}
         for header in ['switch','inport','outport']:
             try:
@@ -794,6 +1134,8 @@ class Runtime(object):
             except:
                 pass
         for header in native_headers + content_headers:
+            if header == 'buffer_id':
+                continue
             try:
                 val = packet[header]
                 concrete_packet[header] = val
@@ -811,21 +1153,301 @@ class Runtime(object):
 # TO OPENFLOW         
 #######################
 
-    def send_packet(self,concrete_packet):
-        self.backend.send_packet(concrete_packet)
+    def send_from_buffer(self,buffer_id,concrete_pkt_in,concrete_pkts_out):
+        """
+        The switch that sent a packet in may have kept a copy of it,
+        identified by buffer_id.  Sends every output that leaves that
+        switch with at most rewritable headers changed in a single
+        packet out referencing that copy, rather than carrying the
+        payload back.  IP addresses are only rewritable on IP packets,
+        as switches don't apply those actions to e.g. ARP packets.  If
+        the packet in was truncated, outputs that can't be sent that way
+        are dropped.
+
+        :param buffer_id: the switch buffer holding the packet
+        :type buffer_id: int
+        :param concrete_pkt_in: the packet as it came in
+        :type concrete_pkt_in: dict
+        :param concrete_pkts_out: the packets to send
+        :type concrete_pkts_out: list dict
+        :returns: the outputs that must still be sent with their payloads
+        :rtype: list dict
+        """
+        action_list = []
+        rest = []
+        current = concrete_pkt_in
+        for pkt in concrete_pkts_out:
+            if (pkt.get('switch') != concrete_pkt_in.get('switch') or
+                pkt.get('raw') != concrete_pkt_in.get('raw')):
+                rest.append(pkt)
+                continue
+            # EACH OUTPUT'S REWRITES APPLY ON TOP OF THE PREVIOUS ONES
+            changed = [h for h in native_headers if pkt.get(h) != current.get(h)]
+            if any(not h in rewritable_headers for h in changed):
+                rest.append(pkt)
+                continue
+            if (pkt.get('ethtype') != IP_TYPE and
+                any(h in ['srcip','dstip'] for h in changed)):
+                rest.append(pkt)
+                continue
+            if any(h in tagging_headers for h in changed):
+                changed += tagging_headers
+            actions = {h : pkt.get(h) for h in changed}
+            actions['outport'] = pkt['outport']
+            action_list.append(actions)
+            current = pkt
+        if action_list:
+            self.backend.send_buffered_packet(concrete_pkt_in['switch'],
+                                              concrete_pkt_in['inport'],
+                                              buffer_id,action_list)
+        truncated = (len(concrete_pkt_in.get('raw','')) < 
+                     concrete_pkt_in.get('header_len',0) + concrete_pkt_in.get('payload_len',0))
+        if truncated and rest:
+            self.log.warning('dropping %d outputs of a truncated packet' % len(rest))
+            return []
+        return rest
+
+    def coalesce_outputs(self,concrete_pkts):
+        """
+        Groups packets that differ only in outport, so that each group,
+        e.g. the output of a flood, can be sent in a single packet out.
 
-    def install_rule(self,(concrete_pred,priority,action_list)):
-        self.log.debug(
-            '|%s|\n\t%s\n\t%s\n' % (str(datetime.now()),
-                "sending openflow rule:",
-                (str(priority) + " " + repr(concrete_pred) + " "+ repr(action_list))))
-        self.backend.send_install(concrete_pred,priority,action_list)
+        :param concrete_pkts: the packets to send
+        :type concrete_pkts: list dict
+        :returns: each group's packet, and its outports if there are several
+        :rtype: list (dict, list int or None)
+        """
+        groups = []
+        for pkt in concrete_pkts:
+            rest = dict(pkt)
+            outport = rest.pop('outport',None)
+            for (other,outports) in groups:
+                if other == rest:
+                    outports.append(outport)
+                    break
+            else:
+                groups.append((rest,[outport]))
+        coalesced = []
+        for (pkt,outports) in groups:
+            pkt['outport'] = outports[0]
+            if len(outports) == 1:
+                coalesced.append((pkt,None))
+            else:
+                coalesced.append((pkt,outports))
+        return coalesced
+
+    def send_packet(self,concrete_packet,outports=None):
+        self.backend.send_packet(concrete_packet,outports)
+
+    def table_miss_rule(self,switch):
+        """
+        The rule sending packets that match nothing else to the controller.
+        """
+        return ({'switch' : switch},TABLE_MISS_PRIORITY,
+                [{'outport' : OFPP_CONTROLLER, 'max_len' : self.packet_in_length}],0)
+
+    def install_rule(self,(concrete_pred,priority,action_list,cookie)):
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug(
+                '|%s|\n\t%s\n\t%s\n' % (str(datetime.now()),
+                    "sending openflow rule:",
+                    (str(priority) + " " + repr(concrete_pred) + " "+ repr(action_list))))
+        self.backend.send_install(concrete_pred,priority,action_list,cookie)
 
     def delete_rule(self,(concrete_pred,priority)):
         self.backend.send_delete(concrete_pred,priority)
 
-    def send_barrier(self,switch):
-        self.backend.send_barrier(switch)
+    def send_barrier(self,switch,tracked=False):
+        """
+        Sends a barrier to a switch.  If tracked, returns the transaction id
+        of the barrier, whose reply can then be awaited with
+        wait_for_barrier.
+        """
+        xid = None
+        if tracked:
+            xid = self.track_barrier(switch)
+        self.backend.send_barrier(switch,xid)
+        return xid
+
+    def send_batch(self,switch,batch):
+        """
+        Sends a batch of flow table updates to a switch in a single
+        message, closed by a tracked barrier, and returns the barrier's
+        transaction id.
+
+        :param switch: the switch to update
+        :type switch: int
+        :param batch: ['install', pred, priority, action_list, cookie],
+            ['delete', pred, priority], ['clear'] or ['barrier'] lists
+        :type batch: list list
+        :rtype: int
+        """
+        xid = self.track_barrier(switch)
+        self.backend.send_apply_diff(switch,batch,xid)
+        return xid
+
+    def track_barrier(self,switch):
+        """
+        Allocates the transaction id of a barrier to switch, whose reply
+        can be awaited with wait_for_barrier.
+        """
+        with self.barrier_lock:
+            xid = self.barrier_xid
+            self.barrier_xid += 1
+            if self.barrier_xid > 0xffffffff:
+                self.barrier_xid = BARRIER_XID_BASE
+            self.outstanding_barriers[(switch,xid)] = threading.Event()
+        return xid
+
+    def wait_for_barrier(self,switch,xid,timeout=BARRIER_TIMEOUT):
+        """
+        Waits for the reply to a tracked barrier.
+
+        :returns: whether the reply arrived within timeout
+        :rtype: bool
+        """
+        with self.barrier_lock:
+            replied = self.outstanding_barriers.get((switch,xid))
+        if replied is None:
+            return True
+        acked = replied.wait(timeout)
+        with self.barrier_lock:
+            del self.outstanding_barriers[(switch,xid)]
+        return acked
+
+    def commit_switch_update(self,switch,updates):
+        """
+        Sends a list of updates to a switch and waits until the switch has
+        acknowledged all of them.  Flow-mods are pipelined in windows of
+        INSTALL_WINDOW, each sent as a single batch closed by a tracked
+        barrier, with at most INSTALL_WINDOWS_IN_FLIGHT windows
+        unacknowledged at a time.  If a barrier reply times out, the rest
+        of the update is sent unpaced.
+
+        :param switch: the switch to update
+        :type switch: int
+        :param updates: ('install', rule), ('delete', (pred, priority)),
+            ('clear', None) or ('barrier', None) pairs, in order
+        :type updates: list (string, tuple)
+        :returns: whether every window was acknowledged
+        :rtype: bool
+        """
+        start = time.time()
+        in_flight = []
+        in_window = 0
+        paced = True
+        sent = 0
+        batch = []
+        self.install_progress[switch] = (sent,len(updates))
+        for (kind,arg) in updates:
+            if kind == 'install':
+                (pred,priority,action_list,cookie) = arg
+                batch.append(['install',pred,priority,action_list,cookie])
+            elif kind == 'delete':
+                (pred,priority) = arg
+                batch.append(['delete',pred,priority])
+            elif kind == 'clear':
+                batch.append(['clear'])
+            elif kind == 'barrier':
+                batch.append(['barrier'])
+                continue
+            in_window += 1
+            sent += 1
+            if in_window == INSTALL_WINDOW:
+                in_window = 0
+                self.install_progress[switch] = (sent,len(updates))
+                in_flight.append(self.send_batch(switch,batch))
+                batch = []
+                if len(in_flight) >= INSTALL_WINDOWS_IN_FLIGHT:
+                    xid = in_flight.pop(0)
+                    paced = self.wait_for_barrier(switch,xid,
+                                                  BARRIER_TIMEOUT if paced else 0) and paced
+        in_flight.append(self.send_batch(switch,batch))
+        for xid in in_flight:
+            paced = self.wait_for_barrier(switch,xid,
+                                          BARRIER_TIMEOUT if paced else 0) and paced
+        self.install_progress[switch] = (len(updates),len(updates))
+        self.switch_commit_times[switch] = time.time() - start
+        if paced:
+            self.log.debug('switch %s committed %d updates in %f seconds' % 
+                           (switch,len(updates),self.switch_commit_times[switch]))
+        else:
+            self.log.warning('switch %s did not acknowledge its update' % switch)
+        return paced
+
+    def commit_switch_updates(self,switch_updates):
+        """
+        Commits each switch's updates on that switch's installer thread,
+        so that switches are updated concurrently while the updates to any
+        one switch stay in order.  Returns once every switch has finished,
+        so an update takes as long as its slowest switch.
+
+        :param switch_updates: the updates for each switch
+        :type switch_updates: dict from int to list (string, tuple)
+        :returns: whether every switch acknowledged its update
+        :rtype: bool
+        """
+        if not switch_updates:
+            return True
+        results = {}
+        jobs = []
+        for s,updates in switch_updates.items():
+            done = threading.Event()
+            self.switch_installer(s).put((updates,results,done))
+            jobs.append(done)
+        for done in jobs:
+            done.wait()
+        if self.verbosity >= self.verbosity_numeric('high'):
+            slowest = max(switch_updates, 
+                          key=lambda s: self.switch_commit_times.get(s,0))
+            self.log.info('updated %d switches, slowest was switch %s (%f seconds)' %
+                          (len(switch_updates),slowest,
+                           self.switch_commit_times.get(slowest,0)))
+        return all(results.values())
+
+    def switch_installer(self,switch):
+        """
+        Returns the job queue of a switch's installer thread, starting the
+        thread if the switch does not have one yet.
+        """
+        with self.install_queues_lock:
+            jobs = self.install_queues.get(switch)
+            if jobs is None:
+                jobs = Queue.Queue()
+                self.install_queues[switch] = jobs
+                t = threading.Thread(target=self.drain_install_queue,
+                                     args=(switch,jobs))
+                t.daemon = True
+                t.start()
+            return jobs
+
+    def drain_install_queue(self,switch,jobs):
+        """
+        Body of a switch's installer thread: commits queued updates to the
+        switch one at a time, until handed None.
+        """
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            (updates,results,done) = job
+            try:
+                results[switch] = self.commit_switch_update(switch,updates)
+            except Exception:
+                results[switch] = False
+                self.log.exception('update of switch %s failed' % switch)
+            finally:
+                done.set()
+
+    def retire_switch_installer(self,switch):
+        """
+        Stops the installer thread of a switch that has left the network.
+        """
+        with self.install_queues_lock:
+            jobs = self.install_queues.pop(switch,None)
+        if not jobs is None:
+            jobs.put(None)
+        self.install_progress.pop(switch,None)
 
     def send_clear(self,switch):
         self.backend.send_clear(switch)
@@ -837,13 +1459,16 @@ class Runtime(object):
                 self.send_barrier(s)
                 self.send_clear(s)
                 self.send_barrier(s)
-                self.install_rule(({'switch' : s},TABLE_MISS_PRIORITY,[{'outport' : OFPP_CONTROLLER}]))
+                self.install_rule(self.table_miss_rule(s))
         p = Process(target=f)
         p.daemon = True
         p.start()
 
-    def request_flow_stats(self,switch):
-        self.backend.send_flow_stats_request(switch)
+    def request_flow_stats(self,switch,concrete_pred=None,xid=None):
+        self.backend.send_flow_stats_request(switch,concrete_pred,xid)
+
+    def request_aggregate_stats(self,switch,concrete_pred,xid):
+        self.backend.send_aggregate_stats_request(switch,concrete_pred,xid)
 
     def inject_discovery_packet(self,dpid, port):
         self.backend.inject_discovery_packet(dpid,port)
@@ -854,11 +1479,34 @@ class Runtime(object):
 #######################
 
     def handle_switch_join(self,switch_id):
+        self.forget_switch_rules(switch_id)
+        self.backend.send_packet_in_length(self.packet_in_length,switch_id)
         self.network.handle_switch_join(switch_id)
 
     def handle_switch_part(self,switch_id):
+        self.forget_switch_rules(switch_id)
         self.network.handle_switch_part(switch_id)
 
+    def forget_switch_rules(self,switch):
+        """
+        Forgets what was installed on a switch that joined or left, so
+        that the next install updates it in full, even if it rejoined
+        (e.g., with an empty table) before any install noticed it gone.
+        """
+        with self.old_rules_lock:
+            self.switch_fingerprints.pop(switch,None)
+            self.old_rules.pop(switch,None)
+            # AND NOT RECORD AN UPDATE IN FLIGHT AS INSTALLED ON IT
+            self.switch_epochs[switch] = self.switch_epochs.get(switch,0) + 1
+        # ITS COUNTERS MAY HAVE STARTED OVER TOO
+        buckets = {}
+        for cookie_buckets in [self.cookie_buckets, self.retired_cookie_buckets]:
+            for bs in cookie_buckets.values():
+                for b in bs:
+                    buckets[id(b)] = b
+        for b in buckets.values():
+            b.forget_switch(switch)
+
     def handle_port_join(self,switch_id,port_id,conf_up,stat_up):
         self.network.handle_port_join(switch_id,port_id,conf_up,stat_up)
 
@@ -871,27 +1519,30 @@ class Runtime(object):
     def handle_link_update(self, s1, p_no1, s2, p_no2):
         self.network.handle_link_update(s1, p_no1, s2, p_no2)
 
-    def handle_flow_stats_reply(self, switch, flow_stats):
+    def handle_barrier_reply(self, switch, xid):
+        with self.barrier_lock:
+            replied = self.outstanding_barriers.get((switch,xid))
+        if not replied is None:
+            replied.set()
+
+    def handle_flow_stats_reply(self, switch, flow_stats, xid=None):
+        """
+        Hands a flow stats reply to the bucket that requested it, which
+        attributes the counts by cookie, so the matches and actions of the
+        entries are only converted for logging.
+        """
         def convert(f,val):
             if f == 'match':
-                import ast
-                val = ast.literal_eval(val)
                 return { g : convert(g,v) for g,v in val.items() }
             if f == 'actions':
-                import ast
-                vals = ast.literal_eval(val)
                 return [ { g : convert(g,v) for g,v in val.items() }
-                         for val in vals ]
+                         for val in val ]
             if f in ['srcmac','dstmac']:
                 return MAC(val)
             elif f in ['srcip','dstip']:
                 return IP(val)
             else:
                 return val
-        flow_stats = [ { f : convert(f,v) 
-                         for (f,v) in flow_stat.items() }
-                       for flow_stat in flow_stats       ]
-        flow_stats = sorted(flow_stats, key=lambda d: -d['priority'])
         def flow_stat_str(flow_stat):
             output = str(flow_stat['priority']) + ':\t' 
             output += str(flow_stat['match']) + '\n\t->'
@@ -899,15 +1550,37 @@ class Runtime(object):
             output += 'packet_count=' + str(flow_stat['packet_count']) 
             output += '\tbyte_count=' + str(flow_stat['byte_count'])
             return output
-        self.log.debug(
-            '|%s|\n\t%s\n' % (str(datetime.now()),
-                '\n'.join(['flow table for switch='+repr(switch)] + 
-                    [flow_stat_str(f) for f in flow_stats])))
+        if self.log.isEnabledFor(logging.DEBUG):
+            flow_table = [ { f : convert(f,v) 
+                             for (f,v) in flow_stat.items() }
+                           for flow_stat in flow_stats       ]
+            flow_table = sorted(flow_table, key=lambda d: -d['priority'])
+            self.log.debug(
+                '|%s|\n\t%s\n' % (str(datetime.now()),
+                    '\n'.join(['flow table for switch='+repr(switch)] + 
+                        [flow_stat_str(f) for f in flow_table])))
+        with self.global_outstanding_queries_lock:
+            (buckets,sent) = self.global_outstanding_queries.pop((switch,xid),([],None))
+        for bucket in buckets:
+            bucket.handle_flow_stats_reply(switch, flow_stats)
+
+    def handle_aggregate_stats_reply(self, switch, aggregate_stats, xid):
         with self.global_outstanding_queries_lock:
-            if switch in self.global_outstanding_queries:
-                for bucket in self.global_outstanding_queries[switch]:
-                    bucket.handle_flow_stats_reply(switch, flow_stats)
-                del self.global_outstanding_queries[switch]
+            (buckets,sent) = self.global_outstanding_queries.pop((switch,xid),([],None))
+        for bucket in buckets:
+            bucket.handle_aggregate_stats_reply(switch, aggregate_stats)
+
+    def handle_flow_removed(self, switch, flow_stat):
+        """
+        Passes the final counts of a table entry removed from switch to
+        the buckets its rule counted into.
+        """
+        cookie = flow_stat.get('cookie')
+        buckets = self.cookie_buckets.get(cookie)
+        if buckets is None:
+            buckets = self.retired_cookie_buckets.get(cookie,[])
+        for bucket in { id(b) : b for b in buckets }.values():
+            bucket.handle_flow_removed(switch, flow_stat)
             
 
 ##########################
@@ -936,7 +1609,7 @@ class Runtime(object):
 def extended_values_from(packet):
     extended_values = {}
     for k, v in packet.header.items():
-        if k not in basic_headers + content_headers + location_headers and v:
+        if k not in basic_headers + content_headers + location_headers + metadata_headers and v:
             extended_values[k] = v
     return util.frozendict(extended_values)
 
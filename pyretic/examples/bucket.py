@@ -33,14 +33,14 @@
 # mininet: mininet.sh --topo=single,3                                          #
 # pyretic: pyretic.py pyretic.examples.bucket -m p0                            #
 # test:    `h_i ping h_j` produce increasing (packet/byte) counts every        #
-#          10 seconds in buckets b_i.                                          #
-#          In i/r0 modes, reported counts from switches are always 0.          #
+#          2.5 seconds in buckets b_i.                                         #
+#          In i/r0 modes, packets are counted at the controller, which sees    #
+#          them all, rather than by switches.                                  #
 ################################################################################
 
 from pyretic.lib.corelib import *
 from pyretic.lib.std import *
 
-import time
 from datetime import datetime
 
 # define some globals for use in various functions
@@ -53,28 +53,16 @@ fwding = ( (match(dstip=ip1) >> fwd(1)) +
            (match(dstip=ip3) >> fwd(3)) )
 
 class QueryTest(CountBucket):
+    """Bucket the runtime polls for counts every 2.5 seconds."""
     
     def __init__(self):
-        super(QueryTest, self).__init__()
+        super(QueryTest, self).__init__(interval=2.5)
         self.register_callback(self.query_callback)
-        import threading
-        self.query_thread = threading.Thread(target=self.query_thread)
-        self.query_thread.daemon = True
-        self.query_thread.start()
-
-    def query_thread(self):
-        """Thread that issues stats queries every 10 seconds."""
-        interval = 2.5
-        while True:
-            output = str(datetime.now()) + "| bucket " + str(id(self)) + ": print matches\n"
-            for m in self.matches:
-                output += str(m) + '\n'
-            self.pull_stats()
-            output += 'issued query, going to sleep for %f' % interval
-            print output
-            time.sleep(interval)
 
     def query_callback(self, counts):
+        print str(datetime.now()) + "| bucket " + str(id(self)) + ": matches"
+        for m in self.matches:
+            print m
         print "*** In user callback for bucket", id(self)
         print "(packet, byte) counts:", counts
 
@@ -88,7 +76,6 @@ def test_main2():
     b = [] # counting buckets
     for i in range(0,2):
         b.append(QueryTest())
-        time.sleep(0.2)
 
     pol1 = match(srcip=ip1) >> b[0]
     pol2 = match(srcip=ip2) >> b[1]
@@ -103,7 +90,6 @@ def test_main3():
     b = [] # counting buckets
     for i in range(0,3):
         b.append(QueryTest())
-        time.sleep(0.2)
 
     query1 = match(srcip=ip1) >> match(dstip=ip2) >> b[0]
     query2 = match(srcip=ip1) >> match(dstip=ip2) >> b[1]
@@ -26,9 +26,51 @@
 # permissions and limitations under the License.                               #
 ################################################################################
 
-from pyretic.core.language import identity, match, union, DerivedPolicy, DynamicFilter, FwdBucket
+from pyretic.core.language import identity, drop, match, union, DerivedPolicy, DynamicPolicy, DynamicFilter, FwdBucket, CountBucket
+import math
+import random
 import time
-from threading import Thread
+from array import array
+from threading import Thread, Lock
+
+DEFAULT_SERIES_SIZE = 256     # samples kept at each resolution of a TimeSeries
+DEFAULT_SKETCH_EPSILON = 0.001 # count-min overestimate, as a fraction of all counted
+DEFAULT_SKETCH_DELTA = 0.01    # probability a count-min estimate exceeds its bound
+
+
+class CountMinSketch(object):
+    """Fixed-memory estimates of the counts of any number of keys.  An estimate is
+    never below the true count, and exceeds it by at most epsilon times the total
+    counted, except with probability delta.
+
+    :param epsilon: the error bound, as a fraction of the total counted.
+    :type epsilon: float
+    :param delta: the probability of exceeding the error bound.
+    :type delta: float
+    """
+    def __init__(self,epsilon=DEFAULT_SKETCH_EPSILON,delta=DEFAULT_SKETCH_DELTA):
+        self.epsilon = epsilon
+        self.delta = delta
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.rows = [array('d',[0.0]*self.width) for i in range(self.depth)]
+        self.total = 0
+
+    def columns(self,key):
+        return [hash((i,key)) % self.width for i in range(self.depth)]
+
+    def add(self,key,count=1):
+        """Count key count more times, returning its new estimate."""
+        self.total += count
+        estimate = None
+        for (row,column) in zip(self.rows,self.columns(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self,key):
+        return min(row[column] for (row,column) in zip(self.rows,self.columns(key)))
 
 class LimitFilter(DynamicFilter):
     """A DynamicFilter that matches the first limit packets in a specified grouping.
@@ -37,10 +79,15 @@ class LimitFilter(DynamicFilter):
     :type limit: int
     :param group_by: the fields by which to group packets.
     :type group_by: list string
+    :param sketch: if given, count the packets seen in this CountMinSketch rather
+        than per grouping, bounding memory at the cost of some groupings being
+        matched fewer than limit times.
+    :type sketch: CountMinSketch
     """
-    def __init__(self,limit=None,group_by=[]):
+    def __init__(self,limit=None,group_by=[],sketch=None):
         self.limit = limit
         self.group_by = group_by
+        self.sketch = sketch
         self.seen = {}
         self.done = []
         super(LimitFilter,self).__init__(identity)
@@ -52,12 +99,18 @@ class LimitFilter(DynamicFilter):
             pred = match([(field,pkt[field]) 
                               for field in pkt.available_group_by()])
         # INCREMENT THE NUMBER OF TIMES MATCHING PKT SEEN
-        try:
-            self.seen[pred] += 1
-        except KeyError:
-            self.seen[pred] = 1
+        if self.sketch is None:
+            try:
+                self.seen[pred] += 1
+            except KeyError:
+                self.seen[pred] = 1
+            reached = self.seen[pred] == self.limit
+        else:
+            # ESTIMATES ONLY GROW, SO EACH GROUPING REACHES THE LIMIT ONCE
+            before = self.sketch.estimate(pred)
+            reached = before < self.limit <= self.sketch.add(pred)
 
-        if self.seen[pred] == self.limit:
+        if reached:
             val = {h : pkt[h] for h in self.group_by}
             self.done.append(match(val))
             self.policy = ~union(self.done)
@@ -66,6 +119,55 @@ class LimitFilter(DynamicFilter):
         return "LimitFilter\n%s" % repr(self.policy)
 
 
+class SampleFilter(DynamicFilter):
+    """A DynamicFilter that matches a sample of packets, either 1 in every n or each
+    with probability p, and sets their sample_rate header to the factor by which
+    counts over the sample should be scaled.
+
+    The sample is taken by the controller, so the packets sampled from still
+    reach it.  Given a period, it is taken in bursts, alternating between
+    matching every packet for period seconds and matching none for long enough
+    that the expected fraction matched is the same.  The filter itself never
+    changes, so switch rules aren't reinstalled as it alternates.
+
+    :param every: match 1 in every n packets.
+    :type every: int
+    :param probability: match each packet with this probability.
+    :type probability: float
+    :param period: if given, the seconds for which every packet is matched.
+    :type period: float
+    """
+    def __init__(self,every=None,probability=None,period=None):
+        if (every is None) == (probability is None):
+            raise TypeError('SampleFilter takes one of every or probability')
+        self.every = every
+        self.probability = probability
+        self.period = period
+        if every is None:
+            self.sample_rate = 1.0 / probability
+        else:
+            self.sample_rate = every
+        self.seen = 0
+        self.start = time.time()
+        super(SampleFilter,self).__init__(identity)
+
+    def eval(self,pkt):
+        if not self.period is None:
+            cycle = self.period * self.sample_rate
+            sampled = (time.time() - self.start) % cycle < self.period
+        elif self.every is None:
+            sampled = random.random() < self.probability
+        else:
+            self.seen += 1
+            sampled = self.seen % self.every == 0
+        if not sampled:
+            return set()
+        return {pkt.modify(sample_rate=self.sample_rate)}
+
+    def __repr__(self):
+        return "SampleFilter\n%s" % repr(self.policy)
+
+
 class packets(DerivedPolicy):
     """A FwdBucket preceeded by a LimitFilter.
 
@@ -73,16 +175,28 @@ class packets(DerivedPolicy):
     :type limit: int
     :param group_by: the fields by which to group packets.
     :type group_by: list string
+    :param payload: whether the callbacks need packet payloads; pass False
+        when they only read headers, so that switches may send just those.
+    :type payload: bool
+    :param sample: if given, the SampleFilter through which packets are
+        sampled before reaching the bucket.
+    :type sample: SampleFilter
+    :param sketch: if given, the CountMinSketch in which the limit counts
+        packets.
+    :type sketch: CountMinSketch
     """
-    def __init__(self,limit=None,group_by=[]):
-        self.fb = FwdBucket()
+    def __init__(self,limit=None,group_by=[],payload=True,sample=None,sketch=None):
+        self.fb = FwdBucket(payload)
         self.register_callback = self.fb.register_callback
-        if limit is None:
-            super(packets,self).__init__(self.fb)
-        else:
-            self.limit_filter = LimitFilter(limit,group_by)
+        policy = self.fb
+        if not limit is None:
+            self.limit_filter = LimitFilter(limit,group_by,sketch)
             self.fb.register_callback(self.limit_filter.update_policy)
-            super(packets,self).__init__(self.limit_filter >> self.fb)
+            policy = self.limit_filter >> policy
+        if not sample is None:
+            self.sample_filter = sample
+            policy = self.sample_filter >> policy
+        super(packets,self).__init__(policy)
         
     def __repr__(self):
         return "packets\n%s" % repr(self.policy)
@@ -96,24 +210,28 @@ class AggregateFwdBucket(FwdBucket):
     are then returned as a dictionary."""
     ### init : int -> List String
     def __init__(self, interval, group_by=[]):
-        FwdBucket.__init__(self)
+        FwdBucket.__init__(self,False)
         self.interval = interval
         self.group_by = group_by
-        if group_by:
-            self.aggregate = {}
-        else:
-            self.aggregate = 0
+        self.aggregate = self.empty_aggregate()
         
-        def report_count(callbacks,aggregate,interval):
-            while(True):
-                for callback in callbacks:
-                    callback(aggregate)
-                time.sleep(interval)
-
-        self.query_thread = Thread(target=report_count,args=(self.callbacks,self.aggregate,self.interval))
+        self.query_thread = Thread(target=self.report_count)
         self.query_thread.daemon = True
         self.query_thread.start()
 
+    def report_count(self):
+        # READ self.aggregate EACH TIME, AS AN INT AGGREGATE IS REPLACED
+        while(True):
+            for callback in self.callbacks:
+                callback(self.aggregate)
+            time.sleep(self.interval)
+
+    def empty_aggregate(self):
+        if self.group_by:
+            return {}
+        else:
+            return 0
+
     def aggregator(self,aggregate,pkt):
         raise NotImplementedError
 
@@ -135,13 +253,321 @@ class AggregateFwdBucket(FwdBucket):
         return set()
 
 
-class count_packets(AggregateFwdBucket):
-    """AggregateFwdBucket that calls back with aggregate count of packets."""
-    def aggregator(self,aggregate,pkt):
-        return aggregate + 1
+class heavy_hitters(AggregateFwdBucket):
+    """AggregateFwdBucket that calls back with the k groups of the most packets (or
+    bytes), as a list of (match, estimated count) pairs, largest first.  Counts are
+    kept in a CountMinSketch, so memory doesn't grow with the number of groups, and
+    each estimate exceeds the true count by at most epsilon times the total counted,
+    except with probability delta.
 
+    :param interval: the seconds between callbacks.
+    :type interval: float
+    :param k: the number of groups reported.
+    :type k: int
+    :param group_by: the fields by which to group packets.
+    :type group_by: list string
+    :param by_bytes: whether to count bytes rather than packets.
+    :type by_bytes: bool
+    """
+    def __init__(self, interval, k, group_by, by_bytes=False,
+                 epsilon=DEFAULT_SKETCH_EPSILON, delta=DEFAULT_SKETCH_DELTA):
+        self.k = k
+        self.by_bytes = by_bytes
+        self.sketch = CountMinSketch(epsilon,delta)
+        self.top = {}
+        AggregateFwdBucket.__init__(self,interval,group_by)
 
-class count_bytes(AggregateFwdBucket):
-    """AggregateFwdBucket that calls back with aggregate bytesize of packets."""
-    def aggregator(self,aggregate,pkt):
-        return aggregate + pkt['header_len'] + pkt['payload_len']
+    def empty_aggregate(self):
+        return []
+
+    def update_aggregate(self,pkt):
+        groups = set(self.group_by) & set(pkt.available_fields())
+        pred = match([(field,pkt[field]) for field in groups])
+        if self.by_bytes:
+            count = pkt['header_len'] + pkt['payload_len']
+        else:
+            count = 1
+        estimate = self.sketch.add(pred,count)
+        if pred in self.top or len(self.top) < self.k:
+            self.top[pred] = estimate
+        else:
+            smallest = min(self.top, key=self.top.get)
+            if self.top[smallest] >= estimate:
+                return
+            del self.top[smallest]
+            self.top[pred] = estimate
+        self.aggregate = sorted(self.top.items(), key=lambda (m,n): -n)
+
+
+class AggregateCountBucket(DynamicPolicy):
+    """An abstract query which, like AggregateFwdBucket, calls back all registered
+    routines every interval seconds with an aggregate value/dict, but whose packets
+    are counted by switch rules rather than sent to the controller.  Each group is
+    counted by its own CountBucket, polled every interval seconds.  Groups are
+    discovered from the first packet of each sent to the controller, after which
+    the group is pinned to a rule of its own."""
+    ### init : int -> List String
+    def __init__(self, interval, group_by=[]):
+        self.interval = interval
+        self.group_by = group_by
+        self.callbacks = []
+        self.groups = {}
+        self.groups_lock = Lock()
+        if group_by:
+            self.aggregate = {}
+            self.discover = FwdBucket(False)
+            self.discover.register_callback(self.add_group)
+            policy = self.discover
+        else:
+            self.aggregate = 0
+            policy = self.group_bucket(identity)
+        super(AggregateCountBucket,self).__init__(policy)
+
+        self.query_thread = Thread(target=self.report_count)
+        self.query_thread.daemon = True
+        self.query_thread.start()
+
+    def register_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def report_count(self):
+        while(True):
+            for callback in self.callbacks:
+                callback(self.aggregate)
+            time.sleep(self.interval)
+
+    def aggregator(self,counts):
+        raise NotImplementedError
+
+    def group_bucket(self,pred):
+        bucket = CountBucket(self.interval)
+        bucket.register_callback(lambda counts: self.update_group(pred,counts))
+        return bucket
+
+    def update_group(self,pred,counts):
+        if self.group_by:
+            self.aggregate[pred] = self.aggregator(counts)
+        else:
+            self.aggregate = self.aggregator(counts)
+
+    ### add_group : Packet -> unit
+    def add_group(self,pkt):
+        # A PACKET MISSING SOME GROUP_BY FIELDS (E.G., ARP FOR srcport) BELONGS
+        # TO NO GROUP, AND PINNING ITS PARTIAL MATCH WOULD SWALLOW OTHER GROUPS
+        fields = pkt.available_fields()
+        if any(not field in fields for field in self.group_by):
+            return
+        pred = match([(field,pkt[field]) for field in self.group_by])
+        with self.groups_lock:
+            if pred in self.groups:
+                return
+            bucket = self.group_bucket(pred)
+            self.groups[pred] = bucket
+            # THE DISCOVERING PACKET ITSELF ISN'T COUNTED BY ANY SWITCH
+            bucket.eval(pkt)
+            bucket.apply()
+            self.update_group(pred,[bucket.packet_count_persistent,
+                                    bucket.byte_count_persistent])
+            pinned = union([ m >> b for (m,b) in self.groups.items() ])
+            self.policy = pinned + (~union(self.groups.keys()) >> self.discover)
+
+    def __repr__(self):
+        return "%s\n%s" % (self.__class__.__name__, repr(self.policy))
+
+
+class count_packets(AggregateCountBucket):
+    """AggregateCountBucket that calls back with aggregate count of packets."""
+    def aggregator(self,counts):
+        return counts[0]
+
+
+class count_bytes(AggregateCountBucket):
+    """AggregateCountBucket that calls back with aggregate bytesize of packets."""
+    def aggregator(self,counts):
+        return counts[1]
+
+
+class RingBuffer(object):
+    """A fixed number of (time, value) samples, oldest overwritten first,
+    kept in preallocated arrays.  With a resolution, only the latest
+    sample in each resolution-second slot is kept.
+
+    :param size: the number of samples kept.
+    :type size: int
+    :param resolution: the seconds between samples kept, if any.
+    :type resolution: float
+    """
+    def __init__(self,size=DEFAULT_SERIES_SIZE,resolution=None):
+        self.size = size
+        self.resolution = resolution
+        self.times = array('d',[0.0]*size)
+        self.values = array('d',[0.0]*size)
+        self.head = 0     # WHERE THE NEXT SAMPLE GOES
+        self.count = 0
+
+    def add(self,t,value):
+        last = (self.head - 1) % self.size
+        if (self.resolution and self.count and
+            int(t / self.resolution) == int(self.times[last] / self.resolution)):
+            # SAME SLOT AS THE LATEST SAMPLE, WHICH THIS ONE REPLACES
+            self.times[last] = t
+            self.values[last] = value
+            return
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def oldest(self):
+        """The time of the oldest sample kept, or None if empty."""
+        if not self.count:
+            return None
+        return self.times[(self.head - self.count) % self.size]
+
+    def samples(self,since=None):
+        """The (time, value) samples in order, starting from the latest one
+        taken at or before since, if given."""
+        result = []
+        for i in range(self.head - self.count, self.head):
+            i %= self.size
+            t = self.times[i]
+            if not since is None and t <= since:
+                result = []
+            result.append((t,self.values[i]))
+        return result
+
+
+class TimeSeries(object):
+    """Bounded history of a value sampled over time: a RingBuffer of the
+    most recent samples, followed by tiers of RingBuffers downsampled to
+    coarser resolutions, which cover longer spans in the same memory.
+    Queries over a window use the finest tier that covers it.
+
+    :param size: the number of recent samples kept.
+    :type size: int
+    :param tiers: the (resolution, size) of each downsampled tier.
+    :type tiers: list (float, int)
+    :param counter: whether the value is a counter, whose max and
+        percentiles are taken over its rate between samples, and which
+        is taken to have been reset when it goes down.
+    :type counter: bool
+    """
+    def __init__(self,size=DEFAULT_SERIES_SIZE,tiers=[],counter=True):
+        self.counter = counter
+        self.levels = [RingBuffer(size)] + [RingBuffer(n,r) for (r,n) in tiers]
+        self.lock = Lock()
+
+    def add(self,value,t=None):
+        if t is None:
+            t = time.time()
+        with self.lock:
+            for level in self.levels:
+                level.add(t,value)
+
+    def samples(self,window=None,now=None):
+        """The samples covering the last window seconds, or as much of it as
+        any tier keeps, or all those kept at the finest resolution if
+        window is None."""
+        if window is None:
+            with self.lock:
+                return self.levels[0].samples()
+        if now is None:
+            now = time.time()
+        since = now - window
+        with self.lock:
+            for level in self.levels:
+                oldest = level.oldest()
+                if not oldest is None and oldest <= since:
+                    return level.samples(since)
+            longest = min(self.levels, key=lambda level: level.oldest())
+            return longest.samples(since)
+
+    def increase(self,v0,v1):
+        if self.counter and v1 < v0:
+            return v1
+        return v1 - v0
+
+    def rate(self,window,now=None):
+        """The average rate of increase over the last window seconds, or
+        None if there are too few samples."""
+        samples = self.samples(window,now)
+        if len(samples) < 2:
+            return None
+        total = sum(self.increase(v0,v1) for ((_,v0),(_,v1))
+                    in zip(samples,samples[1:]))
+        elapsed = samples[-1][0] - samples[0][0]
+        if elapsed <= 0:
+            return None
+        return total / elapsed
+
+    def points(self,window=None,now=None):
+        """The values queries over the window range over: the rates
+        between samples for a counter, otherwise the samples' values."""
+        samples = self.samples(window,now)
+        if not self.counter:
+            return [v for (_,v) in samples]
+        return [ self.increase(v0,v1) / (t1 - t0)
+                 for ((t0,v0),(t1,v1)) in zip(samples,samples[1:])
+                 if t1 > t0 ]
+
+    def max(self,window=None,now=None):
+        points = self.points(window,now)
+        if not points:
+            return None
+        return max(points)
+
+    def percentile(self,p,window=None,now=None):
+        """The p-th percentile (nearest rank) of the points over the window.
+
+        :param p: the percentile, from 0 to 100.
+        :type p: float
+        """
+        points = sorted(self.points(window,now))
+        if not points:
+            return None
+        rank = int(math.ceil(p / 100.0 * len(points)))
+        return points[max(rank,1) - 1]
+
+
+class BucketHistory(object):
+    """TimeSeries of the packet and byte counts a CountBucket reports, and
+    optionally of the counters of each table entry counted into it.
+
+    :param bucket: the bucket whose counts are recorded.
+    :type bucket: CountBucket
+    :param size: the number of recent samples kept in each TimeSeries.
+    :type size: int
+    :param tiers: the (resolution, size) of each downsampled tier.
+    :type tiers: list (float, int)
+    :param per_rule: whether to also keep series per table entry, keyed
+        by (switch, cookie, match items), for as long as the entry exists.
+    :type per_rule: bool
+    """
+    def __init__(self,bucket,size=DEFAULT_SERIES_SIZE,tiers=[],per_rule=False):
+        self.bucket = bucket
+        self.size = size
+        self.tiers = tiers
+        self.per_rule = per_rule
+        self.packets = TimeSeries(size,tiers)
+        self.bytes = TimeSeries(size,tiers)
+        self.rules = {}
+        bucket.register_callback(self.record)
+
+    def record(self,counts):
+        now = time.time()
+        self.packets.add(counts[0],now)
+        self.bytes.add(counts[1],now)
+        if not self.per_rule:
+            return
+        entry_counts = dict(self.bucket.entry_counts)
+        for key in self.rules.keys():
+            if not key in entry_counts:
+                del self.rules[key]
+        for (key,(packets,bytes)) in entry_counts.items():
+            try:
+                (packet_series,byte_series) = self.rules[key]
+            except KeyError:
+                (packet_series,byte_series) = self.rules[key] = \
+                    (TimeSeries(self.size,self.tiers),TimeSeries(self.size,self.tiers))
+            packet_series.add(packets,now)
+            byte_series.add(bytes,now)
@@ -51,7 +51,7 @@ class mac_learner(DynamicPolicy):
         self.set_initial_state()
 
     def set_initial_state(self):
-        self.query = packets(1,['srcmac','switch'])
+        self.query = packets(1,['srcmac','switch'],payload=False)
         self.query.register_callback(self.learn_new_MAC)
         self.forward = self.flood  # REUSE A SINGLE FLOOD INSTANCE
         self.update_policy()
@@ -0,0 +1,86 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+
+from pyretic.backend.comm import *
+
+import pytest
+
+def roundtrip(msg):
+    frame = serialize(msg)
+    (flags,length) = parse_header(frame)
+    assert length == len(frame) - HEADER_LEN
+    return deserialize(frame[HEADER_LEN:])
+
+def test_roundtrip_scalars():
+    msg = ['x', 0, -1, 2**40, 2**70, 1.5, None, True, False, '']
+    assert roundtrip(msg) == msg
+
+def test_roundtrip_packet():
+    raw = ''.join(chr(i) for i in range(256))
+    pkt = {'switch' : 1, 'inport' : 2, 'srcmac' : '\x00\x01\x02\x03\x04\x05',
+           'raw' : raw}
+    assert roundtrip(['packet',pkt]) == ['packet',pkt]
+
+def test_raw_is_not_expanded():
+    raw = 'a' * 1500
+    assert len(serialize(['packet',{'raw' : raw}])) < len(raw) + 64
+
+def test_dict_values_are_repred():
+    assert roundtrip([{'vlan_id' : None}]) == [{'vlan_id' : 'None'}]
+
+def test_bad_magic():
+    frame = serialize(['barrier',1])
+    with pytest.raises(ProtocolError):
+        parse_header('\x00' + frame[1:])
+
+def test_trailing_bytes():
+    frame = serialize(['barrier',1])
+    with pytest.raises(ProtocolError):
+        deserialize(frame[HEADER_LEN:] + 'N')
+
+def test_deserialize_in_place():
+    frames = serialize(['barrier',1]) + serialize(['packet',{'raw' : 'abc'}])
+    buf = bytearray(frames)
+    (flags,length) = parse_header(buf)
+    start = HEADER_LEN + length
+    (flags,length) = parse_header(buf,start)
+    body = start + HEADER_LEN
+    assert deserialize(buf,body,body + length) == ['packet',{'raw' : 'abc'}]
+
+def test_fragments():
+    msg = ['flow_stats_reply',1,[{'cookie' : i, 'x' : 'y' * 64} for i in range(1000)]]
+    frames = fragment(msg,LANE_BULK)
+    assert len(frames) > 1
+    body = ''
+    for f in frames:
+        (flags,length) = parse_header(f)
+        assert flags & LANE_MASK == LANE_BULK
+        assert length <= FRAGMENT_SIZE
+        assert bool(flags & FLAG_MORE) == (f is not frames[-1])
+        body += f[HEADER_LEN:]
+    assert deserialize(body) == msg
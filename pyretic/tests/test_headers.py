@@ -0,0 +1,156 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+
+from pyretic.backend.comm import *
+
+from of_client.headers import *
+
+import struct
+
+SRCMAC = '\x00\x00\x00\x00\x00\x01'
+DSTMAC = '\x00\x00\x00\x00\x00\x02'
+SRCIP = '\x0a\x00\x00\x01'
+DSTIP = '\x0a\x00\x00\x02'
+
+def ipv4(protocol, payload, frag=0):
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 8, 20 + len(payload), 0, frag,
+                       64, protocol, 0, SRCIP, DSTIP) + payload
+
+def eth(ethtype, payload, vlan=None):
+    if vlan is None:
+        return DSTMAC + SRCMAC + struct.pack('!H', ethtype) + payload
+    (vid, pcp) = vlan
+    return (DSTMAC + SRCMAC + struct.pack('!HHH', 0x8100, pcp << 13 | vid, ethtype) +
+            payload)
+
+def test_tcp():
+    raw = eth(0x0800, ipv4(6, struct.pack('!HH', 1234, 80) + '\x00' * 16 + 'data'))
+    h = parse_headers(raw)
+    assert h == {'header_len' : 14, 'payload_len' : len(raw) - 14,
+                 'srcmac' : SRCMAC, 'dstmac' : DSTMAC, 'ethtype' : 0x0800,
+                 'srcip' : SRCIP, 'dstip' : DSTIP, 'protocol' : 6, 'tos' : 8,
+                 'srcport' : 1234, 'dstport' : 80}
+
+def test_vlan_udp():
+    raw = eth(0x0800, ipv4(17, struct.pack('!HHHH', 53, 5353, 8, 0)), vlan=(42, 3))
+    h = parse_headers(raw)
+    assert (h['vlan_id'], h['vlan_pcp'], h['ethtype']) == (42, 3, 0x0800)
+    assert (h['srcport'], h['dstport']) == (53, 5353)
+
+def test_icmp():
+    h = parse_headers(eth(0x0800, ipv4(1, '\x08\x00\x00\x00')))
+    assert (h['srcport'], h['dstport']) == (8, 0)
+
+def test_fragment_has_no_ports():
+    h = parse_headers(eth(0x0800, ipv4(6, '\x00' * 20, frag=0x2000)))
+    assert h['protocol'] == 6 and not 'srcport' in h
+
+def test_arp():
+    arp = struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, SRCMAC, SRCIP,
+                      '\x00' * 6, DSTIP)
+    h = parse_headers(eth(0x0806, arp))
+    assert (h['protocol'], h['srcip'], h['dstip']) == (1, SRCIP, DSTIP)
+
+def test_other_ethertype():
+    h = parse_headers(eth(0x88cc, 'lldp'))
+    assert h['ethtype'] == 0x88cc and not 'srcip' in h
+    assert ethertype(eth(0x88cc, 'lldp')) == 0x88cc
+
+def test_unusual_packets_fall_back():
+    assert parse_headers('short') is None
+    assert parse_headers(eth(0x0800, ipv4(6, '\x00' * 20)[:30])) is None
+    assert parse_headers(eth(0x0800, ipv4(6, '\x00' * 4))) is None
+    assert parse_headers(eth(0x0020, 'llc')) is None
+
+def test_truncated():
+    raw = eth(0x0800, ipv4(6, struct.pack('!HH', 1234, 80) + '\x00' * 16 + 'x' * 1000))
+    h = parse_headers(raw[:128], len(raw))
+    assert h == parse_headers(raw)
+    assert parse_headers(raw[:36], len(raw)) is None
+
+def checksum(data):
+    if len(data) % 2:
+        data += '\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+def with_checksums(raw, l3=14):
+    """Fills in correct IPv4 and TCP/UDP checksums from scratch."""
+    buf = bytearray(raw)
+    buf[l3+10:l3+12] = '\x00\x00'
+    buf[l3+10:l3+12] = struct.pack('!H', checksum(str(buf[l3:l3+20])))
+    protocol = buf[l3+9]
+    segment = str(buf[l3+20:])
+    pseudo = str(buf[l3+12:l3+20]) + struct.pack('!BBH', 0, protocol, len(segment))
+    at = l3 + 20 + (16 if protocol == 6 else 6)
+    buf[at:at+2] = '\x00\x00'
+    segment = str(buf[l3+20:])
+    buf[at:at+2] = struct.pack('!H', checksum(pseudo + segment))
+    return str(buf)
+
+def fields_of(raw):
+    h = parse_headers(raw)
+    del h['header_len'], h['payload_len'], h['ethtype']
+    return h
+
+def test_rewrite_unchanged():
+    raw = with_checksums(eth(0x0800, ipv4(6, struct.pack('!HH', 1, 2) + '\x00' * 16 + 'data')))
+    assert rewrite_headers(raw, fields_of(raw)) == raw
+
+def test_rewrite_checksums():
+    for protocol in [6, 17]:
+        l4 = struct.pack('!HHHH', 1234, 80, 12, 0) + '\x00' * 12 + 'payload'
+        raw = with_checksums(eth(0x0800, ipv4(protocol, l4)))
+        fields = fields_of(raw)
+        fields.update(dstmac='\xff' * 6, srcip='\xc0\xa8\x01\x01', dstport=8080, tos=16)
+        out = rewrite_headers(raw, fields)
+        assert out == with_checksums(out)
+        assert parse_headers(out)['dstport'] == 8080
+        assert parse_headers(out)['tos'] == 16
+
+def test_rewrite_vlan_splice():
+    raw = with_checksums(eth(0x0800, ipv4(17, struct.pack('!HHHH', 1, 2, 8, 0))))
+    fields = fields_of(raw)
+    fields.update(vlan_id=7, vlan_pcp=1)
+    tagged = rewrite_headers(raw, fields)
+    assert len(tagged) == len(raw) + 4
+    assert (parse_headers(tagged)['vlan_id'], parse_headers(tagged)['vlan_pcp']) == (7, 1)
+    del fields['vlan_id'], fields['vlan_pcp']
+    assert rewrite_headers(tagged, fields) == raw
+
+def test_rewrite_falls_back():
+    arp = struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, SRCMAC, SRCIP,
+                      '\x00' * 6, DSTIP)
+    raw = eth(0x0806, arp)
+    assert rewrite_headers(raw, fields_of(raw)) is None
+    raw = with_checksums(eth(0x0800, ipv4(6, '\x00' * 20)))
+    fields = fields_of(raw)
+    fields['protocol'] = 17
+    assert rewrite_headers(raw, fields) is None
@@ -489,3 +489,160 @@ def test_optimize_bug_1():
     print 'classifier.optimize():'
     print classifier.optimize()
     assert classifier == classifier.optimize()
+
+# Payload analysis
+
+def test_needs_payload():
+    def headers(pkt):
+        return pkt['srcip']
+    def payload(pkt):
+        return pkt['raw'][pkt['header_len']:]
+    # CALLBACKS GET FULL PAYLOADS, HOWEVER THEY REACH THEM, UNLESS TOLD OTHERWISE
+    b = FwdBucket()
+    b.register_callback(lambda pkt: payload(pkt))
+    assert ast_fold(needs_payload, False, match(srcip='10.0.0.1') >> b)
+    b = FwdBucket()
+    b.register_callback(headers)
+    assert ast_fold(needs_payload, False, match(srcip='10.0.0.1') >> b)
+    b = FwdBucket(payload=False)
+    b.register_callback(headers)
+    assert not ast_fold(needs_payload, False, match(srcip='10.0.0.1') >> b)
+    assert not ast_fold(needs_payload, False, modify(dstip='10.0.0.2'))
+    assert ast_fold(needs_payload, False, modify(dstport=80))
+
+# Compiling snapshots
+
+def test_snapshot_compiles_as_policy_did():
+    d = DynamicPolicy(match(srcip='10.0.0.1') >> fwd(1))
+    policy = if_(match(dstip='10.0.0.2'), d, fwd(2)) + (d >> fwd(3))
+    before = policy.compile()
+    frozen = snapshot(policy)
+    d.policy = match(srcip='10.0.0.3') >> fwd(4)
+    assert frozen.compile() == before
+    assert snapshot(policy).compile() == policy.compile()
+    assert policy.compile() != before
+
+# Count buckets
+
+def test_count_bucket_attributes_by_cookie():
+    b = CountBucket()
+    b.add_cookie(1)
+    b.add_cookie(2)
+    b.add_cookie(2)
+    counts = []
+    b.register_callback(counts.append)
+    b.add_outstanding_switch_query(1)
+    b.add_outstanding_switch_query(1)
+    stats = [ {'cookie' : cookie, 'priority' : cookie, 'match' : {'inport' : cookie},
+               'packet_count' : packets, 'byte_count' : 10 * packets}
+              for (cookie,packets) in [(0,100), (1,1), (2,2)] ]
+    b.handle_flow_stats_reply(1, stats)
+    # ENTRIES ALREADY COUNTED THIS ROUND ARE SKIPPED
+    b.handle_flow_stats_reply(1, stats[1:])
+    assert counts == [[5, 50]]
+
+def test_count_bucket_streams_deltas():
+    b = CountBucket()
+    b.add_cookie(1)
+    totals = []
+    deltas = []
+    b.register_callback(totals.append)
+    b.register_delta_callback(deltas.append)
+    def poll(packets):
+        b.add_outstanding_switch_query(1)
+        b.entries_counted = set()
+        b.handle_flow_stats_reply(1, [{'cookie' : 1, 'match' : {'inport' : 1},
+                                       'packet_count' : packets,
+                                       'byte_count' : 10 * packets}])
+    poll(3)
+    poll(5)
+    # THE ENTRY IS REMOVED AT 7 AND REINSTALLED, STARTING OVER FROM 0
+    b.handle_flow_removed(1, {'cookie' : 1, 'match' : {'inport' : 1},
+                              'packet_count' : 7, 'byte_count' : 70})
+    poll(1)
+    # REINSTALLED AGAIN WITHOUT A REPORT OF ITS FINAL COUNTS
+    poll(0)
+    assert totals == [[3, 30], [5, 50], [8, 80], [8, 80]]
+    assert deltas == [[3, 30], [2, 20], [3, 30], [0, 0]]
+
+def test_time_series():
+    from pyretic.lib.query import TimeSeries
+    ts = TimeSeries(size=4, tiers=[(10, 4)])
+    for (t,v) in [(0,0), (1,10), (2,30), (3,30), (4,70), (5,5)]:
+        ts.add(v, t)
+    # ONLY THE LAST 4 SAMPLES ARE KEPT AT FULL RESOLUTION
+    assert ts.levels[0].samples() == [(2,30), (3,30), (4,70), (5,5)]
+    assert ts.rate(2, now=5) == (40 + 5) / 2.0
+    # NO TIER COVERS THE WINDOW, SO THE LONGEST HISTORY IS USED
+    assert ts.samples(6, now=5) == [(2,30), (3,30), (4,70), (5,5)]
+    assert ts.levels[1].samples() == [(5,5)]
+    assert ts.max() == 40
+    assert ts.percentile(50) == 5
+
+def test_count_packets_pins_groups():
+    from pyretic.lib.query import count_packets
+    q = count_packets(60, ['srcip'])
+    pkt = Packet({'srcip' : IPAddr('10.0.0.1'), 'header_len' : 14, 'payload_len' : 50})
+    q.policy.eval(pkt)
+    q.discover.apply()
+    assert q.aggregate == {match(srcip=IPAddr('10.0.0.1')) : 1}
+    # THE GROUP IS NOW COUNTED BY A BUCKET OF ITS OWN
+    q.policy.eval(pkt)
+    q.discover.apply()
+    assert len(q.groups) == 1
+    bucket = q.groups.values()[0]
+    assert bucket.interval == 60
+    bucket.apply()
+    assert bucket.packet_count_persistent == 2
+
+def test_sample_filter():
+    from pyretic.lib.query import SampleFilter, packets
+    q = packets(sample=SampleFilter(every=3))
+    sampled = []
+    q.register_callback(sampled.append)
+    for port in range(7):
+        q.eval(Packet({'srcport' : port}))
+        q.fb.apply()
+    assert [pkt['srcport'] for pkt in sampled] == [2, 5]
+    assert all(pkt['sample_rate'] == 3 for pkt in sampled)
+
+def test_sample_filter_period(monkeypatch):
+    from pyretic.lib.query import SampleFilter
+    import pyretic.lib.query as query
+    now = [100.0]
+    monkeypatch.setattr(query.time, 'time', lambda: now[0])
+    f = SampleFilter(every=4,period=2)
+    sampled = []
+    for t in range(10):
+        now[0] = 100.0 + t
+        sampled += [ t for pkt in f.eval(Packet({'srcport' : t})) ]
+    # EVERY PACKET FOR 2 SECONDS IN EACH 8, WITHOUT CHANGING THE FILTER
+    assert sampled == [0, 1, 8, 9]
+    assert f.policy == identity
+
+def test_heavy_hitters():
+    from pyretic.lib.query import heavy_hitters
+    q = heavy_hitters(60, 2, ['srcip'], epsilon=0.01)
+    for (host,packets) in [(1,5), (2,1), (3,9), (4,2)]:
+        for i in range(packets):
+            q.eval(Packet({'srcip' : IPAddr('10.0.0.%d' % host)}))
+    top = [(m.map['srcip'], n) for (m,n) in q.aggregate]
+    assert top == [(IPAddr('10.0.0.3'), 9), (IPAddr('10.0.0.1'), 5)]
+
+def test_count_bucket_reconciles_late_flow_removed():
+    b = CountBucket()
+    b.add_cookie(1)
+    totals = []
+    b.register_callback(totals.append)
+    def poll(packets):
+        b.add_outstanding_switch_query(1)
+        b.handle_aggregate_stats_reply(1, {'packet_count' : packets,
+                                           'byte_count' : 10 * packets})
+    poll(10)
+    # AN ENTRY READ AT 4 IS REMOVED AT 6, BUT THE NEXT READ OVERTAKES
+    # THE REPORT OF ITS FINAL COUNTS
+    poll(6)
+    b.handle_flow_removed(1, {'cookie' : 1, 'match' : {'inport' : 1},
+                              'packet_count' : 6, 'byte_count' : 60})
+    poll(6)
+    assert totals == [[10, 100], [10, 100], [12, 120]]
@@ -0,0 +1,369 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+# author: Christopher Monsanto (chris@monsan.to)                               #
+# author: Cole Schlesinger (cschlesi@cs.princeton.edu)                         #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+################################################################################
+
+from pyretic.core.runtime import *
+from pyretic.lib.corelib import *
+from pyretic.lib.std import *
+from pyretic.lib.query import packets, count_packets
+
+
+class FakeBackend(object):
+    """
+    Records what the runtime sends, and acknowledges each batch of
+    flow table updates at once unless told not to.
+    """
+    def __init__(self):
+        self.runtime = None
+        self.sent = []
+        self.acknowledge = True
+        self.on_apply_diff = None
+
+    def send_apply_diff(self,switch,batch,xid=None):
+        self.sent.append(('apply_diff',switch,batch,xid))
+        if not self.on_apply_diff is None:
+            self.on_apply_diff(switch)
+        if self.acknowledge:
+            self.runtime.handle_barrier_reply(switch,xid)
+
+    def __getattr__(self,name):
+        def send(*args):
+            self.sent.append((name[len('send_'):],) + args)
+        return send
+
+    def messages(self,kind):
+        return [ msg for msg in self.sent if msg[0] == kind ]
+
+
+def make_runtime(policy,switches=[1],mode='proactive1'):
+    backend = FakeBackend()
+    runtime = Runtime(backend,lambda: policy,{},mode=mode)
+    for s in switches:
+        runtime.network.topology.add_node(s, ports={})
+    return (runtime,backend)
+
+
+def packet_in(srcip,switch=1,inport=1):
+    return {'switch' : switch, 'inport' : inport,
+            'srcmac' : '\x00\x00\x00\x00\x00\x01', 'dstmac' : '\x00\x00\x00\x00\x00\x02',
+            'srcip' : srcip, 'dstip' : '10.0.0.9', 'ethtype' : 0x800,
+            'raw' : 'x' * 64, 'header_len' : 14, 'payload_len' : 50}
+
+
+### COUNTING PACKETS SENT TO THE CONTROLLER
+
+def test_controller_rule_counts_at_controller():
+    # THE SWITCH RULE FOR srcip=10.0.0.1 SENDS TO THE CONTROLLER, WHICH
+    # STRIPS THE BUCKET FROM IT, SO ONLY THE CONTROLLER CAN COUNT IT
+    b = CountBucket()
+    policy = ( (match(srcip=IPAddr('10.0.0.1')) >> (b + packets())) +
+               (match(srcip=IPAddr('10.0.0.2')) >> b) )
+    (runtime,backend) = make_runtime(policy)
+    runtime.install_classifier(policy.compile())
+    runtime.handle_packet_in(packet_in('10.0.0.1'))
+    assert b.packet_count_persistent == 1
+    # BUT PACKETS OF RULES THE SWITCH COUNTS AREN'T COUNTED TWICE
+    assert runtime.switch_counted_buckets(
+        runtime.concrete2pyretic(packet_in('10.0.0.2')),{b},
+        runtime.bucket_rules) == {id(b)}
+    runtime.handle_packet_in(packet_in('10.0.0.2'))
+    assert b.packet_count_persistent == 1
+
+def test_packets_evaluated_by_installed_snapshot():
+    # UNTIL THE CHANGED POLICY IS INSTALLED, PACKETS THE OLD RULES SEND UP
+    # ARE HANDLED AS THE OLD POLICY WOULD
+    d = DynamicPolicy(fwd(2))
+    (runtime,backend) = make_runtime(d)
+    runtime.install_classifier(d.compile(),policy=snapshot(d))
+    d.detach()
+    d.policy = fwd(3)
+    runtime.handle_packet_in(packet_in('10.0.0.1'))
+    [(_,pkt,_)] = backend.messages('packet')
+    assert pkt['outport'] == 2
+
+
+### PER-SWITCH FINGERPRINTS
+
+def test_rejoined_switch_is_reinstalled():
+    policy = match(srcip=IPAddr('10.0.0.1')) >> fwd(2)
+    (runtime,backend) = make_runtime(policy,[1,2])
+    classifier = policy.compile()
+    runtime.install_classifier(classifier)
+    assert set(msg[1] for msg in backend.messages('apply_diff')) == {1,2}
+    # UNCHANGED SWITCHES ARE SKIPPED
+    backend.sent = []
+    runtime.install_classifier(classifier)
+    assert backend.messages('apply_diff') == []
+    # SWITCH 1 REBOOTS BETWEEN INSTALLS, COMING BACK WITH AN EMPTY TABLE,
+    # WITHOUT THE TOPOLOGY EVER SETTLING ON IT BEING GONE
+    runtime.network.handle_switch_part = lambda s: None
+    runtime.network.handle_switch_join = lambda s: None
+    runtime.handle_switch_part(1)
+    runtime.handle_switch_join(1)
+    runtime.install_classifier(classifier)
+    assert set(msg[1] for msg in backend.messages('apply_diff')) == {1}
+
+def test_only_changed_switches_are_updated():
+    policy = ( (match(switch=1) >> fwd(2)) +
+               (match(switch=2) >> fwd(3)) )
+    (runtime,backend) = make_runtime(policy,[1,2])
+    runtime.install_classifier(policy.compile())
+    backend.sent = []
+    policy = ( (match(switch=1) >> fwd(2)) +
+               (match(switch=2) >> fwd(4)) )
+    runtime.install_classifier(policy.compile())
+    assert set(msg[1] for msg in backend.messages('apply_diff')) == {2}
+
+
+### INSTALLING UPDATES
+
+def test_stats_not_blocked_while_committing():
+    policy = match(srcip=IPAddr('10.0.0.1')) >> fwd(2)
+    (runtime,backend) = make_runtime(policy)
+    free = []
+    def try_lock(switch):
+        free.append(runtime.old_rules_lock.acquire(False))
+        if free[-1]:
+            runtime.old_rules_lock.release()
+    backend.on_apply_diff = try_lock
+    runtime.install_classifier(policy.compile())
+    assert free and all(free)
+    assert 1 in runtime.old_rules
+
+def test_switch_rejoining_during_commit_is_not_recorded():
+    policy = match(srcip=IPAddr('10.0.0.1')) >> fwd(2)
+    (runtime,backend) = make_runtime(policy)
+    backend.on_apply_diff = runtime.forget_switch_rules
+    runtime.install_classifier(policy.compile())
+    assert not 1 in runtime.old_rules
+    assert not 1 in runtime.switch_fingerprints
+
+def test_updates_split_into_windows():
+    (runtime,backend) = make_runtime(drop)
+    rules = [ ({'switch' : 1, 'tp_dst' : i}, i, [], 0)
+              for i in range(INSTALL_WINDOW * 2 + 5) ]
+    updates = [('barrier',None),('clear',None),('barrier',None)]
+    updates += [ ('install',rule) for rule in rules ]
+    updates.append(('delete',({'switch' : 1}, 0)))
+    assert runtime.commit_switch_update(1,updates)
+    batches = [ msg[2] for msg in backend.messages('apply_diff') ]
+    # BARRIERS DON'T COUNT TOWARDS A WINDOW
+    assert map(len,batches) == [INSTALL_WINDOW + 2, INSTALL_WINDOW, 7]
+    ops = sum(batches,[])
+    assert ops[:2] == [['barrier'],['clear']]
+    assert ops[3:-1] == [ ['install',pred,priority,actions,cookie]
+                          for (pred,priority,actions,cookie) in rules ]
+    assert ops[-1] == ['delete',{'switch' : 1},0]
+    assert runtime.install_progress[1] == (len(updates),len(updates))
+    assert runtime.outstanding_barriers == {}
+
+def test_barrier_timeout_sends_rest_unpaced(monkeypatch):
+    import pyretic.core.runtime as rt
+    monkeypatch.setattr(rt, 'BARRIER_TIMEOUT', 0.05)
+    (runtime,backend) = make_runtime(drop)
+    backend.acknowledge = False
+    rule = ({'switch' : 1}, 1, [], 0)
+    updates = [('install',rule)] * (INSTALL_WINDOW * 4 + 1)
+    start = time.time()
+    assert not runtime.commit_switch_update(1,updates)
+    # ONLY THE FIRST WAIT TIMES OUT, THE OTHERS DON'T WAIT AT ALL
+    assert time.time() - start < 1.0
+    assert len(backend.messages('apply_diff')) == 5
+    assert runtime.outstanding_barriers == {}
+
+def test_policy_changes_during_compile_are_coalesced():
+    import threading
+    policy = match(srcip=IPAddr('10.0.0.1')) >> fwd(2)
+    (runtime,backend) = make_runtime(policy)
+    compiles = []
+    compiling = threading.Event()
+    release = threading.Event()
+    class slow_policy(Policy):
+        def compile(self):
+            compiles.append(runtime.policy_version)
+            compiling.set()
+            release.wait(5)
+            return policy.compile()
+    runtime.policy = slow_policy()
+    runtime.request_update()
+    assert compiling.wait(5)
+    for _ in range(3):
+        runtime.request_update()
+    release.set()
+    deadline = time.time() + 5
+    while runtime.compiled_version != 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert compiles == [1, 4]
+    assert runtime.classifier_version == 4
+
+
+
+### REQUESTING BUCKET STATS
+
+mac1 = MAC('00:00:00:00:00:01')
+mac2 = MAC('00:00:00:00:00:02')
+
+def test_broadest_preds_drop_covered():
+    (runtime,backend) = make_runtime(drop)
+    src = {'srcmac' : mac1}
+    src_dst = {'srcmac' : mac1, 'dstmac' : mac2}
+    dst = {'dstmac' : mac1}
+    assert runtime.broadest_preds([src_dst,src,dst]) == [src,dst]
+    assert runtime.broadest_preds([src,src_dst,{}]) == [{}]
+
+def test_aggregate_requested_when_entries_count_once():
+    b = CountBucket()
+    policy = ( (match(srcmac=mac1) >> b) +
+               (match(dstmac=mac2) >> fwd(2)) )
+    (runtime,backend) = make_runtime(policy)
+    runtime.install_classifier(policy.compile())
+    b.pull_stats()
+    assert len(backend.messages('aggregate_stats_request')) == 1
+    assert backend.messages('flow_stats_request') == []
+
+def test_flow_stats_requested_when_entries_count_twice():
+    b = CountBucket()
+    policy = ( (match(srcmac=mac1) >> b) +
+               (match(srcmac=mac1) >> match(dstmac=mac2) >> b) )
+    (runtime,backend) = make_runtime(policy)
+    runtime.install_classifier(policy.compile())
+    b.pull_stats()
+    assert backend.messages('aggregate_stats_request') == []
+    assert len(backend.messages('flow_stats_request')) == 1
+
+def test_stats_replies_routed_by_xid():
+    b1 = CountBucket()
+    b2 = CountBucket()
+    policy = (match(srcmac=mac1) >> b1) + (match(srcmac=mac2) >> b2)
+    (runtime,backend) = make_runtime(policy)
+    runtime.install_classifier(policy.compile())
+    reports = { id(b1) : [], id(b2) : [] }
+    for b in [b1,b2]:
+        b.register_callback(reports[id(b)].append)
+        b.pull_stats()
+    [(_,_,_,xid1),(_,_,_,xid2)] = backend.messages('aggregate_stats_request')
+    assert xid1 != xid2
+    runtime.handle_aggregate_stats_reply(1,{'packet_count' : 3, 'byte_count' : 300},xid2)
+    assert reports == { id(b1) : [], id(b2) : [[3,300]] }
+    # A REPLY TO A REQUEST ALREADY ANSWERED GOES NOWHERE
+    runtime.handle_aggregate_stats_reply(1,{'packet_count' : 5, 'byte_count' : 500},xid2)
+    assert reports == { id(b1) : [], id(b2) : [[3,300]] }
+    runtime.handle_aggregate_stats_reply(1,{'packet_count' : 4, 'byte_count' : 400},xid1)
+    assert reports == { id(b1) : [[4,400]], id(b2) : [[3,300]] }
+
+
+### SENDING PACKETS
+
+def test_outputs_differing_in_outport_coalesced():
+    (runtime,backend) = make_runtime(drop)
+    pkt = packet_in('10.0.0.1')
+    out = lambda outport, **kw: dict(pkt, outport=outport, **kw)
+    coalesced = runtime.coalesce_outputs([out(2), out(3), out(4, dstip='10.0.0.7'), out(5)])
+    assert coalesced == [ (out(2), [2,3,5]), (out(4, dstip='10.0.0.7'), None) ]
+    assert runtime.coalesce_outputs([out(2)]) == [ (out(2), None) ]
+
+def test_flood_sent_in_one_packet_out():
+    policy = fwd(2) + fwd(3) + fwd(4)
+    (runtime,backend) = make_runtime(policy,mode='interpreted')
+    runtime.handle_packet_in(packet_in('10.0.0.1'))
+    [(_,pkt,outports)] = backend.messages('packet')
+    assert sorted(outports) == [2,3,4]
+    assert pkt['outport'] in outports
+
+def test_outputs_sent_from_switch_buffer():
+    (runtime,backend) = make_runtime(drop)
+    pkt = packet_in('10.0.0.1')
+    out = lambda outport, **kw: dict(pkt, outport=outport, **kw)
+    rest = runtime.send_from_buffer(7, pkt, [out(2), out(3, dstip='10.0.0.8'),
+                                             out(4, dstport=80), out(5, switch=2),
+                                             out(6)])
+    # REWRITES ACCUMULATE, SO LATER OUTPUTS CARRY WHAT THEY CHANGE BACK
+    [(_,switch,inport,buffer_id,actions)] = backend.messages('buffered_packet')
+    assert (switch,inport,buffer_id) == (1,1,7)
+    assert actions == [{'outport' : 2}, {'outport' : 3, 'dstip' : '10.0.0.8'},
+                       {'outport' : 6, 'dstip' : '10.0.0.9'}]
+    assert rest == [out(4, dstport=80), out(5, switch=2)]
+
+def test_arp_ip_rewrites_sent_with_payload():
+    (runtime,backend) = make_runtime(drop)
+    pkt = dict(packet_in('10.0.0.1'), ethtype=0x806)
+    out = lambda outport, **kw: dict(pkt, outport=outport, **kw)
+    rest = runtime.send_from_buffer(7, pkt, [out(2), out(3, dstip='10.0.0.8'),
+                                             out(4, dstmac='\x00\x00\x00\x00\x00\x03')])
+    [(_,_,_,_,actions)] = backend.messages('buffered_packet')
+    assert actions == [{'outport' : 2},
+                       {'outport' : 4, 'dstmac' : '\x00\x00\x00\x00\x00\x03'}]
+    assert rest == [out(3, dstip='10.0.0.8')]
+
+def test_truncated_outputs_not_sent_with_payload():
+    (runtime,backend) = make_runtime(drop)
+    pkt = dict(packet_in('10.0.0.1'), raw='x' * 20)
+    out = lambda outport, **kw: dict(pkt, outport=outport, **kw)
+    assert runtime.send_from_buffer(7, pkt, [out(2), out(4, dstport=80)]) == []
+    [(_,_,_,_,actions)] = backend.messages('buffered_packet')
+    assert actions == [{'outport' : 2}]
+
+
+### COUNTING AGGREGATES
+
+def test_grouped_counts_ignore_packets_missing_fields():
+    q = count_packets(60,['srcip'])
+    (runtime,backend) = make_runtime(q,mode='interpreted')
+    arp = dict(packet_in('10.0.0.1'), ethtype=0x806)
+    del arp['srcip'], arp['dstip']
+    for pkt in [packet_in('10.0.0.1'), arp, packet_in('10.0.0.2'), arp]:
+        runtime.handle_packet_in(pkt)
+    assert sorted(str(m.map['srcip']) for m in q.groups) == ['10.0.0.1','10.0.0.2']
+    # EACH GROUP IS COUNTED ONCE, AND OTHER TRAFFIC STILL DISCOVERED
+    for rule in q.compile().rules:
+        assert len([a for a in rule.actions if isinstance(a,CountBucket)]) <= 1
+    assert q.aggregate == { m : 1 for m in q.groups }
+
+
+### TOPOLOGY CHANGES
+
+class on_network(DynamicPolicy):
+    """Drops packets until the network has switches, then becomes make()."""
+    def __init__(self, make):
+        self.make = make
+        super(on_network,self).__init__(drop)
+
+    def set_network(self, network):
+        if network.topology.nodes():
+            self.policy = self.make()
+
+def test_network_change_refreshes_packet_in_length():
+    (runtime,backend) = make_runtime(on_network(FwdBucket),mode='interpreted')
+    assert runtime.packet_in_length == PACKET_IN_HEADER_LENGTH
+    runtime.handle_network_change()
+    assert runtime.packet_in_length == PACKET_IN_FULL_LENGTH
+    assert backend.messages('packet_in_length')[-1] == ('packet_in_length',PACKET_IN_FULL_LENGTH)
+
+def test_network_change_polls_new_buckets():
+    b = CountBucket(interval=60)
+    (runtime,backend) = make_runtime(on_network(lambda: b),mode='interpreted')
+    assert runtime.polled_buckets == {}
+    runtime.handle_network_change()
+    assert runtime.polled_buckets == { id(b) : b }
@@ -0,0 +1,129 @@
+
+################################################################################
+# The Pyretic Project                                                          #
+# frenetic-lang.org/pyretic                                                    #
+# author: Joshua Reich (jreich@cs.princeton.edu)                               #
+################################################################################
+# Licensed to the Pyretic Project by one or more contributors. See the         #
+# NOTICES file distributed with this work for additional information           #
+# regarding copyright and ownership. The Pyretic Project licenses this         #
+# file to you under the following license.                                     #
+#                                                                              #
+# Redistribution and use in source and binary forms, with or without           #
+# modification, are permitted provided the following conditions are met:       #
+# - Redistributions of source code must retain the above copyright             #
+#   notice, this list of conditions and the following disclaimer.              #
+# - Redistributions in binary form must reproduce the above copyright          #
+#   notice, this list of conditions and the following disclaimer in            #
+#   the documentation or other materials provided with the distribution.       #
+# - The names of the copyright holds and contributors may not be used to       #
+#   endorse or promote products derived from this work without specific        #
+#   prior written permission.                                                  #
+#                                                                              #
+# Unless required by applicable law or agreed to in writing, software          #
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT    #
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the     #
+# LICENSE file distributed with this work for specific language governing      #
+# permissions and limitations under the License.                               #
+
+from pyretic.backend.comm import *
+
+from pyretic.backend.shm import *
+
+import os
+import pytest
+
+@pytest.fixture
+def ring():
+    r = Ring(ring_path('test'), 256)
+    yield r
+    r.close()
+    os.unlink(r.path)
+
+def test_ring_fifo(ring):
+    reader = Ring(ring.path)
+    assert reader.read() is None
+    for i in range(100):
+        assert ring.write('record %d' % i)
+        assert reader.read() == 'record %d' % i
+    assert reader.read() is None
+    reader.close()
+
+def test_ring_full(ring):
+    written = 0
+    while ring.write('x' * 40):
+        written += 1
+    assert written == 256 / 48
+    assert ring.read() == 'x' * 40
+    assert ring.write('x' * 40)
+
+def test_ring_wraps(ring):
+    bodies = [ 'y' * (i % 50) for i in range(200) ]
+    received = []
+    for b in bodies:
+        while not ring.write(b):
+            received.append(ring.read())
+    while True:
+        r = ring.read()
+        if r is None:
+            break
+        received.append(r)
+    assert received == bodies
+
+@pytest.fixture
+def transports():
+    a = ShmTransport.create(None, 1024)
+    b = ShmTransport(a.rx_paths(), a.tx_paths(), None)
+    a.unlink()
+    yield (a,b)
+    a.close()
+    b.close()
+
+def test_transport_lanes_keep_order(transports):
+    (a,b) = transports
+    bodies = [ encode_message(['bulk', 'z' * n]) for n in [10, 600, 20] ]
+    assert len(bodies[1]) > a.tx[LANE_BULK].max_record
+    for body in bodies:
+        assert a.send_body(body, LANE_BULK)
+    assert a.send_body(encode_message(['packet']), LANE_PACKET)
+    # THE URGENT LANE IS READ FIRST, EACH LANE IN ORDER
+    assert deserialize(b.receive()) == ['packet']
+    for body in bodies:
+        assert b.receive() == body
+    assert b.receive() is None
+
+def test_transport_split_records_wrap(transports):
+    (a,b) = transports
+    for i in range(100):
+        body = encode_message(['bulk', 'q' * (i * 37 % 700)])
+        assert a.send_body(body, LANE_BULK)
+        assert b.receive() == body
+
+def test_transport_droppable_whole_messages(transports):
+    (a,b) = transports
+    body = encode_message(['stats', 'w' * 400])
+    sent = 0
+    while a.send_body(body, LANE_BULK, droppable=True):
+        sent += 1
+    assert sent > 0
+    assert a.dropped == 1
+    for _ in range(sent):
+        assert b.receive() == body
+    assert b.receive() is None
+
+def test_transport_delivers_from_one_thread(transports):
+    import threading
+    (a,b) = transports
+    seen = []
+    done = threading.Event()
+    def handler(msg):
+        seen.append((msg, threading.current_thread()))
+        if len(seen) == 2:
+            done.set()
+    b.handler = handler
+    b.start()
+    assert a.send_body(encode_message(['ring']), LANE_CONTROL)
+    b.post(['socket'])
+    assert done.wait(5)
+    assert sorted(m[0] for (m,_) in seen) == ['ring', 'socket']
+    assert all(t is b.poller for (_,t) in seen)